@@ -4,7 +4,15 @@ from django.db.models import Count
 from django.utils.html import format_html
 from resonant_utils.admin import ReadonlyTabularInline
 
-from isic.core.models import Collection, Doi, GirderDataset, GirderImage, Image, ImageAlias
+from isic.core.models import (
+    Collection,
+    Doi,
+    GirderDataset,
+    GirderImage,
+    Image,
+    ImageAlias,
+    Job,
+)
 from isic.core.models.doi import DoiRelatedIdentifier, DraftDoi, DraftDoiRelatedIdentifier
 from isic.core.models.segmentation import Segmentation, SegmentationReview
 from isic.core.models.supplemental_file import DraftSupplementalFile, SupplementalFile
@@ -182,6 +190,13 @@ class ImageAliasAdmin(StaffReadonlyAdmin):
     autocomplete_fields = ["image"]
 
 
+@admin.register(Job)
+class JobAdmin(StaffReadonlyAdmin):
+    list_display = ["key", "status", "attempts", "processed", "total", "progress", "modified"]
+    list_filter = ["status"]
+    search_fields = ["key"]
+
+
 @admin.register(Collection)
 class CollectionAdmin(StaffReadonlyAdmin):
     list_select_related = ["creator", "doi"]
@@ -1,3 +1,4 @@
+from functools import partial
 from typing import Annotated, Literal
 
 from django.contrib import messages
@@ -12,6 +13,7 @@ from pydantic import field_validator
 
 from isic.auth import allow_any, is_authenticated, is_staff
 from isic.core.constants import ISIC_ID_REGEX
+from isic.core.counts import queryset_count
 from isic.core.models.collection import Collection
 from isic.core.pagination import CursorPagination
 from isic.core.permissions import get_visible_objects
@@ -63,7 +65,10 @@ class CollectionOut(ModelSchema):
 )
 @paginate(CursorPagination)
 def collection_list(
-    request, pinned: bool | None = None, sort: Literal["name", "created"] | None = None
+    request,
+    pinned: bool | None = None,
+    sort: Literal["name", "created"] | None = None,
+    exact_count: bool | None = None,
 ) -> list[CollectionOut]:
     queryset = get_visible_objects(request.user, "core.view_collection", Collection.objects.all())
 
@@ -73,6 +78,8 @@ def collection_list(
     if sort is not None:
         queryset = queryset.order_by(sort)
 
+    # large counts are estimated unless an exact count is requested
+    queryset.custom_count = partial(queryset_count, queryset, exact=bool(exact_count))
     return queryset
 
 
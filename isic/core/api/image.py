@@ -1,32 +1,52 @@
-from typing import Any
+from collections.abc import Callable, Generator, Iterable
+from dataclasses import dataclass
+from functools import cache
+from itertools import batched
+from typing import Annotated, Any, Literal
 
 from django.conf import settings
 from django.contrib import messages
-from django.core.cache import cache
-from django.core.exceptions import ValidationError as DjangoValidationError
-from django.db import transaction
-from django.db.models import Case, Max, Q, Value, When
+from django.db import connection, transaction
+from django.db.models import Case, Max, QuerySet, Value, When
+from django.http import StreamingHttpResponse
 from django.http.request import HttpRequest
 from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
+from django.utils.cache import patch_vary_headers
 from isic_metadata import FIELD_REGISTRY
 from ninja import Field, ModelSchema, Query, Router, Schema
-from ninja.errors import ValidationError as NinjaValidationError
 from ninja.pagination import paginate
-from pyparsing.exceptions import ParseException
+import orjson
+import pyarrow as pa
 from sentry_sdk import set_tag
 
 from isic.auth import allow_any, is_authenticated, is_staff
+from isic.core.constants import ISIC_ID_REGEX
+from isic.core.counts import image_count
+from isic.core.dsl import ParseException
 from isic.core.models import Image
-from isic.core.pagination import CursorPagination, qs_with_hardcoded_count
+from isic.core.models.image_embedding import MAX_EF_SEARCH
+from isic.core.pagination import Cursor, CursorPagination, clamp, qs_with_hardcoded_count
 from isic.core.permissions import get_visible_objects
-from isic.core.search import facets, get_elasticsearch_client
+from isic.core.search import facets, get_elasticsearch_client, queue_search_index_update
 from isic.core.serializers import SearchQueryIn
+from isic.core.services.image import find_similar_images, sign_image_file_urls
+from isic.core.utils.cache import get_or_set_single_flight
+from isic.core.utils.http import ChunkSink, accepted_content_coding, compress_stream
+from isic.ingest.models import Accession
+from isic.ingest.utils.parquet import build_parquet_schema
 from isic.types import AuthenticatedHttpRequest
 
 router = Router()
 
-default_qs = Image.objects.select_related("accession__cohort").distinct()
+default_qs = Image.objects.select_related("accession__cohort")
+
+IMAGE_BATCH_MAX_SIZE = 5_000
+# the number of serialized images written per chunk of a streamed batch response
+IMAGE_BATCH_CHUNK_SIZE = 500
+# the number of images fetched from the server side cursor and written per chunk (or arrow
+# record batch) of an export.
+IMAGE_EXPORT_BATCH_SIZE = 2_000
 
 
 class ImageSearchParseError(Exception):
@@ -73,7 +93,7 @@ class ImageOut(ModelSchema):
             "clinical": {},
         }
 
-        for key, value in image.metadata.items():
+        for key, value in image.public_metadata.items():
             try:
                 metadata[FIELD_REGISTRY[key].type][key] = value  # type: ignore[index]
             except KeyError:
@@ -88,102 +108,110 @@ class ImageOut(ModelSchema):
         return metadata
 
 
+@dataclass
+class ElasticsearchImageResults:
+    """A search which is paginated by elasticsearch rather than the database."""
+
+    query: dict
+    # called only when the page includes the count
+    count: Callable[[], int]
+
+
 class PinnedFirstPagination(CursorPagination):
-    # Subclass of CursorPagination with custom behavior to allow ordering by multiple fields
-    # If query contains "pin_sort=true", return pinned images first, then sort by created.
-    #
-    # NOTE: Django Ninja has its own CursorPagination implementation upstream
-    # (https://github.com/vitalik/django-ninja/pull/1657), but it only derives the cursor
-    # position and the seek (__gt/__lt) filter from the FIRST ordering field -- any
-    # additional ordering fields affect ORDER BY only, not the keyset comparison. That
-    # makes it incorrect for paging across more than one field (e.g. "-pinned", "created"):
-    # rows tied on the first field aren't disambiguated by the rest. _apply_ordering and
-    # _get_position_from_instance are overridden below to build the position and the
-    # predicate from *all* ordering fields.
-
-    def _apply_ordering(self, queryset, cursor, order):
+    # Subclass of CursorPagination which orders by pinned first if the query contains
+    # "pin_sort=true", then by created.
+
+    def _paginate_elasticsearch(
+        self,
+        results: ElasticsearchImageResults,
+        pagination: CursorPagination.Input,
+        request: HttpRequest,
+        *,
+        pin_sort: bool,
+    ) -> dict:
         """
-        Filter ``queryset`` down to the rows that fall *after* the cursor position.
-
-        This is the multi-field generalization of the keyset/seek predicate. The
-        cursor encodes one value per ordering field (joined by "|"), and we need the
-        SQL equivalent of a lexicographic tuple comparison against that position.
-        For ordering ``(-pinned, created, id)`` (pinned descending, the rest
-        ascending) paging forward, "after" the cursor row
-        ``(pinned=P, created=C, id=I)`` means::
-
-            pinned < P
-            OR (pinned = P AND created > C)
-            OR (pinned = P AND created = C AND id > I)
-
-        It's expanded by hand into this OR-of-ANDs rather than using a SQL row-value
-        constructor (``(pinned, created, id) > (P, C, I)``) because row-value
-        comparison can't express per-field ascending/descending directions, which
-        keyset pagination requires (here ``pinned`` descends while ``created`` and
-        ``id`` ascend).
-
-        Each ordering field contributes one OR term: a strict comparison on that
-        field (``__gt``/``__lt``, flipped for descending fields and for reverse
-        cursor across an ordering change) AND equality on every field before it.
-
-        The cursor position is user-controlled, so it's fully validated here: a
-        position that doesn't match the current ordering, or a value that isn't
-        parseable as its ordering field's type, raises ``NinjaValidationError`` so
-        the caller can surface it as a 400/422 rather than a 500.
+        Paginate a search by seeking through the images index with search_after.
+
+        The sort always ends with the id, so every position is unique and offsets aren't needed.
+        The position is the sort values of an image in the index, which for created is epoch
+        milliseconds. Only the images on the page are fetched from the database.
         """
+        limit = clamp(pagination.limit or self.max_page_size, 0, self.max_page_size)
+        cursor = pagination.cursor
+        base_url = request.build_absolute_uri()
+
+        sort = [("pinned", "desc")] if pin_sort else []
+        sort += [("created", "asc"), ("id", "asc")]
+
+        search_after = None
         if cursor.position is not None:
-            position_values = cursor.position.split("|")
-            if len(position_values) != len(order):
-                # The cursor was built for a different ordering than this request
-                # (e.g. pin_sort was toggled).
+            search_after = list(cursor.position)
+
+            if len(search_after) != len(sort) or not all(
+                isinstance(value, int) and not isinstance(value, bool) for value in search_after
+            ):
                 raise self._invalid_cursor()
 
-            field_names = [field.lstrip("-") for field in order]
-
-            # Coerce each position value to the type of its ordering field (e.g. reject a
-            # mangled datetime string) before it reaches the database.
-            positions = []
-            for field_name, value in zip(field_names, position_values, strict=True):
-                try:
-                    positions.append(queryset.model._meta.get_field(field_name).to_python(value))
-                except DjangoValidationError as e:
-                    raise self._invalid_cursor() from e
-
-            q_obj = Q()
-            for i, field in enumerate(order):
-                is_reversed = field.startswith("-")
-                comparison = "__gt" if cursor.reverse == is_reversed else "__lt"
-                # Strict comparison on field i AND equality on every field before it.
-                field_condition = Q(**{f"{field_names[i]}{comparison}": positions[i]})
-                for j in range(i):
-                    field_condition &= Q(**{field_names[j]: positions[j]})
-
-                q_obj |= field_condition
-            queryset = queryset.filter(q_obj)
-        return queryset
+        if cursor.reverse:
+            sort = [(field, "asc" if order == "desc" else "desc") for field, order in sort]
 
-    @staticmethod
-    def _invalid_cursor() -> NinjaValidationError:
-        # match the message format of pydantic's rendering of a ValueError, which is
-        # how a cursor that fails to decode is reported
-        return NinjaValidationError(
-            [{"loc": ["query", "cursor"], "msg": "Value error, Invalid cursor."}]
+        hits = get_elasticsearch_client().search(
+            index=settings.ISIC_ELASTICSEARCH_IMAGES_INDEX,
+            query=results.query,
+            sort=[{field: order} for field, order in sort],
+            search_after=search_after,
+            # Always fetch the maximum page size to increase cache utilization.
+            size=self.max_page_size + 1,
+            source=False,
+            track_total_hits=False,
+        )["hits"]["hits"]
+
+        has_following_position = len(hits) > limit
+        hits = hits[:limit]
+
+        if cursor.reverse:
+            hits.reverse()
+            has_next = True
+            has_previous = has_following_position
+        else:
+            has_next = has_following_position
+            has_previous = cursor.position is not None
+
+        # the index lags the database, so images are filtered by their current visibility too
+        images = get_visible_objects(request.user, "core.view_image", default_qs).in_bulk(
+            [int(hit["_id"]) for hit in hits]
         )
 
-    def _get_position_from_instance(self, instance, ordering):
-        values = []
-        for field in ordering:
-            fname = field.lstrip("-")
-            attr = instance[fname] if isinstance(instance, dict) else getattr(instance, fname)
-            values.append(str(attr))
-        return "|".join(values)
+        def link(hit: dict, *, reverse: bool) -> str:
+            return self._encode_cursor(
+                Cursor(reverse=reverse, position=tuple(hit["sort"])), base_url
+            )
+
+        return {
+            # an image could have been deleted or hidden since it was indexed
+            "results": [images[int(hit["_id"])] for hit in hits if int(hit["_id"]) in images],
+            "count": results.count() if cursor.position is None else None,
+            "next": link(hits[-1], reverse=False) if has_next and hits else None,
+            "previous": link(hits[0], reverse=True) if has_previous and hits else None,
+        }
 
     def paginate_queryset(self, queryset, pagination, request, **params):
-        if request.GET.get("pin_sort") or params.get("pin_sort"):
-            queryset = queryset.order_by("-pinned", "created")
+        pin_sort = bool(request.GET.get("pin_sort") or params.get("pin_sort"))
+
+        if isinstance(queryset, ElasticsearchImageResults):
+            page = self._paginate_elasticsearch(queryset, pagination, request, pin_sort=pin_sort)
         else:
-            queryset = queryset.order_by("created")
-        return super().paginate_queryset(queryset, pagination, request, **params)
+            ordered = queryset.order_by(*(["-pinned"] if pin_sort else []), "created")
+
+            # ordering clones the queryset, which would lose a count set by
+            # qs_with_hardcoded_count.
+            if hasattr(queryset, "custom_count"):
+                ordered.custom_count = queryset.custom_count
+
+            page = super().paginate_queryset(ordered, pagination, request, **params)
+
+        sign_image_file_urls(page["results"])
+        return page
 
 
 @router.get(
@@ -198,12 +226,9 @@ def image_list(request: HttpRequest):
     qs = get_visible_objects(request.user, "core.view_image", default_qs)
 
     if settings.ISIC_USE_ELASTICSEARCH_COUNTS:
-        es_query = SearchQueryIn().to_es_query(request.user)
-        es_count = get_elasticsearch_client().count(
-            index=settings.ISIC_ELASTICSEARCH_IMAGES_INDEX,
-            body={"query": es_query},
-        )["count"]
-        return qs_with_hardcoded_count(qs, Image._meta.ordering, es_count)
+        return qs_with_hardcoded_count(
+            qs, Image._meta.ordering, lambda: image_count(SearchQueryIn(), request.user)
+        )
 
     return qs
 
@@ -219,9 +244,15 @@ def image_list(request: HttpRequest):
 @paginate(PinnedFirstPagination)
 def image_search(request: HttpRequest, search: SearchQueryIn = Query(...)):
     try:
-        qs = search.to_queryset(user=request.user, qs=default_qs)
-        if settings.ISIC_USE_ELASTICSEARCH_COUNTS:
+        if settings.ISIC_USE_ELASTICSEARCH_SEARCH_RESULTS:
+            # the page is found by elasticsearch, so the query doesn't need to be parsed
+            # for the database.
+            qs = None
             es_query = search.to_es_query(request.user)
+        else:
+            qs = search.to_queryset(user=request.user, qs=default_qs)
+            if settings.ISIC_USE_ELASTICSEARCH_COUNTS:
+                es_query = search.to_es_query(request.user)
     except ParseException as e:
         # Normally we'd like this to be handled by the input serializer validation, but
         # for backwards compatibility we must return 400 rather than 422.
@@ -229,11 +260,14 @@ def image_search(request: HttpRequest, search: SearchQueryIn = Query(...)):
         # The handler for this exception type is defined in urls.py.
         raise ImageSearchParseError from e
     else:
-        if settings.ISIC_USE_ELASTICSEARCH_COUNTS:
-            es_count = get_elasticsearch_client().count(
-                index=settings.ISIC_ELASTICSEARCH_IMAGES_INDEX,
-                body={"query": es_query},
-            )["count"]
+        if settings.ISIC_USE_ELASTICSEARCH_SEARCH_RESULTS or settings.ISIC_USE_ELASTICSEARCH_COUNTS:
+
+            def es_count() -> int:
+                return image_count(search, request.user, es_query)
+
+            if qs is None:
+                return ElasticsearchImageResults(query=es_query, count=es_count)
+
             return qs_with_hardcoded_count(qs, Image._meta.ordering, es_count)
 
         return qs
@@ -270,21 +304,202 @@ def image_search_size(request: HttpRequest, search: SearchQueryIn = Query(...)):
 @router.get("/facets/", response=dict, include_in_schema=False, auth=allow_any)
 def image_facets(request: HttpRequest, search: SearchQueryIn = Query(...)):
     cache_key = f"image_facets:{search.to_cache_key(request.user)}"
-    cached_facets = cache.get(cache_key)
 
-    set_tag("cached_facets", cached_facets is not None)
+    set_tag("cached_facets", value=True)
+
+    def compute_facets() -> dict:
+        set_tag("cached_facets", value=False)
+
+        try:
+            query = search.to_es_query(request.user)
+        except ParseException as e:
+            raise ImageSearchParseError from e
 
-    if cached_facets:
-        return cached_facets
+        return facets(query)
+
+    return get_or_set_single_flight(cache_key, compute_facets, 86400)
+
+
+class ImageBatchIn(Schema):
+    isic_ids: Annotated[
+        list[Annotated[str, Field(pattern=ISIC_ID_REGEX)]],
+        Field(min_length=1, max_length=IMAGE_BATCH_MAX_SIZE),
+    ]
+
+    model_config = {"extra": "forbid"}
 
+
+class ImageBatchOut(Schema):
+    results: list[ImageOut]
+    no_perms_or_does_not_exist: list[str]
+
+
+def _write_image_batch(images: list[Image], missing: list[str]) -> Generator[bytes]:
+    yield b'{"results": ['
+
+    has_preceding_element = False
+    for image_batch in batched(images, IMAGE_BATCH_CHUNK_SIZE, strict=False):
+        chunk: list[bytes] = []
+        for image in image_batch:
+            if has_preceding_element:
+                chunk.append(b",")
+            has_preceding_element = True
+            # json mode renders decimal metadata as strings, as the default renderer does
+            chunk.append(orjson.dumps(ImageOut.from_orm(image).model_dump(mode="json")))
+        yield b"".join(chunk)
+
+    yield b'], "no_perms_or_does_not_exist": ' + orjson.dumps(missing) + b"}"
+
+
+@cache
+def image_export_schema() -> pa.Schema:
+    """
+    Return the arrow schema of exported images, which mirrors ImageOut.
+
+    The metadata has the same fields as the metadata parquet export.
+    """
+    file_type = pa.struct([("url", pa.string()), ("size", pa.int64())])
+
+    metadata_fields: dict[str, list[pa.Field]] = {
+        "acquisition": [pa.field("pixels_x", pa.int64()), pa.field("pixels_y", pa.int64())],
+        "clinical": [],
+    }
+    computed_field_types = {
+        field_name: computed_field.type
+        for computed_field in Accession.computed_fields
+        for field_name in computed_field.output_field_names
+    }
+
+    for field in build_parquet_schema():
+        if field.name in FIELD_REGISTRY:
+            metadata_fields[FIELD_REGISTRY[field.name].type].append(field)
+        elif field.name in computed_field_types:
+            metadata_fields[computed_field_types[field.name]].append(field)
+
+    return pa.schema(
+        [
+            ("public", pa.bool_()),
+            ("isic_id", pa.string()),
+            ("copyright_license", pa.string()),
+            ("attribution", pa.string()),
+            ("files", pa.struct([("full", file_type), ("thumbnail_256", file_type)])),
+            (
+                "metadata",
+                pa.struct([(name, pa.struct(fields)) for name, fields in metadata_fields.items()]),
+            ),
+        ]
+    )
+
+
+def _image_export_batches(qs: QuerySet[Image]) -> Generator[list[Image]]:
+    # the export is read from one snapshot, which requires the transaction to stay open
+    # while the response is streamed.
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+        for image_batch in batched(
+            qs.iterator(chunk_size=IMAGE_EXPORT_BATCH_SIZE), IMAGE_EXPORT_BATCH_SIZE, strict=False
+        ):
+            images = list(image_batch)
+            sign_image_file_urls(images)
+            yield images
+
+
+def _write_ndjson(batches: Iterable[list[Image]]) -> Generator[bytes]:
+    for images in batches:
+        yield b"".join(
+            orjson.dumps(ImageOut.from_orm(image).model_dump(mode="json")) + b"\n"
+            for image in images
+        )
+
+
+def _write_arrow(batches: Iterable[list[Image]]) -> Generator[bytes]:
+    schema = image_export_schema()
+    sink = ChunkSink()
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for images in batches:
+            writer.write_batch(
+                pa.RecordBatch.from_pylist(
+                    [ImageOut.from_orm(image).model_dump() for image in images], schema=schema
+                )
+            )
+            yield sink.take()
+
+    # closing the writer writes the end of stream marker
+    yield sink.take()
+
+
+# this must be defined before /{isic_id}/, otherwise the path is resolved as an ISIC ID.
+@router.post(
+    "/batch/",
+    response=ImageBatchOut,
+    summary="Retrieve many images by ISIC ID.",
+    include_in_schema=True,
+    auth=allow_any,
+)
+def image_batch(request: HttpRequest, payload: ImageBatchIn):
+    isic_ids = list(dict.fromkeys(payload.isic_ids))
+    qs = get_visible_objects(request.user, "core.view_image", default_qs)
+    visible_images = qs.filter(isic_id__in=isic_ids).in_bulk(field_name="isic_id")
+
+    images = [visible_images[isic_id] for isic_id in isic_ids if isic_id in visible_images]
+    missing = [isic_id for isic_id in isic_ids if isic_id not in visible_images]
+    sign_image_file_urls(images)
+
+    return StreamingHttpResponse(
+        _write_image_batch(images, missing), content_type="application/json"
+    )
+
+
+EXPORT_CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+# this must be defined before /{isic_id}/, otherwise the path is resolved as an ISIC ID.
+@router.get(
+    "/export/",
+    summary="Export every image matching a search.",
+    description=(
+        "Stream every image matching a search, ordered by ISIC ID, as newline delimited JSON "
+        "or an Arrow IPC stream. The response is compressed with zstd or gzip if the client "
+        "accepts either. An interrupted export can be resumed by passing the last ISIC ID "
+        "received as after."
+    ),
+    include_in_schema=True,
+    auth=allow_any,
+)
+def image_export(
+    request: HttpRequest,
+    search: SearchQueryIn = Query(...),
+    export_format: Literal["ndjson", "arrow"] = Query("ndjson", alias="format"),
+    after: str | None = Query(None, pattern=ISIC_ID_REGEX),
+):
     try:
-        query = search.to_es_query(request.user)
+        qs = search.to_queryset(user=request.user, qs=default_qs)
     except ParseException as e:
         raise ImageSearchParseError from e
 
-    ret = facets(query)
-    cache.set(cache_key, ret, 86400)
-    return ret
+    if after is not None:
+        qs = qs.filter(isic_id__gt=after)
+
+    batches = _image_export_batches(qs.order_by("isic_id"))
+    content = _write_arrow(batches) if export_format == "arrow" else _write_ndjson(batches)
+
+    content_coding = accepted_content_coding(request)
+    if content_coding:
+        content = compress_stream(content, content_coding)
+
+    response = StreamingHttpResponse(content, content_type=EXPORT_CONTENT_TYPES[export_format])
+
+    if content_coding:
+        response["Content-Encoding"] = content_coding
+    patch_vary_headers(response, ["Accept-Encoding"])
+
+    return response
 
 
 @router.get(
@@ -311,17 +526,32 @@ class SimilarImageOut(ImageOut):
     auth=is_authenticated,
 )
 def image_similar(
-    request: AuthenticatedHttpRequest, isic_id: str, limit: int = Query(10, le=50)
+    request: AuthenticatedHttpRequest,
+    isic_id: str,
+    limit: int = Query(10, le=50),
+    ef_search: int | None = Query(
+        None,
+        ge=1,
+        le=MAX_EF_SEARCH,
+        description="The size of the candidate list of an HNSW search. Higher values improve "
+        "recall at the cost of latency.",
+    ),
+    probes: int | None = Query(
+        None,
+        ge=1,
+        le=1000,
+        description="The number of lists probed by an IVFFlat search. Higher values improve "
+        "recall at the cost of latency.",
+    ),
 ) -> list[SimilarImageOut]:
     qs = get_visible_objects(request.user, "core.view_image", default_qs)
     image = get_object_or_404(qs, isic_id=isic_id)
 
-    if not image.has_embedding:
-        return []
-
-    similar_qs = image.similar_images().select_related("accession__cohort")
-    similar_qs = get_visible_objects(request.user, "core.view_image", similar_qs)
-    return similar_qs[:limit]
+    similar_images = find_similar_images(
+        image=image, user=request.user, limit=limit, ef_search=ef_search, probes=probes
+    )
+    sign_image_file_urls(similar_images)
+    return similar_images
 
 
 class SetPinned(Schema):
@@ -338,7 +568,7 @@ class SetPinned(Schema):
 )
 def image_set_pinned(request, id: int, payload: SetPinned):
     qs = get_visible_objects(request.user, "core.view_image", Image.objects.all())
-    image = get_object_or_404(qs.distinct(), id=id)
+    image = get_object_or_404(qs, id=id)
     if payload.pinned:
         if not image.public:
             return 400, {"error": "Cannot pin a private image."}
@@ -346,7 +576,11 @@ def image_set_pinned(request, id: int, payload: SetPinned):
         image.pinned = last_pin + 1
     else:
         image.pinned = 0
-    image.save()
+
+    with transaction.atomic():
+        image.save()
+        queue_search_index_update(image=image)
+
     action = "pinned" if payload.pinned else "unpinned"
     messages.add_message(request, messages.SUCCESS, f"Image {action}.")
     return 200, None
@@ -380,5 +614,7 @@ def image_pins_reorder(request: HttpRequest, payload: PinOrder):
             transaction.set_rollback(True)
             return 400, {"error": "Invalid ISIC ID list."}
 
+        queue_search_index_update(qs=Image.objects.filter(public=True, isic_id__in=payload.order))
+
     messages.add_message(request, messages.SUCCESS, "Reordered pinned images.")
     return 200, None
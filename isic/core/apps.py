@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     name = "isic.core"
     verbose_name = "ISIC Archive: Core"
+
+    def ready(self):
+        from isic.core import receivers  # noqa: F401
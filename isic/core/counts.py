@@ -0,0 +1,82 @@
+"""
+Total counts for paginated lists.
+
+Counts are computed lazily so that requests for pages which don't report a count (see
+CursorPagination) don't compute them. Counts from elasticsearch are cached under the normalized
+search and the visibility class of the user, so equivalent requests share them, and they're
+invalidated by the generation of their index changing.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+
+from isic.core.search import get_elasticsearch_client, search_generation
+from isic.core.utils.cache import get_or_set_single_flight
+from isic.core.utils.db import estimated_count
+from isic.core.visibility import get_visibility_context
+from isic.ingest.models.lesion import get_lesion_count_for_user
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from django.contrib.auth.models import AnonymousUser, User
+    from django.db.models.query import QuerySet
+
+    from isic.core.serializers import SearchQueryIn
+
+# generations change on every index sync, this only bounds how long unused counts are kept.
+COUNT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# estimates at or below this are replaced with exact counts since they're cheap to compute
+# and estimates of small results are the least accurate.
+ESTIMATED_COUNT_THRESHOLD = 10_000
+
+
+def _cached_count(index: str, key: str, compute: Callable[[], int]) -> int:
+    return get_or_set_single_flight(
+        f"count:{index}:{search_generation(index)}:{key}", compute, COUNT_CACHE_TIMEOUT
+    )
+
+
+def image_count(
+    search: SearchQueryIn, user: User | AnonymousUser, es_query: dict | None = None
+) -> int:
+    """
+    Count the images matching search which are visible to user.
+
+    es_query can be passed to avoid building the query again if the caller already has it.
+    """
+    index = settings.ISIC_ELASTICSEARCH_IMAGES_INDEX
+
+    def compute() -> int:
+        query = es_query if es_query is not None else search.to_es_query(user)
+        return get_elasticsearch_client().count(index=index, body={"query": query})["count"]
+
+    return _cached_count(index, search.to_cache_key(user), compute)
+
+
+def lesion_count(user: User | AnonymousUser) -> int:
+    """Count the lesions visible to user."""
+    return _cached_count(
+        settings.ISIC_ELASTICSEARCH_LESIONS_INDEX,
+        get_visibility_context(user).cache_key,
+        lambda: get_lesion_count_for_user(user),
+    )
+
+
+def queryset_count(qs: QuerySet, *, exact: bool = False) -> int:
+    """
+    Count qs, using the planner's estimate for large results unless exact is requested.
+
+    This is for lists which are only in postgres, where counting a large result scans all of it.
+    """
+    if not exact:
+        estimate = estimated_count(qs)
+
+        if estimate > ESTIMATED_COUNT_THRESHOLD:
+            return estimate
+
+    return qs.count()
@@ -1,21 +1,38 @@
+"""
+A parser for the subset of the Lucene query syntax supported by image search.
+
+Queries are parsed into a small AST (Term, And, Or) which is then converted into a Q object
+(to_q) or an Elasticsearch query (to_es). The grammar is:
+
+    query   := and_expr ("OR" and_expr)*
+    and_expr := operand ("AND" operand)*
+    operand := term+ | "(" query ")"
+    term    := ["-"] field ":" value
+
+where the type of value depends on the field, see _search_fields. Adjacent terms are implicitly
+AND'd together.
+"""
+
 from collections.abc import Callable
 from dataclasses import dataclass
-from functools import lru_cache
-from typing import Any
+from functools import cache, lru_cache, reduce
+import operator
+import re
+from typing import Any, Literal, cast
 
 from django.db.models.query_utils import Q
 from isic_metadata import FIELD_REGISTRY
-from pyparsing import Keyword, OpAssoc, Optional, ParserElement, Word, alphas, infix_notation, nums
-from pyparsing.common import pyparsing_common
-from pyparsing.core import Literal, OneOrMore, Or, QuotedString, Suppress
-from pyparsing.helpers import one_of
-from pyparsing.results import ParseResults
 import sentry_sdk
 
 from isic.ingest.models.accession import Accession
 
-# the cache size limit is the number of items, not the number of bytes
-ParserElement.enable_packrat(cache_size_limit=2_000)
+
+class ParseException(ValueError):  # noqa: N818
+    def __init__(self, query: str, loc: int, msg: str) -> None:
+        self.query = query
+        self.loc = loc
+        self.msg = msg
+        super().__init__(f"{msg} (at char {loc})")
 
 
 @dataclass(frozen=True)
@@ -24,6 +41,7 @@ class SearchTermKey:
     negated: bool = False
 
 
+@dataclass(frozen=True)
 class Value:
     value: Any
 
@@ -49,67 +67,70 @@ class Value:
 
 
 class BoolValue(Value):
-    def __init__(self, toks) -> None:
-        if toks[0] == "*":
-            self.value = "*"
-        else:
-            self.value = toks[0] == "true"
+    value: bool | Literal["*"]
+
+
+class NumberValue(Value):
+    value: int | float | Literal["*"]
+
+
+# Special casing for image type renaming, see
+# https://linear.app/isic/issue/ISIC-138#comment-93029f64
+# TODO: Remove this once better error messages are put in place.
+IMAGE_TYPE_ALIASES = {
+    "clinical": "clinical: close-up",
+    "overview": "clinical: overview",
+}
 
 
 class StrValue(Value):
-    def __init__(self, toks) -> None:
-        self.value = toks[0]
+    value: str
+
+    def _image_type_value(self) -> str:
+        return IMAGE_TYPE_ALIASES.get(self.value, self.value)
 
     def to_q(self, key: SearchTermKey) -> Q:
-        # Special casing for image type renaming, see
-        # https://linear.app/isic/issue/ISIC-138#comment-93029f64
-        # TODO: Remove this once better error messages are put in place.
-        if key.field_lookup == "accession__image_type" and self.value == "clinical":
-            self.value = "clinical: close-up"
-        elif key.field_lookup == "accession__image_type" and self.value == "overview":
-            self.value = "clinical: overview"
+        value = self.value
+        if key.field_lookup == "accession__image_type":
+            value = self._image_type_value()
 
         # so asterisk is any present value
-        if self.value == "*":
+        if value == "*":
             return Q(**{f"{key.field_lookup}__isnull": False}, _negated=key.negated)
 
-        if self.value.startswith("*"):
+        if value.startswith("*"):
             if key.negated:
-                return ~Q(**{f"{key.field_lookup}__startswith": self.value[1:]}) | Q(
+                return ~Q(**{f"{key.field_lookup}__startswith": value[1:]}) | Q(
                     **{f"{key.field_lookup}__isnull": True}
                 )
 
-            return Q(**{f"{key.field_lookup}__endswith": self.value[1:]}, _negated=key.negated)
+            return Q(**{f"{key.field_lookup}__endswith": value[1:]}, _negated=key.negated)
 
-        if self.value.endswith("*"):
+        if value.endswith("*"):
             if key.negated:
-                return ~Q(**{f"{key.field_lookup}__startswith": self.value[:-1]}) | Q(
+                return ~Q(**{f"{key.field_lookup}__startswith": value[:-1]}) | Q(
                     **{f"{key.field_lookup}__isnull": True}
                 )
 
-            return Q(**{f"{key.field_lookup}__startswith": self.value[:-1]}, _negated=key.negated)
+            return Q(**{f"{key.field_lookup}__startswith": value[:-1]}, _negated=key.negated)
 
-        return super().to_q(key)
+        return Value(value).to_q(key)
 
     def to_es(self, key: SearchTermKey) -> dict:
-        # Special casing for image type renaming, see
-        # https://linear.app/isic/issue/ISIC-138#comment-93029f64
-        # TODO: Remove this once better error messages are put in place.
-        if key.field_lookup == "image_type" and self.value == "clinical":
-            self.value = "clinical: close-up"
-        elif key.field_lookup == "image_type" and self.value == "overview":
-            self.value = "clinical: overview"
+        value = self.value
+        if key.field_lookup == "image_type":
+            value = self._image_type_value()
 
         term: dict
 
-        if self.value == "*":
+        if value == "*":
             term = {"exists": {"field": key.field_lookup}}
-        elif self.value.startswith("*"):
-            term = {"wildcard": {key.field_lookup: {"value": f"*{self.value[1:]}"}}}
-        elif self.value.endswith("*"):
-            term = {"wildcard": {key.field_lookup: {"value": f"{self.value[:-1]}*"}}}
+        elif value.startswith("*"):
+            term = {"wildcard": {key.field_lookup: {"value": f"*{value[1:]}"}}}
+        elif value.endswith("*"):
+            term = {"wildcard": {key.field_lookup: {"value": f"{value[:-1]}*"}}}
         else:
-            term = {"term": {key.field_lookup: self.value}}
+            term = {"term": {key.field_lookup: value}}
 
         if key.negated:
             return {"bool": {"must_not": term}}
@@ -117,19 +138,11 @@ class StrValue(Value):
         return term
 
 
-class NumberValue(Value):
-    def __init__(self, toks) -> None:
-        if toks[0] == "*":
-            self.value = "*"
-        else:
-            self.value = toks[0]
-
-
+@dataclass(frozen=True)
 class NumberRangeValue(Value):
-    def __init__(self, toks) -> None:
-        self.lower_lookup = "gte" if toks[0] == "[" else "gt"
-        self.upper_lookup = "lte" if toks[-1] == "]" else "lt"
-        self.value = (toks[1].value, toks[2].value)
+    value: tuple[int | float | Literal["*"], int | float | Literal["*"]]
+    lower_lookup: Literal["gt", "gte"] = "gte"
+    upper_lookup: Literal["lt", "lte"] = "lte"
 
     def to_q(self, key: SearchTermKey) -> Q:
         start_value, end_value = self.value
@@ -176,200 +189,517 @@ class NumberRangeValue(Value):
         return term
 
 
-def es_query(s, loc, toks):
-    key = toks[0]
-    value = toks[1]
-    return value.to_es(key)
+@dataclass(frozen=True)
+class SetValue(Value):
+    """Any of several values, only produced by normalize for terms which aren't negated."""
 
+    value: tuple[str | int | float | bool, ...]
 
-def es_query_and(s, loc, toks):
-    ret: dict[str, Any] = {"bool": {"filter": []}}
-    if isinstance(toks, ParseResults):
-        # Explicit ANDs come in as parse results
-        q_objects = toks.asList()
-    elif isinstance(toks[0], Q):
-        # Single search queries come in as a single Q object
-        q_objects = [toks[0]]
-    else:
-        raise TypeError("Something went wrong")
+    def to_q(self, key: SearchTermKey) -> Q:
+        return Q(**{f"{key.field_lookup}__in": list(self.value)})
 
-    # Results can be nested one level
-    if isinstance(q_objects, list) and isinstance(q_objects[0], list):
-        q_objects = q_objects[0]
+    def to_es(self, key: SearchTermKey) -> dict:
+        return {"terms": {key.field_lookup: list(self.value)}}
 
-    for q in q_objects:
-        ret["bool"]["filter"].append(q)
 
-    return ret
+@dataclass(frozen=True)
+class Term:
+    field: str
+    value: Value
+    negated: bool = False
 
 
-def es_query_or(s, loc, toks):
-    ret: dict[str, Any] = {"bool": {"should": []}}
-    for tok in toks[0]:
-        ret["bool"]["should"].append(tok)
-    toks[0] = ret
+@dataclass(frozen=True)
+class And:
+    children: tuple["Node", ...]
 
 
-def q(s, loc, toks):
-    key = toks[0]
-    value = toks[1]
-    return value.to_q(key)
+@dataclass(frozen=True)
+class Or:
+    children: tuple["Node", ...]
 
 
-def q_and(s, loc, toks):
-    ret = Q()
-    if isinstance(toks, ParseResults):
-        # Explicit ANDs come in as parse results
-        q_objects = toks.asList()
-    elif isinstance(toks[0], Q):
-        # Single search queries come in as a single Q object
-        q_objects = [toks[0]]
-    else:
-        raise TypeError("Something went wrong")
+type Node = Term | And | Or
 
-    # Results can be nested one level
-    if isinstance(q_objects, list) and isinstance(q_objects[0], list):
-        q_objects = q_objects[0]
+ValueType = Literal["str", "bool", "number"]
 
-    for q in q_objects:
-        ret &= q
 
-    return ret
+@cache
+def _search_fields() -> dict[str, ValueType]:
+    # First setup reserved (special) search terms
+    fields: dict[str, ValueType] = {
+        "isic_id": "str",
+        "public": "bool",
+        "age_approx": "number",
+        "copyright_license": "str",
+    }
 
+    for key, definition in FIELD_REGISTRY.items():
+        if definition.search:
+            es_property_type = definition.search.es_property["type"]
 
-def q_or(s, loc, toks):
-    ret = Q()
-    for tok in toks[0]:
-        ret |= tok
-    toks[0] = ret
+            if es_property_type == "keyword":
+                fields[key] = "str"
+            elif es_property_type == "boolean":
+                fields[key] = "bool"
+            elif es_property_type in ["integer", "float"]:
+                fields[key] = "number"
+            else:
+                raise Exception("Found unknown es property type")
 
+    return fields
 
-# Lucene DSL only supports uppercase AND/OR/TO
-AND = Suppress(Keyword("AND"))
-OR = Suppress(Keyword("OR"))
 
-# Note that the Lucene DSL treats a single asterisk as a replacement for whether
-# the field exists and has a non null value.
-# https://www.elastic.co/docs/reference/query-languages/query-dsl/query-dsl-query-string-query#query-string-wildcard
-EXISTS = Literal("*")
+# the same characters pyparsing used for whitespace and keyword boundaries
+WHITESPACE_RE = re.compile(r"[ \n\t\r]+")
+IDENT_RE = re.compile(r"[A-Za-z0-9_$]+")
 
 # asterisks for wildcard, _ for ISIC ID search, - for license types
-str_value = (Word(alphas + nums + "*" + "_" + "-") | QuotedString('"')).add_parse_action(StrValue)
-number_value = (pyparsing_common.number.copy() | EXISTS).add_parse_action(NumberValue)
-number_range_value = (
-    one_of("[ {") + number_value + Suppress(Literal("TO")) + number_value + one_of("] }")
-).add_parse_action(NumberRangeValue)
-bool_value = one_of("true false *").add_parse_action(BoolValue)
+WORD_RE = re.compile(r"[A-Za-z0-9*_-]+")
+QUOTED_STRING_RE = re.compile(r'"([^"\n\r]*)"')
+WHITESPACE_ESCAPE_RE = re.compile(r"\\([tnfr])")
+WHITESPACE_ESCAPES = {"t": "\t", "n": "\n", "f": "\f", "r": "\r"}
+REAL_RE = re.compile(r"[+-]?(?:\d+[eE][+-]?\d+|(?:\d+\.\d*|\.\d+)(?:[eE][+-]?\d+)?)")
+INTEGER_RE = re.compile(r"[+-]?\d+")
+BOOL_RE = re.compile(r"true|false|\*")
+RANGE_START_RE = re.compile(r"[\[{]")
+RANGE_END_RE = re.compile(r"[\]}]")
+
+
+class _Scanner:
+    """
+    Reads tokens from a query on demand.
+
+    Which tokens are valid depends on where the parser is, e.g. "-" negates a term but is
+    part of a value, so tokens are matched at the current position rather than up front.
+    Each method either consumes a token and the whitespace after it, or raises a
+    ParseException located at the token and leaves the position unchanged.
+    """
+
+    def __init__(self, query: str) -> None:
+        self.query = query
+        self.pos = 0
+        self.advance(0)
+
+    def advance(self, pos: int) -> None:
+        match = WHITESPACE_RE.match(self.query, pos)
+        self.pos = match.end() if match else pos
+
+    def error(self, msg: str) -> ParseException:
+        return ParseException(self.query, self.pos, msg)
+
+    def at_end(self) -> bool:
+        return self.pos == len(self.query)
+
+    def startswith(self, prefix: str | tuple[str, ...]) -> bool:
+        return self.query.startswith(prefix, self.pos)
+
+    def literal(self, literal: str) -> str:
+        if not self.accept(literal):
+            raise self.error(f"Expected '{literal}'")
+        return literal
+
+    def accept(self, literal: str) -> bool:
+        """Consume literal if it's next, without raising if it isn't."""
+        if not self.query.startswith(literal, self.pos):
+            return False
+        self.advance(self.pos + len(literal))
+        return True
+
+    def peek_identifier(self) -> str | None:
+        # keywords can't start in the middle of an identifier, e.g. the AND in "50AND"
+        if self.pos > 0 and IDENT_RE.match(self.query, self.pos - 1, self.pos):
+            return None
+        match = IDENT_RE.match(self.query, self.pos)
+        return match[0] if match else None
+
+    def identifier(self) -> str:
+        identifier = self.peek_identifier()
+        if identifier is None:
+            raise self.error("Expected a search term")
+        self.advance(self.pos + len(identifier))
+        return identifier
+
+    def keyword(self, keyword: str) -> str:
+        if self.peek_identifier() != keyword:
+            raise self.error(f"Expected '{keyword}'")
+        self.advance(self.pos + len(keyword))
+        return keyword
+
+    def match(self, pattern: re.Pattern, msg: str) -> re.Match:
+        match = pattern.match(self.query, self.pos)
+        if not match:
+            raise self.error(msg)
+        self.advance(match.end())
+        return match
+
+    def str_value(self) -> StrValue:
+        if self.startswith('"'):
+            quoted = self.match(QUOTED_STRING_RE, "Expected a value")
+            return StrValue(WHITESPACE_ESCAPE_RE.sub(lambda m: WHITESPACE_ESCAPES[m[1]], quoted[1]))
+        return StrValue(self.match(WORD_RE, "Expected a value")[0])
+
+    def bool_value(self) -> BoolValue:
+        value = self.match(BOOL_RE, "Expected true, false, or *")[0]
+        return BoolValue("*" if value == "*" else value == "true")
+
+    def number_value(self) -> NumberValue:
+        if match := REAL_RE.match(self.query, self.pos):
+            self.advance(match.end())
+            return NumberValue(float(match[0]))
+        if match := INTEGER_RE.match(self.query, self.pos):
+            self.advance(match.end())
+            return NumberValue(int(match[0]))
+        self.literal("*")
+        return NumberValue("*")
+
+    def number_range_value(self) -> NumberRangeValue:
+        # Lucene DSL only supports uppercase AND/OR/TO
+        lower = self.match(RANGE_START_RE, "Expected '[' or '{'")[0]
+        start = self.number_value()
+        self.literal("TO")
+        end = self.number_value()
+        upper = self.match(RANGE_END_RE, "Expected ']' or '}'")[0]
+        return NumberRangeValue(
+            (start.value, end.value),
+            lower_lookup="gte" if lower == "[" else "gt",
+            upper_lookup="lte" if upper == "]" else "lt",
+        )
+
+
+class _Parser:
+    def __init__(self, query: str) -> None:
+        self.scanner = _Scanner(query)
+
+    def optional(self, production: Callable[[], Any]) -> Any | None:
+        """Return the result of production, or None and rewind if it fails."""
+        pos = self.scanner.pos
+        try:
+            return production()
+        except ParseException:
+            self.scanner.pos = pos
+            return None
+
+    def parse(self) -> Node:
+        node = self.query()
+        if not self.scanner.at_end():
+            raise self.scanner.error("Expected end of text")
+        return node
+
+    def query(self) -> Node:
+        return self.binary_operation("OR", Or, self.and_expr)
+
+    def and_expr(self) -> Node:
+        return self.binary_operation("AND", And, self.operand)
+
+    def binary_operation(
+        self, keyword: str, node_type: type[And | Or], operand: Callable[[], Node]
+    ) -> Node:
+        operands = [operand()]
+
+        while self.scanner.peek_identifier() == keyword:
+            # a trailing keyword without a right hand side isn't consumed, which leaves it to
+            # be reported as unexpected by whatever follows.
+            pos = self.scanner.pos
+            try:
+                self.scanner.keyword(keyword)
+                operands.append(operand())
+            except ParseException:
+                self.scanner.pos = pos
+                break
+
+        if len(operands) == 1:
+            return operands[0]
+
+        return node_type(tuple(operands))
+
+    def operand(self) -> Node:
+        if self.scanner.startswith("("):
+            self.scanner.literal("(")
+            node = self.query()
+            self.scanner.literal(")")
+            return node
+
+        terms = [self.term()]
+        while self.at_term() and (term := self.optional(self.term)):
+            terms.append(term)
+
+        return And(tuple(terms))
+
+    def at_term(self) -> bool:
+        pos = self.scanner.pos
+        self.scanner.accept("-")
+        field = self.scanner.peek_identifier()
+        self.scanner.pos = pos
+        return field in _search_fields()
+
+    def term(self) -> Term:
+        negated = self.scanner.accept("-")
+
+        pos = self.scanner.pos
+        field = self.scanner.identifier()
+        value_type = _search_fields().get(field)
+        if value_type is None:
+            # report the error after the longest field name that the identifier starts with,
+            # e.g. at the "x" in "age_approxx:5".
+            field_end = max(
+                (len(name) for name in _search_fields() if field.startswith(name)), default=0
+            )
+            raise ParseException(self.scanner.query, pos + field_end, "Expected a search term")
+
+        self.scanner.literal(":")
+
+        value: Value
+        if value_type == "str":
+            value = self.scanner.str_value()
+        elif value_type == "bool":
+            value = self.scanner.bool_value()
+        elif self.scanner.startswith(("[", "{")):
+            value = self.scanner.number_range_value()
+        else:
+            value = self.scanner.number_value()
 
+        return Term(field, value, negated)
 
-def convert_term(s, loc, toks):
-    negate = False
 
-    if len(toks) == 2 and toks[0] == "-":
-        negate = True
-        toks = toks[1:]
+def parse(query: str) -> Node:
+    """Parse a query into its AST, raising a ParseException if it's invalid."""
+    # tabs are expanded like the pyparsing grammar this replaced did, which affects quoted
+    # values and error locations.
+    return _Parser(query.expandtabs()).parse()
 
-    if len(toks) > 1:
-        raise Exception("Something went wrong")
 
-    field_to_lookup_map: dict[str, str] = {
-        "public": toks[0],
-        # isic_id can't be used with wildcards since it's a foreign key, so join the table and
-        # refer to the __id.
-        "isic_id": "isic__id",
-        "age_approx": "accession__age__approx",
-        "copyright_license": "accession__copyright_license",
-    }
+def _is_exact(term: Term) -> bool:
+    if term.negated or isinstance(term.value, NumberRangeValue):
+        return False
+    if isinstance(term.value, SetValue):
+        return True
+    if isinstance(term.value, StrValue):
+        return not term.value.value.startswith("*") and not term.value.value.endswith("*")
+    return term.value.value != "*"
 
-    for field in Accession.remapped_internal_fields:
-        field_to_lookup_map[field.csv_field_name] = f"accession__{field.relation_name}__id"
 
-    if toks[0] in field_to_lookup_map:
-        return SearchTermKey(field_to_lookup_map[toks[0]], negate)
+def _merge_exact_terms(children: list[Node]) -> list[Node]:
+    # field:a OR field:b is a single set membership filter
+    merged: list[Node] = []
+    indices: dict[str, int] = {}
 
-    return SearchTermKey(f"accession__{toks[0]}", negate)
+    for child in children:
+        if isinstance(child, Term) and _is_exact(child):
+            if child.field in indices:
+                i = indices[child.field]
+                values = sorted(
+                    set(_exact_values(cast("Term", merged[i]))) | set(_exact_values(child))
+                )
+                if len(values) > 1:
+                    merged[i] = Term(child.field, SetValue(tuple(values)))
+                continue
 
+            indices[child.field] = len(merged)
 
-def es_convert_term(s, loc, toks):
-    negate = False
+        merged.append(child)
 
-    if len(toks) == 2 and toks[0] == "-":
-        negate = True
-        toks = toks[1:]
+    return merged
 
-    if len(toks) > 1:
-        raise Exception("Something went wrong")
 
-    return SearchTermKey(toks[0], negate)
+def _exact_values(term: Term) -> tuple:
+    return term.value.value if isinstance(term.value, SetValue) else (term.value.value,)
 
 
-def make_parser(  # noqa: C901
-    element=q, conjunctive=q_and, disjunctive=q_or, term_converter: Callable = convert_term
-) -> ParserElement:
-    def make_term_keyword(name):
-        term = Optional("-") + Keyword(name)
-        if term_converter is not None:
-            term.add_parse_action(term_converter)
-        return term
+def _merge_range_terms(children: list[Node]) -> list[Node]:
+    # field:[a TO *] AND field:[* TO b] is field:[a TO b]
+    merged: list[Node] = []
+    indices: dict[str, int] = {}
 
-    def make_term(name, values):
-        term = make_term_keyword(name)
-        term = term + Suppress(Literal(":")) + values
-        term.add_parse_action(element)
-        return term
+    for child in children:
+        if (
+            isinstance(child, Term)
+            and not child.negated
+            and isinstance(child.value, NumberRangeValue)
+        ):
+            if child.field in indices:
+                i = indices[child.field]
+                merged_range = cast("NumberRangeValue", cast("Term", merged[i]).value)
+                merged[i] = Term(child.field, _intersect_ranges(merged_range, child.value))
+                continue
 
-    def make_number_term(keyword_name):
-        return make_term(keyword_name, number_range_value | number_value)
+            indices[child.field] = len(merged)
 
-    def make_str_term(keyword_name):
-        return make_term(keyword_name, str_value)
+        merged.append(child)
 
-    def make_bool_term(keyword_name):
-        return make_term(keyword_name, bool_value)
+    return merged
 
-    # First setup reserved (special) search terms
-    terms = {
-        "isic_id": make_str_term("isic_id"),
-        "public": make_bool_term("public"),
-        "age_approx": make_number_term("age_approx"),
-        # TODO: use one_of to get this validating maybe? it's hard to get this to work
-        # with QuotedString
-        "copyright_license": make_str_term("copyright_license"),
+
+def _intersect_ranges(a: NumberRangeValue, b: NumberRangeValue) -> NumberRangeValue:
+    (a_start, a_end), (b_start, b_end) = a.value, b.value
+
+    # the greater lower bound wins, or the exclusive one if they're the same
+    if b_start != "*" and (
+        a_start == "*" or (b_start, b.lower_lookup == "gt") > (a_start, a.lower_lookup == "gt")
+    ):
+        start, lower_lookup = b_start, b.lower_lookup
+    else:
+        start, lower_lookup = a_start, a.lower_lookup
+
+    # the lesser upper bound wins, or the exclusive one if they're the same
+    if b_end != "*" and (
+        a_end == "*" or (b_end, b.upper_lookup == "lte") < (a_end, a.upper_lookup == "lte")
+    ):
+        end, upper_lookup = b_end, b.upper_lookup
+    else:
+        end, upper_lookup = a_end, a.upper_lookup
+
+    return NumberRangeValue((start, end), lower_lookup=lower_lookup, upper_lookup=upper_lookup)
+
+
+def _normalize_term(term: Term) -> Term:
+    if term.field == "image_type" and isinstance(term.value, StrValue):
+        value = IMAGE_TYPE_ALIASES.get(term.value.value, term.value.value)
+        return Term(term.field, StrValue(value), term.negated)
+
+    if isinstance(term.value, NumberRangeValue):
+        # an unbounded end of a range is the same whether it's inclusive or not
+        start, end = term.value.value
+        return Term(
+            term.field,
+            NumberRangeValue(
+                term.value.value,
+                lower_lookup="gte" if start == "*" else term.value.lower_lookup,
+                upper_lookup="lte" if end == "*" else term.value.upper_lookup,
+            ),
+            term.negated,
+        )
+
+    return term
+
+
+def normalize(node: Node) -> Node:
+    """
+    Rewrite a query into a canonical form which is the same for equivalent queries.
+
+    Nested ANDs and ORs are flattened, image type aliases are resolved, multiple exact values
+    of a field in an OR become a set, multiple ranges of a field in an AND are intersected,
+    and duplicate operands are removed. The operands are then sorted so the order they were
+    written in doesn't matter.
+    """
+    if isinstance(node, Term):
+        return _normalize_term(node)
+
+    children: list[Node] = []
+    for child in map(normalize, node.children):
+        if type(child) is type(node):
+            children.extend(cast("And | Or", child).children)
+        else:
+            children.append(child)
+
+    children = (
+        _merge_exact_terms(children) if isinstance(node, Or) else _merge_range_terms(children)
+    )
+
+    # dedupe by the string representation rather than equality, since 50 == 50.0
+    unique_children = {to_query_string(child): child for child in children}
+    if len(unique_children) == 1:
+        return next(iter(unique_children.values()))
+
+    return type(node)(tuple(unique_children[key] for key in sorted(unique_children)))
+
+
+def _value_string(value: str | float | bool) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, str) and value != "*" and not WORD_RE.fullmatch(value):
+        return f'"{value}"'
+    return str(value)
+
+
+def to_query_string(node: Node) -> str:
+    """Format a query as a string, which parses to the same results."""
+    if isinstance(node, And | Or):
+        operands = [
+            f"({to_query_string(child)})" if isinstance(child, Or) else to_query_string(child)
+            for child in node.children
+        ]
+        return (" AND " if isinstance(node, And) else " OR ").join(operands)
+
+    prefix = f"{'-' if node.negated else ''}{node.field}:"
+
+    if isinstance(node.value, SetValue):
+        return "(" + " OR ".join(prefix + _value_string(value) for value in node.value.value) + ")"
+
+    if isinstance(node.value, NumberRangeValue):
+        start, end = node.value.value
+        lower = "[" if node.value.lower_lookup == "gte" else "{"
+        upper = "]" if node.value.upper_lookup == "lte" else "}"
+        return f"{prefix}{lower}{_value_string(start)} TO {_value_string(end)}{upper}"
+
+    return prefix + _value_string(node.value.value)
+
+
+@lru_cache(maxsize=1_000)
+def canonicalize(query: str) -> Node:
+    """Parse a query into its normalized AST, see normalize."""
+    with sentry_sdk.start_span(op="dsl-parsing"):
+        return normalize(parse(query))
+
+
+def canonical_query(query: str) -> str:
+    """
+    Return the canonical string for a query, e.g. for use in cache keys.
+
+    Equivalent queries, such as the same terms in a different order or with redundant
+    parentheses, have the same canonical string.
+    """
+    return to_query_string(canonicalize(query))
+
+
+def django_field_lookup(field: str) -> str:
+    field_to_lookup_map: dict[str, str] = {
+        "public": "public",
+        # isic_id can't be used with wildcards since it's a foreign key, so join the table and
+        # refer to the __id.
+        "isic_id": "isic__id",
+        "age_approx": "accession__age__approx",
+        "copyright_license": "accession__copyright_license",
     }
 
-    for key, definition in FIELD_REGISTRY.items():
-        if definition.search:
-            es_property_type = definition.search.es_property["type"]
+    for remapped_field in Accession.remapped_internal_fields:
+        field_to_lookup_map[remapped_field.csv_field_name] = (
+            f"accession__{remapped_field.relation_name}__id"
+        )
 
-            if es_property_type == "keyword":
-                term = make_str_term(key)
-            elif es_property_type == "boolean":
-                term = make_bool_term(key)
-            elif es_property_type in ["integer", "float"]:
-                term = make_number_term(key)
-            else:
-                raise Exception("Found unknown es property type")
+    return field_to_lookup_map.get(field, f"accession__{field}")
 
-            terms[key] = term
 
-    parser = OneOrMore(Or(terms.values())).add_parse_action(conjunctive)
+def to_q(node: Node) -> Q:
+    if isinstance(node, Term):
+        return node.value.to_q(SearchTermKey(django_field_lookup(node.field), node.negated))
 
-    # TODO: ZeroOrMore?
-    return infix_notation(
-        parser, [(AND, 2, OpAssoc.LEFT, conjunctive), (OR, 2, OpAssoc.LEFT, disjunctive)]
-    )
+    children = [to_q(child) for child in node.children]
+
+    if isinstance(node, And):
+        return reduce(operator.and_, children, Q())
+
+    return reduce(operator.or_, children, Q())
+
+
+def to_es(node: Node) -> dict:
+    if isinstance(node, Term):
+        return node.value.to_es(SearchTermKey(node.field, node.negated))
+
+    children = [to_es(child) for child in node.children]
+
+    if isinstance(node, And):
+        return {"bool": {"filter": children}}
+
+    return {"bool": {"should": children}}
 
 
-django_parser = make_parser()
-es_parser = make_parser(es_query, es_query_and, es_query_or, es_convert_term)
+# parse_query takes the backend to convert the parsed query with
+django_parser = to_q
+es_parser = to_es
 
 
-# Takes ~150ms to parse a fairly complex query e.g.
-# "diagnosis:foobar OR (diagnosis:foobaz AND (diagnosis:foo* OR age_approx:50))"
 @lru_cache(maxsize=1_000)  # limit the cache size to 1000 to avoid unbounded growth
-def parse_query(parser, query) -> Q | dict | None:
+def parse_query(parser: Callable[[Node], Q | dict], query: str) -> Q | dict | None:
     with sentry_sdk.start_span(op="dsl-parsing"):
-        parse_results = parser.parse_string(query, parse_all=True)
-        if parse_results:
-            return parse_results[0]
-        return None
+        return parser(parse(query))
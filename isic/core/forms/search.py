@@ -1,7 +1,7 @@
 from django import forms
 import pydantic_core
-from pyparsing.exceptions import ParseException
 
+from isic.core.dsl import ParseException
 from isic.core.models.image import Image
 from isic.core.serializers import SearchQueryIn
 
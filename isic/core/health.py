@@ -258,6 +258,27 @@ def check_engagement_profile_defaults_consistent() -> HealthCheckResult:
     )
 
 
+def check_public_metadata_consistency() -> HealthCheckResult:
+    images = Image.objects.select_related(
+        "accession__lesion", "accession__patient", "accession__rcm_case"
+    ).order_by("?")[:1_000]
+
+    inconsistent = [image.isic_id for image in images if image.public_metadata != image.metadata]
+
+    passed = not inconsistent
+    message = (
+        "Public metadata is consistent"
+        if passed
+        else f"{len(inconsistent)} images have stale public metadata: {', '.join(inconsistent)}"
+    )
+
+    return HealthCheckResult(
+        name="public_metadata_consistency",
+        passed=passed,
+        message=message,
+    )
+
+
 HEALTH_CHECKS = [
     ("public_images_have_sponsored_blob", check_public_images_have_sponsored_blob),
     ("non_public_images_have_non_sponsored_blob", check_non_public_images_have_non_sponsored_blob),
@@ -272,6 +293,7 @@ HEALTH_CHECKS = [
     ("published_images_have_attribution", check_published_images_have_attribution),
     ("embeddings_only_for_public_images", check_embeddings_only_for_public_images),
     ("engagement_profile_defaults_consistent", check_engagement_profile_defaults_consistent),
+    ("public_metadata_consistency", check_public_metadata_consistency),
 ]
 
 
@@ -0,0 +1,232 @@
+"""
+Checkpointed jobs for long running tasks.
+
+A task which is killed, times out, or fails is retried from the start by celery. Tasks which
+record a checkpoint on their Job as they go can resume from it instead, see run_job. The
+tasks should be declared with acks_late and reject_on_worker_lost so that a task whose
+worker dies is redelivered rather than lost, and keyed with job_key.
+
+A job which raises isn't redelivered, so its multipart upload is aborted. Jobs which never
+finish, e.g. because their worker died and the message was lost, are cleaned up by prune_jobs.
+
+Only one attempt of a job runs at a time. RabbitMQ redelivers a message which has been
+unacknowledged for longer than its consumer_timeout, which defaults to 30 minutes, while the
+first attempt is still running. The consumer_timeout of the broker has to be raised above the
+time limit of the longest task, e.g. 12 hours for the archive snapshot, otherwise every run of
+it is attempted a second time. An attempt which finds another running raises JobRunningError,
+which the tasks retry after JOB_RUNNING_RETRY_DELAY.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import timedelta
+import logging
+from typing import TYPE_CHECKING
+import uuid
+
+from django.core.files.storage import storages
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from isic.core.models.job import Job
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from celery import Task
+    from django.core.files.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# the smallest part of a multipart upload other than the last, which is a limit of s3.
+MULTIPART_UPLOAD_MIN_PART_SIZE = 5 * 1024 * 1024
+
+# a job which keeps killing its worker, e.g. by running out of memory, is given up on.
+MAX_JOB_ATTEMPTS = 5
+
+JOB_RETENTION = timedelta(days=7)
+
+# an attempt which finds another attempt of its job running tries again after this.
+JOB_RUNNING_RETRY_DELAY = timedelta(minutes=10)
+
+# the first key of the advisory locks of jobs, the second is the id of the job.
+JOB_LOCK_NAMESPACE = 0x4A4F42
+
+
+class JobAttemptsExceededError(Exception):
+    pass
+
+
+class JobRunningError(Exception):
+    pass
+
+
+def job_key(task: Task) -> str:
+    """
+    Return the key of the job of a task, which is the same when the task is redelivered.
+
+    A task which is called directly rather than through celery has no id, and is never
+    redelivered, so it gets a key of its own.
+    """
+    return f"{task.name}:{task.request.id or uuid.uuid4()}"
+
+
+@contextmanager
+def run_job(key: str, *, total: int | None = None) -> Iterator[Job]:
+    """
+    Run an attempt of the job with key, creating it if this is the first attempt.
+
+    The job's checkpoint is empty on the first attempt, and is whatever was last saved on
+    later attempts. A job which already succeeded, e.g. because the task message was
+    redelivered after the task finished, is yielded with a SUCCEEDED status and the caller
+    should do nothing.
+
+    Raises JobRunningError if another attempt of the job is running.
+    """
+    job, _ = Job.objects.get_or_create(key=key)
+
+    # the lock belongs to the database session, so it's released if the worker dies
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [JOB_LOCK_NAMESPACE, job.pk])
+        (locked,) = cursor.fetchone()
+
+    if not locked:
+        raise JobRunningError(f"{job.key} is being attempted by another worker.")
+
+    try:
+        job.refresh_from_db()
+
+        if job.status == Job.Status.SUCCEEDED:
+            yield job
+            return
+
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.Status.RUNNING, attempts=F("attempts") + 1, total=total
+        )
+        job.refresh_from_db()
+
+        if job.attempts > MAX_JOB_ATTEMPTS:
+            _fail_job(job)
+            raise JobAttemptsExceededError(f"{job.key} was attempted {job.attempts} times.")
+
+        try:
+            yield job
+        except BaseException:
+            _fail_job(job)
+            raise
+
+        job.status = Job.Status.SUCCEEDED
+        job.checkpoint = {}
+        job.save(update_fields=["status", "checkpoint", "modified"])
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [JOB_LOCK_NAMESPACE, job.pk])
+
+
+def _fail_job(job: Job) -> None:
+    job.status = Job.Status.FAILED
+    job.save(update_fields=["status", "modified"])
+    _abort_upload(job)
+
+
+def _abort_upload(job: Job) -> None:
+    """
+    Abort the multipart upload in the checkpoint of job, if it hasn't completed.
+
+    The parts of an upload which is never completed or aborted are kept, and billed, by s3
+    indefinitely. The checkpoint is cleared since it can't be resumed from without the upload.
+    """
+    checkpoint = job.checkpoint.get("upload")
+
+    if checkpoint is None or checkpoint.get("completed"):
+        return
+
+    try:
+        MultipartUpload.from_checkpoint(checkpoint).abort()
+    except Exception:
+        # e.g. the bucket's lifecycle rules already aborted it
+        logger.exception("Failed to abort the upload of %s.", job.key)
+
+    job.processed = 0
+    job.checkpoint = {}
+    job.save(update_fields=["processed", "checkpoint", "modified"])
+
+
+def prune_jobs(*, older_than: timedelta = JOB_RETENTION) -> int:
+    """
+    Delete jobs which haven't changed in older_than, aborting their unfinished uploads.
+
+    Returns the number of jobs deleted.
+    """
+    # aborting an upload saves the job, which makes it look recent
+    stale = list(Job.objects.filter(modified__lt=timezone.now() - older_than))
+
+    for job in stale:
+        if job.status != Job.Status.SUCCEEDED:
+            _abort_upload(job)
+
+    deleted, _ = Job.objects.filter(pk__in=[job.pk for job in stale]).delete()
+    return deleted
+
+
+@dataclass
+class MultipartUpload:
+    """
+    A multipart upload which can be saved in a checkpoint and continued by another process.
+
+    The storage is referred to by its alias in STORAGES, and must implement
+    create_multipart_upload, upload_part, complete_multipart_upload, and
+    abort_multipart_upload, which the s3 and minio storages do. An upload which is saved in
+    the checkpoint of a job is aborted if the job fails, see run_job.
+    """
+
+    storage_alias: str
+    name: str
+    upload_id: str
+    parts: list[tuple[int, str]] = field(default_factory=list)
+    completed: bool = False
+
+    @classmethod
+    def create(cls, storage_alias: str, name: str) -> MultipartUpload:
+        return cls(storage_alias, name, storages[storage_alias].create_multipart_upload(name))
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint: dict) -> MultipartUpload:
+        return cls(
+            checkpoint["storage"],
+            checkpoint["name"],
+            checkpoint["upload_id"],
+            [(number, etag) for number, etag in checkpoint["parts"]],
+            checkpoint["completed"],
+        )
+
+    def to_checkpoint(self) -> dict:
+        return {
+            "storage": self.storage_alias,
+            "name": self.name,
+            "upload_id": self.upload_id,
+            "parts": self.parts,
+            "completed": self.completed,
+        }
+
+    @property
+    def storage(self) -> Storage:
+        return storages[self.storage_alias]
+
+    def upload_part(self, data: bytes) -> None:
+        # a part which was uploaded after the last checkpoint is uploaded again under the same
+        # number when resuming, which replaces it.
+        number = len(self.parts) + 1
+        self.parts.append(
+            (number, self.storage.upload_part(self.name, self.upload_id, number, data))
+        )
+
+    def complete(self) -> None:
+        self.storage.complete_multipart_upload(self.name, self.upload_id, self.parts)
+        self.completed = True
+
+    def abort(self) -> None:
+        self.storage.abort_multipart_upload(self.name, self.upload_id)
@@ -0,0 +1,22 @@
+from itertools import batched
+import sys
+
+import djclick as click
+
+from isic.core.models import Image
+
+
+@click.command(help="Recompute the public metadata of every image")
+@click.option("--batch-size", default=2_000, show_default=True)
+def backfill_public_metadata(batch_size):
+    qs = Image.objects.select_related("accession").order_by("pk")
+
+    with click.progressbar(length=qs.count(), file=sys.stderr) as bar:
+        for image_batch in batched(qs.iterator(chunk_size=batch_size), batch_size, strict=False):
+            for image in image_batch:
+                image.public_metadata = image.metadata
+
+            Image.objects.bulk_update(image_batch, ["public_metadata"])
+            bar.update(len(image_batch))
+
+    click.secho("Done", fg="green", err=True)
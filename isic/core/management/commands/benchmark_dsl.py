@@ -0,0 +1,83 @@
+import contextlib
+import statistics
+import time
+
+import djclick as click
+
+from isic.core.dsl import ParseException, django_parser, es_parser, parse_query
+
+# the queries exercised by test_dsl.py and test_search.py
+CORPUS = [
+    "isic_id:ISIC_123*",
+    "isic_id:*123",
+    "-isic_id:*",
+    "-lesion_id:*",
+    "lesion_id:IL_123*",
+    "lesion_id:*123",
+    "patient_id:IP_123*",
+    "patient_id:*123",
+    "rcm_case_id:123*",
+    "rcm_case_id:*123",
+    "-mel_thick_mm:*",
+    "melanocytic:*",
+    "-melanocytic:*",
+    "public:true",
+    "image_type:dermoscopic",
+    "image_type:clinical",
+    "image_type:overview",
+    "public:true image_type:dermoscopic",
+    "age_approx:50",
+    "-age_approx:50",
+    "age_approx:10",
+    "age_approx:[50 TO 70]",
+    "-age_approx:[50 TO 70]",
+    "age_approx:{50 TO 70}",
+    "age_approx:[50 TO 70}",
+    "age_approx:[50 TO *]",
+    "age_approx:[* TO 70]",
+    "age_approx:{* TO 70}",
+    "age_approx:{5 TO *}",
+    "age_approx:[5 TO *]",
+    "-age_approx:[5 TO *]",
+    "age_approx:[* TO *]",
+    "-age_approx:[* TO *]",
+    "mel_thick_mm:[0 TO 0.5]",
+    "mel_thick_mm:[5.0 TO *]",
+    "mel_thick_mm:{5.0 TO *}",
+    "mel_thick_mm:[* TO 10.5]",
+    "-mel_thick_mm:[* TO 10.0]",
+    "mel_thick_mm:{* TO *}",
+    "diagnosis_3:Nevus",
+    "anatom_site_3:Scalp",
+    'anatom_site_1:"Upper extremity"',
+    "-anatom_site_special:toenail",
+    "diagnosis_1:foobar OR (diagnosis_1:foobaz AND (diagnosis_1:foo* OR age_approx:50))",
+    # invalid queries
+    "diagnosis_1:foo randstring",
+    "age_approx:[[[[]]]]",
+]
+
+
+def _parse(parser, query: str) -> None:
+    with contextlib.suppress(ParseException):
+        # bypass the cache, otherwise only the first iteration is measured
+        parse_query.__wrapped__(parser, query)
+
+
+@click.command(help="Benchmark parsing the search query DSL")
+@click.option("--iterations", default=1_000, show_default=True)
+def benchmark_dsl(iterations):
+    for name, parser in [("django", django_parser), ("elasticsearch", es_parser)]:
+        timings: list[float] = []
+
+        for _ in range(iterations):
+            for query in CORPUS:
+                start = time.perf_counter()
+                _parse(parser, query)
+                timings.append(time.perf_counter() - start)
+
+        quantiles = statistics.quantiles(timings, n=100)
+        click.echo(
+            f"{name}: {len(timings)} parses, p50={quantiles[49] * 1_000_000:.1f}us "
+            f"p95={quantiles[94] * 1_000_000:.1f}us max={max(timings) * 1_000_000:.1f}us"
+        )
@@ -0,0 +1,109 @@
+from copy import deepcopy
+import random
+import statistics
+import time
+
+from django.core.cache import cache
+from django.test import override_settings
+import djclick as click
+from elasticsearch.helpers import bulk
+from isic_metadata.fields import ImageTypeEnum
+
+from isic.core.search import (
+    COUNTS_AGGREGATES,
+    DEFAULT_SEARCH_AGGREGATES,
+    IMAGE_INDEX_MAPPINGS,
+    facets,
+    get_elasticsearch_client,
+)
+
+BENCHMARK_INDEX = "benchmark-facets"
+
+
+def _synthetic_document(rng: random.Random, pk: int) -> dict:
+    document = {"id": pk}
+
+    for field, mapping in IMAGE_INDEX_MAPPINGS["properties"].items():
+        # leave a portion of every field missing so the missing counts are meaningful
+        if field == "id" or rng.random() < 0.3:
+            continue
+
+        if field == "image_type":
+            document[field] = rng.choice(list(ImageTypeEnum)).value
+        elif mapping["type"] == "keyword":
+            document[field] = f"value-{rng.randrange(20)}"
+        elif mapping["type"] == "boolean":
+            document[field] = rng.random() < 0.5
+        elif mapping["type"] == "integer":
+            document[field] = rng.randrange(100)
+        elif mapping["type"] == "float":
+            document[field] = rng.uniform(0, 100)
+        elif mapping["type"] == "date":
+            document[field] = f"20{rng.randrange(10, 26)}-01-01"
+
+    return document
+
+
+def _two_phase_facets(index: str) -> dict:
+    # the previous implementation of facets, which requested the counts separately
+    es = get_elasticsearch_client()
+    counts = es.search(index=index, size=0, aggs=COUNTS_AGGREGATES)["aggregations"]
+
+    aggs = deepcopy(DEFAULT_SEARCH_AGGREGATES)
+    for field, agg in aggs.items():
+        agg["meta"] = {
+            "missing_count": counts[f"{field}_missing"]["doc_count"],
+            "present_count": counts[f"{field}_present"]["value"],
+        }
+        if "terms" in agg:
+            agg["terms"]["min_doc_count"] = 0
+
+    return es.search(index=index, size=0, aggs=aggs)["aggregations"]
+
+
+def _percentiles(timings: list[float]) -> str:
+    quantiles = statistics.quantiles(timings, n=100)
+    return f"p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms"
+
+
+@click.command(help="Benchmark facet computation against a synthetic index")
+@click.option("--documents", default=100_000, show_default=True)
+@click.option("--iterations", default=50, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+def benchmark_facets(documents, iterations, seed):
+    # the elasticsearch cache has to be cleared between iterations, otherwise the timings
+    # only measure cache hits.
+    if not hasattr(cache, "delete_pattern"):
+        raise click.ClickException("A cache backend supporting delete_pattern is required.")
+
+    es = get_elasticsearch_client()
+    rng = random.Random(seed)  # noqa: S311
+
+    es.indices.delete(index=BENCHMARK_INDEX, ignore_unavailable=True)
+    es.indices.create(index=BENCHMARK_INDEX, mappings=IMAGE_INDEX_MAPPINGS)
+
+    try:
+        bulk(
+            client=es,
+            index=BENCHMARK_INDEX,
+            actions=(_synthetic_document(rng, pk) for pk in range(documents)),
+        )
+        es.indices.refresh(index=BENCHMARK_INDEX)
+
+        timings: dict[str, list[float]] = {"two-phase": [], "single-query": []}
+
+        with override_settings(ISIC_ELASTICSEARCH_IMAGES_INDEX=BENCHMARK_INDEX):
+            for _ in range(iterations):
+                for name, func in [
+                    ("two-phase", lambda: _two_phase_facets(BENCHMARK_INDEX)),
+                    ("single-query", facets),
+                ]:
+                    cache.delete_pattern(f"es:{BENCHMARK_INDEX}:*")
+                    start = time.perf_counter()
+                    func()
+                    timings[name].append(time.perf_counter() - start)
+
+        for name, values in timings.items():
+            click.echo(f"{name}: {_percentiles(values)}")
+    finally:
+        es.indices.delete(index=BENCHMARK_INDEX)
@@ -0,0 +1,58 @@
+import statistics
+import time
+
+import djclick as click
+
+from isic.core.models import Collection, Image
+from isic.core.services import image_metadata_csv, image_metadata_csv_copy
+from isic.core.utils.csv import EscapingDictWriter
+from isic.core.utils.http import Echo
+
+
+def _percentiles(timings: list[float]) -> str:
+    quantiles = statistics.quantiles(timings, n=100)
+    return f"p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms"
+
+
+def _python_csv(qs) -> int:
+    fieldnames, rows = image_metadata_csv(qs=qs)
+    writer = EscapingDictWriter(Echo(), fieldnames)
+    size = len(writer.writeheader())
+
+    for row in rows:
+        size += len(writer.writerow(row))
+
+    return size
+
+
+def _copy_csv(qs) -> int:
+    return sum(len(chunk) for chunk in image_metadata_csv_copy(qs=qs))
+
+
+@click.command(help="Benchmark generating the metadata CSV of images")
+@click.option("--collection", "collection_id", type=int, help="Defaults to all public images.")
+@click.option("--iterations", default=5, show_default=True)
+def benchmark_metadata_csv(collection_id, iterations):
+    if collection_id is not None:
+        qs = Collection.objects.get(pk=collection_id).images.all()
+    else:
+        qs = Image.objects.public()
+
+    count = qs.count()
+    if count == 0:
+        raise click.ClickException("There are no images.")
+
+    strategies = {"python": _python_csv, "copy": _copy_csv}
+    timings: dict[str, list[float]] = {name: [] for name in strategies}
+
+    for name, strategy in strategies.items():
+        for _ in range(iterations):
+            start = time.perf_counter()
+            size = strategy(qs)
+            timings[name].append(time.perf_counter() - start)
+
+        rows_per_second = count / statistics.median(timings[name])
+        click.echo(
+            f"{name}: {_percentiles(timings[name])} "
+            f"{rows_per_second:,.0f} rows/s {size / 1024**2:.1f}MB"
+        )
@@ -0,0 +1,209 @@
+import statistics
+import time
+
+from django.db import connection, transaction
+import djclick as click
+
+from isic.core.models.image_embedding import DEFAULT_EF_SEARCH, DEFAULT_PROBES
+
+# embeddings are clustered around random centroids, which resembles real embeddings far more
+# than uniformly random vectors do. uniformly random vectors are nearly equidistant from each
+# other, which makes every approximate search look bad.
+CREATE_TABLES_SQL = """
+CREATE TEMPORARY TABLE benchmark_centroid ON COMMIT DROP AS
+SELECT centroid.id, array_agg(random() * 2 - 1) AS components
+FROM generate_series(0, %(clusters)s - 1) AS centroid(id)
+CROSS JOIN generate_series(1, %(dimensions)s)
+GROUP BY centroid.id;
+
+CREATE TEMPORARY TABLE benchmark_embedding (
+    id integer PRIMARY KEY,
+    embedding halfvec({dimensions}) NOT NULL
+) ON COMMIT DROP;
+
+INSERT INTO benchmark_embedding (id, embedding)
+SELECT
+    embedding.id,
+    (
+        SELECT array_agg(component + (random() - 0.5) * %(noise)s ORDER BY position)
+        FROM unnest(centroid.components) WITH ORDINALITY AS vector(component, position)
+    )::halfvec
+FROM generate_series(1, %(count)s) AS embedding(id)
+INNER JOIN benchmark_centroid AS centroid ON centroid.id = embedding.id %% %(clusters)s;
+
+ANALYZE benchmark_embedding;
+"""
+
+NEAREST_SQL = """
+SELECT id
+FROM benchmark_embedding
+WHERE id <> %(id)s
+ORDER BY embedding <=> %(embedding)s::halfvec
+LIMIT %(limit)s
+"""
+
+# the same two stage search as ImageEmbeddingQuerySet.nearest with a shortlist
+SHORTLIST_NEAREST_SQL = """
+SELECT id
+FROM (
+    SELECT id, embedding
+    FROM benchmark_embedding
+    WHERE id <> %(id)s
+    ORDER BY binary_quantize(embedding)::bit({dimensions})
+        <~> binary_quantize(%(embedding)s::halfvec)::bit({dimensions})
+    LIMIT %(shortlist)s
+) AS shortlist
+ORDER BY embedding <=> %(embedding)s::halfvec
+LIMIT %(limit)s
+"""
+
+STORAGE_SQL = """
+SELECT
+    pg_size_pretty(sum(pg_column_size(embedding))),
+    pg_size_pretty(sum(pg_column_size(binary_quantize(embedding))))
+FROM benchmark_embedding
+"""
+
+
+def _percentiles(timings: list[float]) -> str:
+    quantiles = statistics.quantiles(timings, n=100)
+    return f"p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms"
+
+
+def _nearest(cursor, sql: str, params: dict) -> list[int]:
+    cursor.execute(sql, params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+@click.command(
+    help="Benchmark the recall and latency of approximate similarity search against exact search"
+)
+@click.option("--count", default=10_000, show_default=True)
+@click.option("--dimensions", default=3584, show_default=True)
+@click.option("--clusters", default=50, show_default=True)
+@click.option("--noise", default=0.5, show_default=True, help="The spread of each cluster.")
+@click.option("--queries", default=100, show_default=True)
+@click.option("--limit", default=10, show_default=True)
+@click.option(
+    "--index",
+    "indexes",
+    type=click.Choice(["hnsw", "ivfflat", "binary"]),
+    multiple=True,
+    default=["hnsw", "ivfflat", "binary"],
+    show_default=True,
+)
+@click.option("--ef-search", multiple=True, type=int, default=[DEFAULT_EF_SEARCH, 100, 200])
+@click.option("--probes", multiple=True, type=int, default=[1, DEFAULT_PROBES, 40])
+@click.option(
+    "--shortlist",
+    multiple=True,
+    type=int,
+    default=[20, 40, 100, 200],
+    help="The number of binary embeddings reranked by the binary strategy.",
+)
+@click.option("--lists", type=int, help="The lists of the ivfflat index, defaults to count/1000.")
+def benchmark_similarity(  # noqa: PLR0913
+    count, dimensions, clusters, noise, queries, limit, indexes, ef_search, probes, shortlist, lists
+):
+    lists = lists or max(count // 1_000, 1)
+
+    # everything is rolled back, the embeddings only exist for the duration of the benchmark
+    with transaction.atomic(), connection.cursor() as cursor:
+        start = time.perf_counter()
+        cursor.execute(
+            CREATE_TABLES_SQL.format(dimensions=int(dimensions)),
+            {"clusters": clusters, "dimensions": dimensions, "noise": noise, "count": count},
+        )
+        click.echo(f"generated {count} embeddings in {time.perf_counter() - start:.1f}s")
+
+        cursor.execute(STORAGE_SQL)
+        embedding_size, binary_size = cursor.fetchone()
+        click.echo(f"embeddings: {embedding_size}, binary embeddings: {binary_size}")
+
+        cursor.execute(
+            "SELECT id, embedding::text FROM benchmark_embedding ORDER BY random() LIMIT %s",
+            [queries],
+        )
+        query_embeddings = cursor.fetchall()
+
+        exact_timings = []
+        exact: dict[int, set[int]] = {}
+        for query_id, embedding in query_embeddings:
+            start = time.perf_counter()
+            exact[query_id] = set(
+                _nearest(
+                    cursor, NEAREST_SQL, {"id": query_id, "embedding": embedding, "limit": limit}
+                )
+            )
+            exact_timings.append(time.perf_counter() - start)
+        click.echo(f"exact: {_percentiles(exact_timings)}")
+
+        # the index definition, the query, and the setting and values which tune recall
+        strategies = {
+            "hnsw": (
+                "USING hnsw (embedding halfvec_cosine_ops) WITH (m = 16, ef_construction = 64)",
+                NEAREST_SQL,
+                "hnsw.ef_search",
+                ef_search,
+            ),
+            "ivfflat": (
+                f"USING ivfflat (embedding halfvec_cosine_ops) WITH (lists = {int(lists)})",
+                NEAREST_SQL,
+                "ivfflat.probes",
+                probes,
+            ),
+            "binary": (
+                f"USING hnsw ((binary_quantize(embedding)::bit({int(dimensions)})) "
+                "bit_hamming_ops) WITH (m = 16, ef_construction = 64)",
+                SHORTLIST_NEAREST_SQL.format(dimensions=int(dimensions)),
+                "hnsw.ef_search",
+                shortlist,
+            ),
+        }
+
+        for index in indexes:
+            definition, sql, setting, values = strategies[index]
+
+            start = time.perf_counter()
+            cursor.execute(
+                f"CREATE INDEX benchmark_embedding_{index} ON benchmark_embedding {definition}"
+            )
+            build_time = time.perf_counter() - start
+            cursor.execute("ANALYZE benchmark_embedding")
+            cursor.execute(
+                "SELECT pg_size_pretty(pg_relation_size(%s::regclass))",
+                [f"benchmark_embedding_{index}"],
+            )
+            click.echo(f"{index}: built in {build_time:.1f}s, {cursor.fetchone()[0]}")
+
+            # the index must be used even where the planner estimates a scan would be cheaper
+            cursor.execute("SELECT set_config('enable_seqscan', 'off', true)")
+
+            for value in values:
+                # the shortlist of the binary strategy is bounded by ef_search in the same way
+                cursor.execute("SELECT set_config(%s, %s, true)", [setting, str(value)])
+
+                timings = []
+                recalls = []
+                for query_id, embedding in query_embeddings:
+                    params = {
+                        "id": query_id,
+                        "embedding": embedding,
+                        "limit": limit,
+                        "shortlist": value,
+                    }
+                    start = time.perf_counter()
+                    neighbors = _nearest(cursor, sql, params)
+                    timings.append(time.perf_counter() - start)
+                    recalls.append(len(exact[query_id].intersection(neighbors)) / limit)
+
+                label = "shortlist" if index == "binary" else setting
+                click.echo(
+                    f"  {label}={value}: recall@{limit}={statistics.mean(recalls):.3f} "
+                    f"{_percentiles(timings)}"
+                )
+
+            cursor.execute("SELECT set_config('enable_seqscan', 'on', true)")
+            cursor.execute(f"DROP INDEX benchmark_embedding_{index}")
+
+        transaction.set_rollback(True)
@@ -0,0 +1,63 @@
+import statistics
+import time
+
+from django.core.cache import cache
+from django.core.files.storage import storages
+import djclick as click
+
+from isic.core.api.image import ImageOut
+from isic.core.models import Image
+from isic.core.services.image import sign_image_file_urls
+from isic.core.storages.s3 import CacheableCloudFrontStorage
+
+
+def _percentiles(timings: list[float]) -> str:
+    quantiles = statistics.quantiles(timings, n=100)
+    return f"p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms"
+
+
+@click.command(help="Benchmark signing the file urls of a page of private images")
+@click.option("--page-size", default=100, show_default=True)
+@click.option("--iterations", default=20, show_default=True)
+def benchmark_url_signing(page_size, iterations):
+    storage = storages["default"]
+    if not isinstance(storage, CacheableCloudFrontStorage) or not storage.cloudfront_signer:
+        raise click.ClickException("The default storage doesn't sign urls with CloudFront.")
+
+    images = list(Image.objects.private().select_related("accession__cohort")[:page_size])
+    if not images:
+        raise click.ClickException("There are no private images to sign urls for.")
+
+    def clear_caches():
+        storage._signed_urls.clear()  # noqa: SLF001
+        cache.delete_pattern("signed-url:*")
+
+    def serialize():
+        for image in images:
+            ImageOut.from_orm(image)
+
+    def serialize_in_bulk():
+        sign_image_file_urls(images)
+        serialize()
+
+    # signing every url is the previous behavior, which the cold runs approximate.
+    cases = {
+        "uncached": (serialize, True),
+        "bulk, cold": (serialize_in_bulk, True),
+        "bulk, warm": (serialize_in_bulk, False),
+    }
+
+    for name, (run, cold) in cases.items():
+        timings = []
+
+        for _ in range(iterations):
+            if cold:
+                clear_caches()
+
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+
+        click.echo(f"{name}: {_percentiles(timings)}")
+
+    clear_caches()
@@ -0,0 +1,96 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Max, Q
+import djclick as click
+
+from isic.core.models import Image
+from isic.core.models.image import ImagePermissions
+from isic.core.visibility import invalidate_visibility_contexts
+
+# shares are sampled uniformly from the existing images, most grantees end up with distinct sets.
+SEED_SHARES_SQL = """
+WITH sampled AS (
+    SELECT grantee.id AS grantee_id, (random() * %(max_image_id)s)::integer + 1 AS image_id
+    FROM unnest(%(grantee_ids)s::integer[]) AS grantee(id)
+    CROSS JOIN generate_series(1, %(shares_per_grantee)s)
+)
+INSERT INTO core_imageshare (created, modified, grantor_id, grantee_id, image_id)
+SELECT DISTINCT now(), now(), %(grantor_id)s, sampled.grantee_id, core_image.id
+FROM sampled
+INNER JOIN core_image ON core_image.id = sampled.image_id
+ON CONFLICT DO NOTHING
+"""
+
+SEED_VISIBILITY_SQL = """
+INSERT INTO core_imagevisibility (image_id, principal)
+SELECT DISTINCT image_id, 'user:' || grantee_id
+FROM core_imageshare
+WHERE grantee_id = ANY(%(grantee_ids)s)
+ON CONFLICT DO NOTHING
+"""
+
+
+def _percentiles(timings: list[float]) -> str:
+    quantiles = statistics.quantiles(timings, n=100)
+    return f"p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms"
+
+
+@click.command(help="Benchmark filtering visible images for a user with shares")
+@click.option("--grantees", default=1_000, show_default=True)
+@click.option("--shares-per-grantee", default=5_000, show_default=True)
+@click.option("--iterations", default=20, show_default=True)
+@click.option("--explain", is_flag=True, help="Print the plan of each query.")
+def benchmark_visibility(grantees, shares_per_grantee, iterations, explain):
+    max_image_id = Image.objects.aggregate(max_id=Max("pk"))["max_id"]
+    if max_image_id is None:
+        raise click.ClickException("There are no images to share.")
+
+    # everything is rolled back, the shares only exist for the duration of the benchmark
+    with transaction.atomic():
+        users = User.objects.bulk_create(
+            [User(username=f"benchmark-visibility-{i}") for i in range(grantees + 1)]
+        )
+        grantor, grantee_ids = users[0], [user.pk for user in users[1:]]
+
+        with connection.cursor() as cursor:
+            params = {
+                "grantor_id": grantor.pk,
+                "grantee_ids": grantee_ids,
+                "max_image_id": max_image_id,
+                "shares_per_grantee": shares_per_grantee,
+            }
+            cursor.execute(SEED_SHARES_SQL, params)
+            click.echo(f"seeded {cursor.rowcount} shares")
+            cursor.execute(SEED_VISIBILITY_SQL, params)
+            cursor.execute("ANALYZE core_imageshare, core_imagevisibility")
+
+        user = users[1]
+        querysets = {
+            # the previous implementation, which joins shares
+            "join-distinct": Image.objects.filter(Q(public=True) | Q(shares=user)).distinct(),
+            "semi-join": ImagePermissions.view_image_list(user),
+        }
+
+        timings: dict[str, list[float]] = {name: [] for name in querysets}
+
+        for name, qs in querysets.items():
+            page = qs.order_by("pk")[:100]
+
+            if explain:
+                click.echo(f"{name}:\n{page.explain(analyze=True)}\n")
+
+            for _ in range(iterations):
+                start = time.perf_counter()
+                list(page.values_list("pk", flat=True))
+                qs.count()
+                timings[name].append(time.perf_counter() - start)
+
+        for name, values in timings.items():
+            click.echo(f"{name}: {_percentiles(values)}")
+
+        transaction.set_rollback(True)
+
+    invalidate_visibility_contexts(grantee_ids)
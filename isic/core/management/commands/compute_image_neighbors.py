@@ -0,0 +1,19 @@
+import sys
+
+import djclick as click
+
+from isic.core.models import ImageEmbedding
+from isic.core.services.image import neighbor
+
+
+@click.command(help="Compute the neighbors of the images which don't have them yet")
+@click.option("--batch-size", default=100, show_default=True)
+def compute_image_neighbors(batch_size):
+    pending = ImageEmbedding.objects.filter(neighbors_computed=False).count()
+
+    with click.progressbar(length=pending, file=sys.stderr) as bar:
+        # one batch at a time, for the progress bar
+        while computed := neighbor.compute_image_neighbors(batch_size=batch_size, max_seconds=0):
+            bar.update(computed)
+
+    click.secho("Done", fg="green", err=True)
@@ -8,24 +8,53 @@ from isic.core.search import (
     LESION_INDEX_MAPPINGS,
     get_elasticsearch_client,
     maybe_create_index,
+    reindex_search_indices,
+    sync_search_indices,
 )
-from isic.core.tasks import sync_elasticsearch_indices_task
 
 
 @click.command(help="Populate the Elasticsearch indices")
 @click.option("--chunk-size", default=500)
-def populate_elasticsearch(chunk_size):
+@click.option(
+    "--reindex",
+    is_flag=True,
+    help="Build new versioned indices and swap the aliases over to them, without downtime.",
+)
+@click.option(
+    "--keep",
+    default=1,
+    show_default=True,
+    help="The number of previous index generations to retain when reindexing.",
+)
+@click.option(
+    "--concurrency",
+    default=1,
+    show_default=True,
+    help="The number of processes to index with.",
+)
+def populate_elasticsearch(chunk_size, reindex, keep, concurrency):
     elastic_transport_logger = logging.getLogger("elastic_transport")
     elastic_transport_logger.setLevel(logging.INFO)
 
+    if reindex:
+        reindex_search_indices(keep=keep, concurrency=concurrency)
+        click.secho("Done", fg="green", err=True)
+        return
+
     es = get_elasticsearch_client()
-    es.indices.delete(index=settings.ISIC_ELASTICSEARCH_IMAGES_INDEX, ignore_unavailable=True)
-    es.indices.delete(index=settings.ISIC_ELASTICSEARCH_LESIONS_INDEX, ignore_unavailable=True)
+    for index in [
+        settings.ISIC_ELASTICSEARCH_IMAGES_INDEX,
+        settings.ISIC_ELASTICSEARCH_LESIONS_INDEX,
+    ]:
+        # the index may be an alias to versioned indices, which have to be deleted by name.
+        concrete_indices = es.indices.get(index=index, ignore_unavailable=True)
+        if concrete_indices:
+            es.indices.delete(index=",".join(concrete_indices))
 
     maybe_create_index(settings.ISIC_ELASTICSEARCH_IMAGES_INDEX, IMAGE_INDEX_MAPPINGS)
     maybe_create_index(settings.ISIC_ELASTICSEARCH_LESIONS_INDEX, LESION_INDEX_MAPPINGS)
 
-    sync_elasticsearch_indices_task()
+    sync_search_indices(concurrency=concurrency)
 
     es.indices.refresh(index="_all")
 
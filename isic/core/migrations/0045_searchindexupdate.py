@@ -0,0 +1,34 @@
+# Generated by Django 5.2.16 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0044_image_pin_nonnull"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SearchIndexUpdate",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("created", django_extensions.db.fields.CreationDateTimeField(auto_now_add=True)),
+                (
+                    "image",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="core.image",
+                    ),
+                ),
+            ],
+        ),
+    ]
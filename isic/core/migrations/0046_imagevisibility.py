@@ -0,0 +1,48 @@
+# Generated by Django 5.2.16 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0045_searchindexupdate"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImageVisibility",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("principal", models.CharField(max_length=64)),
+                (
+                    "image",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="core.image",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("principal", "image"),
+                        name="imagevisibility_principal_image_unique",
+                    )
+                ],
+            },
+        ),
+        migrations.RunSQL(
+            sql="""
+            INSERT INTO core_imagevisibility (image_id, principal)
+            SELECT DISTINCT image_id, 'user:' || grantee_id FROM core_imageshare;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
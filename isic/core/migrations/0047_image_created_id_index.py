@@ -0,0 +1,16 @@
+# Generated by Django 5.2.16 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0046_imagevisibility"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="image",
+            index=models.Index(fields=["created", "id"], name="created_id_index"),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.16 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+import isic.core.models.image
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0047_image_created_id_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="public_metadata",
+            field=models.JSONField(
+                decoder=isic.core.models.image.PublicMetadataDecoder,
+                default=dict,
+                editable=False,
+                encoder=isic.core.models.image.PublicMetadataEncoder,
+            ),
+        ),
+    ]
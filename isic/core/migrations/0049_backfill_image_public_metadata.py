@@ -0,0 +1,74 @@
+from itertools import batched
+
+from django.db import migrations
+
+# a frozen copy of the fields which Image.metadata reads, so later changes to the accession
+# metadata don't change what this migration computes.
+METADATA_FIELDS = [
+    "concomitant_biopsy",
+    "fitzpatrick_skin_type",
+    "age",
+    "sex",
+    "anatom_site_special",
+    "anatom_site_1",
+    "anatom_site_2",
+    "anatom_site_3",
+    "anatom_site_4",
+    "anatom_site_5",
+    "diagnosis_1",
+    "diagnosis_2",
+    "diagnosis_3",
+    "diagnosis_4",
+    "diagnosis_5",
+    "diagnosis_confirm_type",
+    "personal_hx_mm",
+    "family_hx_mm",
+    "clin_size_long_diam_mm",
+    "melanocytic",
+    "mel_mitotic_index",
+    "mel_thick_mm",
+    "mel_ulcer",
+    "acquisition_day",
+    "image_manipulation",
+    "image_type",
+    "dermoscopic_type",
+    "tbp_tile_type",
+]
+REMAPPED_FIELDS = ["lesion_id", "patient_id", "rcm_case_id"]
+
+
+def backfill_public_metadata(apps, schema_editor):
+    Image = apps.get_model("core", "Image")
+
+    images = Image.objects.filter(public_metadata={}).select_related("accession").order_by("pk")
+
+    # this mirrors Image.metadata, which historical models don't have
+    for image_batch in batched(images.iterator(chunk_size=2_000), 2_000, strict=False):
+        for image in image_batch:
+            metadata = {
+                field: getattr(image.accession, field)
+                for field in METADATA_FIELDS
+                if getattr(image.accession, field) is not None
+            }
+
+            if "age" in metadata:
+                metadata["age_approx"] = int(round(metadata.pop("age") / 5.0) * 5)
+
+            for field in REMAPPED_FIELDS:
+                if getattr(image.accession, field) is not None:
+                    metadata[field] = getattr(image.accession, field)
+
+            image.public_metadata = metadata
+
+        Image.objects.bulk_update(image_batch, ["public_metadata"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0048_image_public_metadata"),
+        ("ingest", "0043_alter_rcmcase_id"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_public_metadata, migrations.RunPython.noop, elidable=True),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.16 on 2026-10-17 12:00
+
+from django.db import migrations
+import pgvector.django.indexes
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0049_backfill_image_public_metadata"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="imageembedding",
+            index=pgvector.django.indexes.HnswIndex(
+                ef_construction=64,
+                fields=["embedding"],
+                m=16,
+                name="imageembedding_embed_hnsw",
+                opclasses=["halfvec_cosine_ops"],
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.16 on 2026-10-17 12:00
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.functions.comparison
+import pgvector.django.bit
+import pgvector.django.indexes
+
+import isic.core.models.image_embedding
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0050_imageembedding_embed_hnsw"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="imageembedding",
+            index=pgvector.django.indexes.HnswIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.comparison.Cast(
+                        isic.core.models.image_embedding.BinaryQuantize(models.F("embedding")),
+                        pgvector.django.bit.BitField(length=3584),
+                    ),
+                    name="bit_hamming_ops",
+                ),
+                ef_construction=64,
+                m=16,
+                name="imageembedding_binary_hnsw",
+            ),
+        ),
+    ]
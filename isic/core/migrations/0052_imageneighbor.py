@@ -0,0 +1,65 @@
+# Generated by Django 5.2.16 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0051_imageembedding_binary_hnsw"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imageembedding",
+            name="neighbors_computed",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name="imageembedding",
+            index=models.Index(
+                condition=models.Q(("neighbors_computed", False)),
+                fields=["image"],
+                name="imageembedding_nbrs_pending",
+            ),
+        ),
+        migrations.CreateModel(
+            name="ImageNeighbor",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("distance", models.FloatField()),
+                (
+                    "image",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="core.image",
+                    ),
+                ),
+                (
+                    "neighbor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="nearest_to",
+                        to="core.image",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["image", "distance"], name="imageneighbor_image_distance")
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("image", "neighbor"), name="imageneighbor_image_neighbor_unique"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -10,7 +10,11 @@ from .girder_image import GirderDataset, GirderImage
 from .image import Image
 from .image_alias import ImageAlias
 from .image_embedding import ImageEmbedding
+from .image_neighbor import ImageNeighbor
+from .image_visibility import ImageVisibility
 from .isic_id import IsicId
+from .job import Job
+from .search_index_update import SearchIndexUpdate
 from .segmentation import Segmentation, SegmentationReview
 from .supplemental_file import SupplementalFile
 
@@ -25,8 +29,12 @@ __all__ = [
     "Image",
     "ImageAlias",
     "ImageEmbedding",
+    "ImageNeighbor",
+    "ImageVisibility",
     "IsicId",
     "IsicOAuthApplication",
+    "Job",
+    "SearchIndexUpdate",
     "Segmentation",
     "SegmentationReview",
     "SupplementalFile",
@@ -1,24 +1,29 @@
 from __future__ import annotations
 
 from copy import deepcopy
+from decimal import Decimal
+import json
 from pathlib import PurePosixPath
 from typing import TYPE_CHECKING
 
 from django.contrib.auth.models import User
 from django.contrib.postgres.aggregates.general import ArrayAgg
+from django.contrib.postgres.expressions import ArraySubquery
 from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.db import models
 from django.db.models.constraints import CheckConstraint
-from django.db.models.expressions import F
-from django.db.models.functions import Upper
+from django.db.models.expressions import F, Func, OuterRef
+from django.db.models.fields.json import JSONField
+from django.db.models.functions import Cast, JSONObject, Upper
 from django.db.models.query_utils import Q
 from django.urls import reverse
 from django_extensions.db.models import TimeStampedModel
-from pgvector.django import CosineDistance
 
-from isic.core.dsl import django_parser, parse_query
+from isic.core.dsl import canonicalize, django_parser
 from isic.core.models.base import CreationSortedTimeStampedModel
+from isic.core.visibility import get_visibility_context, user_principal
 from isic.ingest.models import Accession
+from isic.ingest.models.contributor import Contributor
 
 from .isic_id import IsicId
 
@@ -26,6 +31,26 @@ if TYPE_CHECKING:
     from django.db.models.query import QuerySet
 
 
+class JSONBConcat(Func):
+    arg_joiner = " || "
+    template = "(%(expressions)s)"
+    output_field = JSONField()
+
+
+class PublicMetadataEncoder(json.JSONEncoder):
+    def default(self, o):
+        # decimals are stored as JSON numbers, which is how postgres renders numeric columns
+        if isinstance(o, Decimal):
+            return float(o)
+        return super().default(o)
+
+
+class PublicMetadataDecoder(json.JSONDecoder):
+    def __init__(self, *args, **kwargs):
+        # the only non-integer numbers in metadata come from decimal fields
+        super().__init__(*args, parse_float=Decimal, **kwargs)
+
+
 class ImageQuerySet(models.QuerySet["Image"]):
     def public(self):
         return self.filter(public=True)
@@ -36,7 +61,52 @@ class ImageQuerySet(models.QuerySet["Image"]):
     def from_search_query(self, query: str):
         if query == "":
             return self
-        return self.filter(parse_query(django_parser, query) or Q())
+        return self.filter(django_parser(canonicalize(query)))
+
+    def with_elasticsearch_document(self):
+        """
+        Annotate each image with its search document, built as JSON by the database.
+
+        The document matches to_elasticsearch_document, but avoids materializing the models
+        for each image. It's annotated as text so it can be sent to elasticsearch without
+        being decoded.
+        """
+        from isic.core.models.collection import CollectionImage
+
+        document = JSONBConcat(
+            JSONObject(
+                id=F("pk"),
+                created=F("created"),
+                isic_id=F("isic_id"),
+                public=F("public"),
+                pinned=F("pinned"),
+                copyright_license=F("accession__copyright_license"),
+                blob_size=F("accession__blob_size"),
+                contributor_owner_ids=ArraySubquery(
+                    Contributor.owners.through.objects.filter(
+                        contributor_id=OuterRef("accession__cohort__contributor_id")
+                    )
+                    .values("user_id")
+                    .distinct()
+                    .order_by("user_id")
+                ),
+                shared_to=ArraySubquery(
+                    ImageShare.objects.filter(image_id=OuterRef("pk"))
+                    .values("grantee_id")
+                    .distinct()
+                    .order_by("grantee_id")
+                ),
+                collections=ArraySubquery(
+                    CollectionImage.objects.filter(image_id=OuterRef("pk"))
+                    .values("collection_id")
+                    .distinct()
+                    .order_by("collection_id")
+                ),
+            ),
+            F("public_metadata"),
+        )
+
+        return self.annotate(elasticsearch_document=Cast(document, output_field=models.TextField()))
 
 
 _BaseImageManager = models.Manager.from_queryset(ImageQuerySet)
@@ -80,6 +150,8 @@ class Image(CreationSortedTimeStampedModel):
             GinIndex(OpClass(Upper("isic"), name="gin_trgm_ops"), name="isic_name_gin"),
             # Used when sorting images by pinned state and then by created timestamp
             models.Index(fields=["-pinned", "created"], name="pinned_created_index"),
+            # Used when paginating images by created, which is tiebroken by id
+            models.Index(fields=["created", "id"], name="created_id_index"),
         ]
 
     accession = models.OneToOneField(
@@ -101,6 +173,13 @@ class Image(CreationSortedTimeStampedModel):
 
     pinned = models.PositiveSmallIntegerField(default=0)
 
+    # the sanitized metadata, see Image.metadata. this is materialized since it's read far
+    # more often than it changes, and is kept up to date by Accession.update_metadata and
+    # Accession.remove_metadata.
+    public_metadata = models.JSONField(
+        default=dict, editable=False, encoder=PublicMetadataEncoder, decoder=PublicMetadataDecoder
+    )
+
     shares: models.ManyToManyField[User, ImageShare] = models.ManyToManyField(
         User, through="ImageShare", through_fields=("image", "grantee")
     )
@@ -110,6 +189,12 @@ class Image(CreationSortedTimeStampedModel):
     def __str__(self):
         return self.isic_id
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self.public_metadata = self.metadata
+
+        super().save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse("core/image-detail", args=[self.isic_id])
 
@@ -174,6 +259,10 @@ class Image(CreationSortedTimeStampedModel):
 
         return image_metadata
 
+    def update_public_metadata(self) -> None:
+        self.public_metadata = self.metadata
+        self.save(update_fields=["public_metadata"])
+
     def to_elasticsearch_document(self, *, source_only=False) -> dict:
         # Can only be called on images that were fetched with with_elasticsearch_properties.
         document = {
@@ -181,6 +270,7 @@ class Image(CreationSortedTimeStampedModel):
             "created": self.created,
             "isic_id": self.isic_id,
             "public": self.public,
+            "pinned": self.pinned,
             "copyright_license": self.accession.copyright_license,
             "blob_size": self.accession.blob_size,
             # TODO: make sure these fields can't be searched on
@@ -189,7 +279,7 @@ class Image(CreationSortedTimeStampedModel):
             "collections": self.coll_pks,
         }
 
-        document.update(self.metadata)
+        document.update(self.public_metadata)
 
         if source_only:
             return document
@@ -227,21 +317,6 @@ class Image(CreationSortedTimeStampedModel):
             .exclude(pk=self.pk)
         )
 
-    def similar_images(self) -> QuerySet[Image]:
-        if not self.has_embedding:
-            return Image.objects.none()
-
-        return (
-            Image.objects.filter(embedding_relation__isnull=False)
-            .exclude(pk=self.pk)
-            .annotate(
-                distance=CosineDistance(
-                    "embedding_relation__embedding", self.embedding_relation.embedding
-                )
-            )
-            .order_by("distance")
-        )
-
 
 class ImageShare(TimeStampedModel):
     class Meta(TimeStampedModel.Meta):
@@ -298,24 +373,28 @@ class ImagePermissions:
         if user_obj.is_staff:
             return qs
         elif user_obj.is_authenticated:
+            visibility = get_visibility_context(user_obj)
             image_visibility_requirements = Q(public=True)
 
-            if user_obj.owned_contributors.exists():
+            if visibility.contributor_ids:
                 image_visibility_requirements |= Q(
-                    # this needs list coercion because otherwise it will be a subquery that contains
-                    # the user_id, which doesn't allow users with identical privileges to share
-                    # the query cache.
-                    accession__cohort__contributor_id__in=list(
-                        user_obj.owned_contributors.order_by().values_list("id", flat=True)
-                    )
+                    # this uses the ids rather than a subquery that contains the user_id, which
+                    # doesn't allow users with identical privileges to share the query cache.
+                    accession__cohort__contributor_id__in=visibility.contributor_ids
                 )
 
-            if user_obj.image_shares_received.exists():
+            if visibility.has_shares:
+                from isic.core.models.image_visibility import ImageVisibility
+
                 # this is the worst case scenario where we have to put the specific user into the
                 # query, guaranteeing that they won't share the cache with others.
-                # this is also the only portion that demands a left join, forcing the
-                # caller to wrap the query in a distinct() call.
-                image_visibility_requirements |= Q(shares=user_obj)
+                # joining shares would produce duplicate rows, so use a semi-join against the
+                # visibility index instead.
+                image_visibility_requirements |= Q(
+                    pk__in=ImageVisibility.objects.filter(
+                        principal=user_principal(user_obj.pk)
+                    ).values("image_id")
+                )
 
             # Note: permissions here must be also modified in build_elasticsearch_query and
             # LesionPermissions.view_lesion_list.
@@ -327,6 +406,10 @@ class ImagePermissions:
 
     @staticmethod
     def view_image(user_obj: User, obj: Image) -> bool:
+        # avoid a query for the common cases
+        if user_obj.is_staff or obj.public:
+            return True
+
         return ImagePermissions.view_image_list(user_obj).contains(obj)
 
 
@@ -1,7 +1,116 @@
 from __future__ import annotations
 
-from django.db import models
-from pgvector.django import HalfVectorField, IvfflatIndex
+from typing import TYPE_CHECKING
+
+from django.contrib.postgres.indexes import OpClass
+from django.db import connections, models, transaction
+from django.db.models import F, Func, Value
+from django.db.models.functions import Cast
+from pgvector import HalfVector
+from pgvector.django import (
+    BitField,
+    CosineDistance,
+    HalfVectorField,
+    HammingDistance,
+    HnswIndex,
+    IvfflatIndex,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    from django.db.models import Expression
+
+EMBEDDING_DIMENSIONS = 3584
+
+# the defaults for the size of the candidate list of an hnsw scan, and the number of lists
+# probed by an ivfflat scan. larger values increase recall at the cost of latency.
+DEFAULT_EF_SEARCH = 40
+DEFAULT_PROBES = 10
+# the largest hnsw.ef_search pgvector accepts
+MAX_EF_SEARCH = 1_000
+
+
+class BinaryQuantize(Func):
+    function = "binary_quantize"
+    output_field = BitField()
+
+
+def binary_embedding(expression: Expression) -> Cast:
+    """
+    Quantize an embedding to one bit per dimension.
+
+    This is the expression of the index of the binary embeddings, which a query has to repeat
+    exactly to be answered by the index. The cast gives the bits the length the index requires.
+    """
+    return Cast(BinaryQuantize(expression), BitField(length=EMBEDDING_DIMENSIONS))
+
+
+class ImageEmbeddingQuerySet(models.QuerySet["ImageEmbedding"]):
+    def nearest(
+        self,
+        embedding: Sequence[float] | HalfVector,
+        limit: int,
+        *,
+        ef_search: int | None = None,
+        probes: int | None = None,
+        shortlist: int | None = None,
+    ) -> list[tuple[int, float]]:
+        """
+        Return the image ids and cosine distances of the embeddings nearest to embedding.
+
+        The search is approximate when it uses an index. ef_search applies to hnsw scans and
+        probes to ivfflat scans, and both are only set for this query. An hnsw scan can't return
+        more rows than ef_search, so it's raised to limit when necessary.
+
+        If shortlist is given, the search is done in two stages: the shortlist nearest binary
+        embeddings are found with their index, which is a fraction of the size of the index of
+        the full embeddings, and then ranked by their exact distance.
+        """
+        ef_search = min(max(ef_search or DEFAULT_EF_SEARCH, shortlist or limit), MAX_EF_SEARCH)
+        halfvec = (
+            embedding if isinstance(embedding, HalfVector) else HalfVector(list(embedding))
+        ).to_text()
+
+        with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('hnsw.ef_search', %s, true), "
+                "set_config('ivfflat.probes', %s, true)",
+                [str(ef_search), str(probes or DEFAULT_PROBES)],
+            )
+
+            # the queries are run through the cursor rather than the orm so that they aren't
+            # cached, since their results depend on the settings above.
+            if shortlist is None:
+                sql, params = (
+                    self.annotate(distance=CosineDistance("embedding", embedding))
+                    .order_by("distance")
+                    .values_list("image_id", "distance")[:limit]
+                    .query.sql_with_params()
+                )
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+
+            shortlist_sql, shortlist_params = (
+                self.order_by(
+                    HammingDistance(
+                        binary_embedding(F("embedding")),
+                        binary_embedding(
+                            Cast(Value(halfvec), HalfVectorField(dimensions=EMBEDDING_DIMENSIONS))
+                        ),
+                    )
+                )
+                .values("image_id", "embedding")[:shortlist]
+                .query.sql_with_params()
+            )
+            # reranking outside of the shortlist subquery prevents the planner from using the
+            # index of the full embeddings, which could drop rows from the shortlist.
+            cursor.execute(
+                "SELECT image_id, embedding <=> %s::halfvec AS distance "  # noqa: S608
+                f"FROM ({shortlist_sql}) AS shortlist ORDER BY distance LIMIT %s",
+                [halfvec, *shortlist_params, limit],
+            )
+            return cursor.fetchall()
 
 
 class ImageEmbedding(models.Model):
@@ -11,7 +120,11 @@ class ImageEmbedding(models.Model):
         primary_key=True,
         related_name="embedding_relation",
     )
-    embedding = HalfVectorField(dimensions=3584)
+    embedding = HalfVectorField(dimensions=EMBEDDING_DIMENSIONS)
+    # whether the neighbors of the image have been computed, see ImageNeighbor
+    neighbors_computed = models.BooleanField(default=False, editable=False)
+
+    objects = ImageEmbeddingQuerySet.as_manager()
 
     class Meta:
         indexes = [
@@ -21,6 +134,28 @@ class ImageEmbedding(models.Model):
                 lists=1000,
                 opclasses=["halfvec_cosine_ops"],
             ),
+            # hnsw has better recall at the same latency and doesn't need to be trained on
+            # existing rows, see benchmark_similarity for comparing the two.
+            HnswIndex(
+                name="imageembedding_embed_hnsw",
+                fields=["embedding"],
+                m=16,
+                ef_construction=64,
+                opclasses=["halfvec_cosine_ops"],
+            ),
+            # the binary embeddings are only stored in this index, at 1/16 the size of the
+            # halfvecs. queries use the same expression, see binary_embedding.
+            HnswIndex(
+                OpClass(binary_embedding(F("embedding")), name="bit_hamming_ops"),
+                name="imageembedding_binary_hnsw",
+                m=16,
+                ef_construction=64,
+            ),
+            models.Index(
+                name="imageembedding_nbrs_pending",
+                fields=["image"],
+                condition=models.Q(neighbors_computed=False),
+            ),
         ]
 
     def __str__(self):
@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from django.db import models
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from .image import Image
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+
+class ImageNeighborQuerySet(models.QuerySet):
+    def trim(self, image_ids: Iterable[int], count: int) -> None:
+        """Remove all but the count nearest neighbors of each of image_ids."""
+        ranked = self.filter(image_id__in=image_ids).annotate(
+            rank=Window(
+                RowNumber(), partition_by=[F("image_id")], order_by=["distance", "neighbor_id"]
+            )
+        )
+        self.filter(pk__in=ranked.filter(rank__gt=count).values("pk")).delete()
+
+
+class ImageNeighbor(models.Model):
+    """
+    The precomputed nearest neighbors of images with embeddings.
+
+    Neighbors are computed by compute_image_neighbors, see ImageEmbedding.neighbors_computed
+    for the images which have them. Similar images are served from this table rather than
+    searching the embeddings on every request.
+    """
+
+    # the unique constraint indexes image
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name="+", db_index=False)
+    neighbor = models.ForeignKey(Image, on_delete=models.CASCADE, related_name="nearest_to")
+    distance = models.FloatField()
+
+    objects = ImageNeighborQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name="imageneighbor_image_neighbor_unique", fields=["image", "neighbor"]
+            ),
+        ]
+        indexes = [
+            models.Index(name="imageneighbor_image_distance", fields=["image", "distance"]),
+        ]
+
+    def __str__(self):
+        return f"{self.neighbor_id} is a neighbor of {self.image_id}"
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+from django.db import models
+from django.db.models import Exists, OuterRef, Value
+from django.db.models.functions import Cast, Concat
+
+from isic.core.visibility import USER_PRINCIPAL_PREFIX, user_principal
+
+from .image import Image, ImageShare
+
+
+class ImageVisibilityQuerySet(models.QuerySet):
+    def add_shares(self, image_ids: list[int], grantee_ids: list[int]) -> None:
+        self.bulk_create(
+            [
+                ImageVisibility(image_id=image_id, principal=user_principal(grantee_id))
+                for image_id in image_ids
+                for grantee_id in grantee_ids
+            ],
+            batch_size=5_000,
+            ignore_conflicts=True,
+        )
+
+    def remove_shares(self, image_ids: list[int] | None, grantee_ids: list[int] | None) -> None:
+        """
+        Remove the rows of images which are no longer shared with the grantees.
+
+        None matches every image or grantee. A row is kept while a share remains, since an image
+        can be shared with the same grantee by multiple grantors.
+        """
+        qs = self.filter(principal__startswith=USER_PRINCIPAL_PREFIX)
+
+        if image_ids is not None:
+            qs = qs.filter(image_id__in=image_ids)
+
+        if grantee_ids is not None:
+            qs = qs.filter(principal__in=[user_principal(pk) for pk in grantee_ids])
+
+        remaining_shares = ImageShare.objects.annotate(
+            principal=Concat(
+                Value(USER_PRINCIPAL_PREFIX),
+                Cast("grantee_id", models.CharField()),
+                output_field=models.CharField(),
+            )
+        ).filter(image_id=OuterRef("image_id"), principal=OuterRef("principal"))
+
+        qs.exclude(Exists(remaining_shares)).delete()
+
+
+class ImageVisibility(models.Model):
+    """
+    An index of the principals each image is visible to.
+
+    A principal is a user the image is shared with. Public images and the images of a user's
+    contributors are found with columns of the image, so they aren't stored. Filtering images with
+    a semi-join against this table avoids joining shares, which produces duplicate rows and
+    forces callers to use distinct(). An image shared with a user by multiple grantors has a
+    single row.
+    """
+
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name="+")
+    principal = models.CharField(max_length=64)
+
+    objects = ImageVisibilityQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name="imagevisibility_principal_image_unique",
+                fields=["principal", "image"],
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.image_id} visible to {self.principal}"
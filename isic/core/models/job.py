@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from django.db import models
+from django_extensions.db.models import TimeStampedModel
+
+
+class Job(TimeStampedModel):
+    """
+    The progress of a long running task, which allows it to be resumed after it fails.
+
+    A job is identified by a key which is the same for every attempt at the same work, see
+    run_job. checkpoint is whatever state the task needs to resume from where it was.
+    """
+
+    class Status(models.TextChoices):
+        RUNNING = "running", "Running"
+        SUCCEEDED = "succeeded", "Succeeded"
+        FAILED = "failed", "Failed"
+
+    key = models.CharField(max_length=255, unique=True)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.RUNNING)
+    attempts = models.PositiveIntegerField(default=0)
+    processed = models.PositiveBigIntegerField(default=0)
+    total = models.PositiveBigIntegerField(null=True, blank=True)
+    checkpoint = models.JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return f"{self.key} ({self.status})"
+
+    @property
+    def progress(self) -> float | None:
+        """Return the fraction of the job which is done, if its total is known."""
+        if not self.total:
+            return None
+
+        return min(self.processed / self.total, 1.0)
+
+    def save_checkpoint(self, *, processed: int, **checkpoint) -> None:
+        """Record progress, which is resumed from if the job is attempted again."""
+        self.processed = processed
+        self.checkpoint = checkpoint
+        self.save(update_fields=["processed", "checkpoint", "modified"])
@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+from django.db import models
+from django_extensions.db.fields import CreationDateTimeField
+
+
+class SearchIndexUpdate(models.Model):
+    """
+    An outbox entry recording that an image's search documents are stale.
+
+    Rows are written in the same transaction as the change that made the documents stale, and
+    are consumed by sync_elasticsearch_index_updates_task. Rows aren't unique per image, an image
+    which is modified while it's being reindexed gets a second row so the later change isn't lost.
+    """
+
+    created = CreationDateTimeField()
+    image = models.ForeignKey("Image", on_delete=models.CASCADE, related_name="+")
+
+    def __str__(self):
+        return f"Search index update for image {self.image_id}"
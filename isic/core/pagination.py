@@ -1,10 +1,15 @@
-from base64 import b64decode, b64encode
-from collections.abc import Sequence
+from collections.abc import Callable, Sequence
 from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from functools import cache
 from typing import Any
 from urllib import parse
 
+from django.core import signing
 from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import DateTimeField, F, Model, Q
+from django.db.models import Field as ModelField
+from django.db.models.fields.tuple_lookups import Tuple, TupleGreaterThan, TupleLessThan
 from django.db.models.query import QuerySet
 from django.http.request import HttpRequest
 from ninja import Field, Schema
@@ -13,13 +18,16 @@ from ninja.pagination import PaginationBase
 from pydantic import field_validator
 
 
-def qs_with_hardcoded_count(qs: QuerySet, ordering: Sequence, count: int) -> QuerySet:
+def qs_with_hardcoded_count(
+    qs: QuerySet, ordering: Sequence, count: int | Callable[[], int]
+) -> QuerySet:
     """
     Modify a queryset to return a hardcoded count rather than querying the database.
 
     This is useful when the count can be obtained with a cheaper method instead of
     the default queryset.count() method, e.g. elasticsearch, a separate query with
-    fewer joins, etc.
+    fewer joins, etc. count can be a function, which is called at most once and only if the
+    count is needed.
     """
     # This is an unfortunate bit of hackery to get around the fact that the CursorPagination class
     # adds an order by which clones the queryset, overriding our hardcoded count. We have to repeat
@@ -27,19 +35,88 @@ def qs_with_hardcoded_count(qs: QuerySet, ordering: Sequence, count: int) -> Que
     if not qs.query.order_by:
         qs = qs.order_by(*ordering)
 
-    qs.count = lambda: count
+    qs.count = qs.custom_count = cache(count) if callable(count) else lambda: count
 
     return qs
 
 
+_CURSOR_SALT = "isic.core.pagination.cursor"
+_EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+
+
 @dataclass
 class Cursor:
-    offset: int = 0
     reverse: bool = False
-    position: str | None = None
+    # the values of the ordering fields for the row the page starts after (or before, if reversed)
+    position: tuple[Any, ...] | None = None
+
+
+def dump_cursor(cursor: Cursor) -> str:
+    """
+    Encode a cursor as a compact signed string.
+
+    The position is encoded as JSON values, with datetimes as microseconds since the epoch. The
+    signature means positions can only come from links generated by the server.
+    """
+    return signing.dumps(
+        [int(cursor.reverse), *(cursor.position or ())], salt=_CURSOR_SALT, compress=True
+    )
+
+
+def load_cursor(encoded_cursor: str) -> Cursor:
+    try:
+        payload = signing.loads(encoded_cursor, salt=_CURSOR_SALT)
+    except signing.BadSignature as e:
+        raise ValueError("Invalid cursor.") from e
+
+    if not isinstance(payload, list) or not payload or payload[0] not in [0, 1]:
+        raise ValueError("Invalid cursor.")
+
+    return Cursor(reverse=bool(payload[0]), position=tuple(payload[1:]) or None)
+
+
+def _position_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return (value - _EPOCH) // timedelta(microseconds=1)
+    if value is None or isinstance(value, int | float | str):
+        return value
+    return str(value)
 
 
-def _clamp(val: int, min_: int, max_: int) -> int:
+def _coerce_position_value(field: ModelField, value: Any) -> Any:
+    if isinstance(field, DateTimeField):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise DjangoValidationError("Invalid datetime position.")
+        return _EPOCH + timedelta(microseconds=value)
+    return field.to_python(value)
+
+
+def _get_field(model: type[Model], name: str) -> ModelField:
+    *path, field_name = name.split("__")
+    for part in path:
+        model = model._meta.get_field(part).related_model
+    return model._meta.pk if field_name == "pk" else model._meta.get_field(field_name)
+
+
+def _keyset_ordering(queryset: QuerySet) -> tuple[str, ...]:
+    """
+    Return the ordering of queryset with the primary key appended as a tiebreaker.
+
+    The tiebreaker makes every position unique, so a position alone identifies where a page
+    starts. The tiebreaker takes the direction of the last field so that orderings whose
+    directions agree keep agreeing.
+    """
+    order: tuple[str, ...] = tuple(queryset.query.order_by)
+    pk_name = queryset.model._meta.pk.name
+
+    if not any(field.lstrip("-") in ["pk", pk_name] for field in order):
+        descending = bool(order) and order[-1].startswith("-")
+        order = (*order, f"-{pk_name}" if descending else pk_name)
+
+    return order
+
+
+def clamp(val: int, min_: int, max_: int) -> int:
     return max(min_, min(val, max_))
 
 
@@ -82,21 +159,7 @@ class CursorPagination(PaginationBase):
             if not isinstance(encoded_cursor, str):
                 raise ValueError("Invalid cursor.")  # noqa: TRY004
 
-            try:
-                querystring = b64decode(encoded_cursor).decode()
-                tokens = parse.parse_qs(querystring, keep_blank_values=True)
-
-                offset = int(tokens.get("o", ["0"])[0])
-                offset = _clamp(offset, 0, CursorPagination._offset_cutoff)
-
-                reverse_str = tokens.get("r", ["0"])[0]
-                reverse = bool(int(reverse_str))
-
-                position = tokens.get("p", [None])[0]
-            except (TypeError, ValueError) as e:
-                raise ValueError("Invalid cursor.") from e
-
-            return Cursor(offset=offset, reverse=reverse, position=position)
+            return load_cursor(encoded_cursor)
 
     class Output(Schema):
         results: list[Any] = Field(description="The page of objects.")
@@ -109,7 +172,6 @@ class CursorPagination(PaginationBase):
     items_attribute = "results"
     default_ordering = ("-created",)
     max_page_size = 100
-    _offset_cutoff = 100  # limit to protect against possibly malicious queries
 
     def __init__(self, ordering: Sequence = default_ordering, **kwargs: Any) -> None:
         self.ordering = ordering
@@ -118,252 +180,149 @@ class CursorPagination(PaginationBase):
     def paginate_queryset(
         self, queryset: QuerySet, pagination: Input, request: HttpRequest, **params
     ) -> dict:
-        limit = _clamp(pagination.limit or self.max_page_size, 0, self.max_page_size)
+        limit = clamp(pagination.limit or self.max_page_size, 0, self.max_page_size)
+
+        # only count the total number of results if a position is absent, usually indicating
+        # that we're on the first page. this improves performance for larger queries.
+        total_count = self._total_count(queryset) if pagination.cursor.position is None else None
 
         if not queryset.query.order_by:
             queryset = queryset.order_by(*self.ordering)
 
-        order: tuple[str, ...] = queryset.query.order_by
-
-        total_count = (
-            # let the queryset define a custom_count attribute in the event that computing
-            # the count can be done cheaper than the default queryset.count() method.
-            queryset.custom_count
-            if hasattr(queryset, "custom_count")
-            else queryset.count()
-            # only count the total number of results if a position is absent, usually indicating
-            # that we're on the first page. this improves performance for larger queries.
-            if pagination.cursor.position is None
-            else None
-        )
-
         base_url = request.build_absolute_uri()
         cursor = pagination.cursor
+        order = _keyset_ordering(queryset)
 
-        if cursor.reverse:
-            queryset = queryset.order_by(*_reverse_order(order))
-
+        queryset = queryset.order_by(*(_reverse_order(order) if cursor.reverse else order))
         queryset = self._apply_ordering(queryset, cursor, order)
 
-        # If we have an offset cursor then offset the entire page by that amount.
-        # We also always fetch an extra item in order to determine if there is a
+        # We always fetch an extra item in order to determine if there is a
         # page following on from this one.
         # Always fetch the maximum page size to increase cache utilization.
-        results = list(queryset[cursor.offset : cursor.offset + self.max_page_size + 1])
-        page = list(results[:limit])
-
-        # Determine the position of the final item following the page.
-        if len(results) > len(page):
-            has_following_position = True
-            following_position = self._get_position_from_instance(results[-1], order)
-        else:
-            has_following_position = False
-            following_position = None
+        results = list(queryset[: self.max_page_size + 1])
+        page = results[:limit]
+        has_following_position = len(results) > len(page)
 
         if cursor.reverse:
             # If we have a reverse queryset, then the query ordering was in reverse
             # so we need to reverse the items again before returning them to the user.
             page.reverse()
-
-            has_next = (cursor.position is not None) or (cursor.offset > 0)
+            has_next = cursor.position is not None
             has_previous = has_following_position
-            next_position = cursor.position if has_next else None
-            previous_position = following_position if has_previous else None
         else:
             has_next = has_following_position
-            has_previous = (cursor.position is not None) or (cursor.offset > 0)
-            next_position = following_position if has_next else None
-            previous_position = cursor.position if has_previous else None
+            has_previous = cursor.position is not None
+
+        # an empty page can only follow a position whose rows were deleted, so link back to it.
+        next_position = (
+            self._get_position_from_instance(page[-1], order) if page else cursor.position
+        )
+        previous_position = (
+            self._get_position_from_instance(page[0], order) if page else cursor.position
+        )
 
         return {
             "results": page,
             "count": total_count,
             "next": (
-                self.next_link(
-                    base_url,
-                    page,
-                    cursor,
-                    order,
-                    has_previous,
-                    limit,
-                    next_position,
-                    previous_position,
-                )
-                if has_next
-                else None
+                self._encode_cursor(Cursor(position=next_position), base_url) if has_next else None
             ),
             "previous": (
-                self.previous_link(
-                    base_url,
-                    page,
-                    cursor,
-                    order,
-                    has_next,
-                    limit,
-                    next_position,
-                    previous_position,
-                )
+                self._encode_cursor(Cursor(reverse=True, position=previous_position), base_url)
                 if has_previous
                 else None
             ),
         }
 
+    @staticmethod
+    def _total_count(queryset: QuerySet) -> int:
+        # let the queryset define a custom_count attribute in the event that computing
+        # the count can be done cheaper than the default queryset.count() method. it can be
+        # a function so that it's only computed when it's needed.
+        custom_count = getattr(queryset, "custom_count", None)
+
+        if custom_count is None:
+            return queryset.count()
+
+        return custom_count() if callable(custom_count) else custom_count
+
     def _encode_cursor(self, cursor: Cursor, base_url: str) -> str:
-        tokens = {}
-        if cursor.offset != 0:
-            tokens["o"] = str(cursor.offset)
-        if cursor.reverse:
-            tokens["r"] = "1"
-        if cursor.position is not None:
-            tokens["p"] = cursor.position
-
-        querystring = parse.urlencode(tokens, doseq=True)
-        encoded = b64encode(querystring.encode()).decode()
-        return _replace_query_param(base_url, "cursor", encoded)
-
-    def next_link(  # noqa: PLR0913
-        self,
-        base_url: str,
-        page: list,
-        cursor: Cursor,
-        order: Sequence[str],
-        has_previous: bool,
-        limit: int,
-        next_position: str | None,
-        previous_position: str | None,
-    ) -> str:
-        if page and cursor.reverse and cursor.offset:
-            # If we're reversing direction and we have an offset cursor
-            # then we cannot use the first position we find as a marker.
-            compare = self._get_position_from_instance(page[-1], order)
-        else:
-            compare = next_position
-        offset = 0
-
-        has_item_with_unique_position = False
-        for item in reversed(page):
-            position = self._get_position_from_instance(item, order)
-            if position != compare:
-                # The item in this position and the item following it
-                # have different positions. We can use this position as
-                # our marker.
-                has_item_with_unique_position = True
-                break
-
-            # The item in this position has the same position as the item
-            # following it, we can't use it as a marker position, so increment
-            # the offset and keep seeking to the previous item.
-            compare = position
-            offset += 1  # noqa: SIM113
-
-        if page and not has_item_with_unique_position:
-            # There were no unique positions in the page.
-            if not has_previous:
-                # We are on the first page.
-                # Our cursor will have an offset equal to the page size,
-                # but no position to filter against yet.
-                offset = limit
-                position = None
-            elif cursor.reverse:
-                # The change in direction will introduce a paging artifact,
-                # where we end up skipping forward a few extra items.
-                offset = 0
-                position = previous_position
-            else:
-                # Use the position from the existing cursor and increment
-                # it's offset by the page size.
-                offset = cursor.offset + limit
-                position = previous_position
-
-        if not page:
-            position = next_position
-
-        next_cursor = Cursor(offset=offset, reverse=False, position=position)
-        return self._encode_cursor(next_cursor, base_url)
-
-    def previous_link(  # noqa: PLR0913
-        self,
-        base_url: str,
-        page: list,
-        cursor: Cursor,
-        order: Sequence[str],
-        has_next: bool,
-        limit: int,
-        next_position: str | None,
-        previous_position: str | None,
-    ) -> str:
-        if page and not cursor.reverse and cursor.offset:
-            # If we're reversing direction and we have an offset cursor
-            # then we cannot use the first position we find as a marker.
-            compare = self._get_position_from_instance(page[0], order)
-        else:
-            compare = previous_position
-        offset = 0
-
-        has_item_with_unique_position = False
-        for item in page:
-            position = self._get_position_from_instance(item, order)
-            if position != compare:
-                # The item in this position and the item following it
-                # have different positions. We can use this position as
-                # our marker.
-                has_item_with_unique_position = True
-                break
-
-            # The item in this position has the same position as the item
-            # following it, we can't use it as a marker position, so increment
-            # the offset and keep seeking to the previous item.
-            compare = position
-            offset += 1  # noqa: SIM113
-
-        if page and not has_item_with_unique_position:
-            # There were no unique positions in the page.
-            if not has_next:
-                # We are on the final page.
-                # Our cursor will have an offset equal to the page size,
-                # but no position to filter against yet.
-                offset = limit
-                position = None
-            elif cursor.reverse:
-                # Use the position from the existing cursor and increment
-                # it's offset by the page size.
-                offset = cursor.offset + limit
-                position = next_position
-            else:
-                # The change in direction will introduce a paging artifact,
-                # where we end up skipping back a few extra items.
-                offset = 0
-                position = next_position
-
-        if not page:
-            position = previous_position
-
-        cursor = Cursor(offset=offset, reverse=True, position=position)
-        return self._encode_cursor(cursor, base_url)
-
-    def _apply_ordering(self, queryset, cursor, order):
-        if cursor.position is not None:
-            is_reversed = order[0].startswith("-")
-            order_attr = order[0].lstrip("-")
-
-            # The cursor "position" is user-controlled, so part of validation is ensuring it's
-            # parseable as the type of the ordering field (e.g. it's not a mangled datetime string).
-            try:
-                position = queryset.model._meta.get_field(order_attr).to_python(cursor.position)
-            except DjangoValidationError as e:
-                # match the message format of pydantic's rendering of a ValueError, which is
-                # how a cursor that fails to decode is reported
-                raise NinjaValidationError(
-                    [{"loc": ["query", "cursor"], "msg": "Value error, Invalid cursor."}]
-                ) from e
-
-            if cursor.reverse != is_reversed:
-                queryset = queryset.filter(**{f"{order_attr}__lt": position})
+        return _replace_query_param(base_url, "cursor", dump_cursor(cursor))
+
+    @staticmethod
+    def _invalid_cursor() -> NinjaValidationError:
+        # match the message format of pydantic's rendering of a ValueError, which is
+        # how a cursor that fails to decode is reported
+        return NinjaValidationError(
+            [{"loc": ["query", "cursor"], "msg": "Value error, Invalid cursor."}]
+        )
+
+    def _apply_ordering(self, queryset: QuerySet, cursor: Cursor, order: Sequence[str]):
+        """
+        Filter queryset down to the rows that fall after the cursor position.
+
+        The position has a value for every ordering field, the last being the primary key, so
+        the rows after it are those comparing lexicographically greater (or less, for descending
+        fields). When every field orders in the same direction this is a single row-value
+        comparison, e.g. ``(created, id) > (C, I)``, which postgres answers with one range scan
+        of an index on those fields. Mixed directions can't be expressed as a row-value
+        comparison, so e.g. ``(-pinned, created, id)`` is expanded into::
+
+            pinned < P
+            OR (pinned = P AND created > C)
+            OR (pinned = P AND created = C AND id > I)
+
+        The cursor position is validated here: a position that doesn't match the current
+        ordering (e.g. pin_sort was toggled), or a value that isn't parseable as its ordering
+        field's type, raises NinjaValidationError so the caller can surface it as a 400/422
+        rather than a 500.
+        """
+        if cursor.position is None:
+            return queryset
+
+        if len(cursor.position) != len(order):
+            raise self._invalid_cursor()
+
+        field_names = [field.lstrip("-") for field in order]
+
+        try:
+            positions = [
+                _coerce_position_value(_get_field(queryset.model, field_name), value)
+                for field_name, value in zip(field_names, cursor.position, strict=True)
+            ]
+        except (DjangoValidationError, TypeError, ValueError) as e:
+            raise self._invalid_cursor() from e
+
+        # whether the rows after the position are greater in each field, which is flipped for
+        # descending fields and again for reversed cursors.
+        greater = [field.startswith("-") == cursor.reverse for field in order]
+
+        if all(greater) or not any(greater):
+            lookup = TupleGreaterThan if greater[0] else TupleLessThan
+            return queryset.filter(lookup(Tuple(*[F(name) for name in field_names]), positions))
+
+        q_obj = Q()
+        for i, field_name in enumerate(field_names):
+            comparison = "__gt" if greater[i] else "__lt"
+            # Strict comparison on field i AND equality on every field before it.
+            field_condition = Q(**{f"{field_name}{comparison}": positions[i]})
+            for j in range(i):
+                field_condition &= Q(**{field_names[j]: positions[j]})
+
+            q_obj |= field_condition
+        return queryset.filter(q_obj)
+
+    def _get_position_from_instance(self, instance, ordering: Sequence[str]) -> tuple[Any, ...]:
+        values = []
+        for field in ordering:
+            field_name = field.lstrip("-")
+
+            if isinstance(instance, dict):
+                value = instance[field_name]
             else:
-                queryset = queryset.filter(**{f"{order_attr}__gt": position})
-        return queryset
+                value = instance
+                for part in field_name.split("__"):
+                    value = getattr(value, part)
 
-    def _get_position_from_instance(self, instance, ordering):
-        field_name = ordering[0].lstrip("-")
-        attr = instance[field_name] if isinstance(instance, dict) else getattr(instance, field_name)
-        return str(attr)
+            values.append(_position_value(value))
+        return tuple(values)
@@ -0,0 +1,56 @@
+"""
+Receivers which keep image visibility up to date.
+
+These are connected in CoreConfig.ready rather than in isic.core.models, since they depend on
+the models of isic.ingest, which import isic.core.models.
+"""
+
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from isic.core.models import Image, ImageVisibility
+from isic.core.models.image import ImageShare
+from isic.core.visibility import invalidate_visibility_context, invalidate_visibility_contexts
+from isic.ingest.models.contributor import Contributor
+
+
+@receiver(m2m_changed, sender=Contributor.owners.through)
+def invalidate_contributor_owner_visibility(
+    sender, instance: Contributor | User, action: str, reverse: bool, pk_set: set[int], **kwargs
+):
+    if reverse:
+        if action in ["post_add", "post_remove", "post_clear"]:
+            invalidate_visibility_context(instance)
+    elif action in ["post_add", "post_remove"]:
+        invalidate_visibility_contexts(pk_set)
+    elif action == "pre_clear":
+        invalidate_visibility_contexts(instance.owners.values_list("pk", flat=True))
+
+
+@receiver(m2m_changed, sender=Image.shares.through)
+def add_image_shares_visibility(
+    sender, instance: Image | User, action: str, reverse: bool, pk_set: set[int], **kwargs
+):
+    # removing shares deletes ImageShare rows, which is handled by delete_image_share_visibility.
+    if action != "post_add":
+        return
+
+    if reverse:
+        ImageVisibility.objects.add_shares(list(pk_set), [instance.pk])
+        invalidate_visibility_context(instance)
+    else:
+        ImageVisibility.objects.add_shares([instance.pk], list(pk_set))
+        invalidate_visibility_contexts(pk_set)
+
+
+@receiver(post_save, sender=ImageShare)
+def add_image_share_visibility(sender, instance: ImageShare, **kwargs):
+    ImageVisibility.objects.add_shares([instance.image_id], [instance.grantee_id])
+    invalidate_visibility_contexts([instance.grantee_id])
+
+
+@receiver(post_delete, sender=ImageShare)
+def delete_image_share_visibility(sender, instance: ImageShare, **kwargs):
+    ImageVisibility.objects.remove_shares([instance.image_id], [instance.grantee_id])
+    invalidate_visibility_contexts([instance.grantee_id])
@@ -1,29 +1,45 @@
-from collections.abc import Mapping
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from copy import deepcopy
+from datetime import UTC, datetime
 from functools import lru_cache
 import hashlib
+import itertools
 import logging
+import multiprocessing
+import re
 from typing import Any, override
 
+import django
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
 from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Prefetch
 from django.db.models.query import QuerySet
 from elastic_transport import Transport
 from elasticsearch import Elasticsearch, NotFoundError
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import bulk, expand_action
 from isic_metadata import FIELD_REGISTRY
 from isic_metadata.fields import ImageTypeEnum
 import sentry_sdk
 
-from isic.core.models import Image
+from isic.core.models import Image, SearchIndexUpdate
 from isic.core.models.collection import Collection
 from isic.core.permissions import get_visible_objects
+from isic.core.utils.cache import get_or_set_single_flight, mark_stale
+from isic.core.visibility import get_visibility_context
 from isic.ingest.models.accession import Accession
 from isic.ingest.models.lesion import Lesion
 
 logger = logging.getLogger(__name__)
 
+# how long invalidated search results can be served while they're being recomputed.
+STALE_SEARCH_CACHE_TIMEOUT = 60 * 10
+
+# set while a reindex is building new index generations, see reindex_search_indices.
+REINDEX_IN_PROGRESS_CACHE_KEY = "es-reindex-in-progress"
+
 IMAGE_INDEX_MAPPINGS: dict[str, Any] = {"properties": {}}
 DEFAULT_SEARCH_AGGREGATES = {}
 COUNTS_AGGREGATES = {}
@@ -45,6 +61,7 @@ IMAGE_INDEX_MAPPINGS["properties"].update(
         "isic_id": {"type": "keyword"},
         "copyright_license": {"type": "keyword"},
         "public": {"type": "boolean"},
+        "pinned": {"type": "integer"},
         "shared_to": {"type": "integer"},
         "blob_size": {"type": "integer"},
     }
@@ -98,7 +115,11 @@ class InstrumentedTransport(Transport):
 
     @staticmethod
     def _cache_key(method: str, target: str, body: Any) -> str:
-        return "es:" + hashlib.sha256(f"{method}:{target}:{body}".encode()).hexdigest()
+        # namespace the key by index so that invalidating one index doesn't discard the cached
+        # results of another, see invalidate_search_caches.
+        index = target.lstrip("/").split("/", 1)[0]
+        digest = hashlib.sha256(f"{method}:{target}:{body}".encode()).hexdigest()
+        return f"es:{index}:{digest}"
 
     @override
     def perform_request(
@@ -109,21 +130,18 @@ class InstrumentedTransport(Transport):
         body: Any = None,
         **kwargs: Any,
     ) -> Any:
-        is_cacheable = target.endswith(("/_count", "/_search"))
-
-        if is_cacheable:
-            cache_key = self._cache_key(method, target, body)
-            cached_result = cache.get(cache_key)
-            if cached_result:
-                return cached_result
+        def _perform_request() -> Any:
+            with sentry_sdk.start_span(op="es"):
+                return super(InstrumentedTransport, self).perform_request(
+                    method, target, body=body, **kwargs
+                )
 
-        with sentry_sdk.start_span(op="es"):
-            result = super().perform_request(method, target, body=body, **kwargs)
+        if not target.endswith(("/_count", "/_search")):
+            return _perform_request()
 
-        if is_cacheable:
-            cache.set(cache_key, result)
-
-        return result
+        # identical searches are coalesced so that a cold cache (e.g. after a sync) results in
+        # one query per distinct search rather than one per concurrent request.
+        return get_or_set_single_flight(self._cache_key(method, target, body), _perform_request)
 
 
 @lru_cache
@@ -142,12 +160,16 @@ def maybe_create_index(index: str, mappings: Mapping[str, Any]) -> None:
         get_elasticsearch_client().indices.create(index=index, mappings=mappings)
     else:
         # "indices" also contains "settings", which are unspecified by us, so only compare
-        # "mappings"
-        if indices[index]["mappings"] != mappings:
+        # "mappings". indices is keyed by the concrete index name, which differs from index
+        # when it's an alias to a versioned index.
+        if any(index_info["mappings"] != mappings for index_info in indices.values()):
             # Existing fields cannot be mutated.
             # TODO: It's possible to add new fields if none of the existing fields are modified.
             # https://www.elastic.co/docs/manage-data/data-store/mapping/update-mappings-examples
-            raise Exception(f'Cannot safely update existing index "{index}".')
+            raise Exception(
+                f'Cannot safely update existing index "{index}", '
+                "run populate_elasticsearch --reindex instead."
+            )
         # Otherwise, the index is up to date; nothing to be done.
 
 
@@ -175,25 +197,40 @@ def add_to_search_index(image: Image) -> None:
     )
 
 
+def _image_document_actions(qs: QuerySet[Image], chunk_size: int) -> Iterator[tuple[dict, str]]:
+    rows = qs.with_elasticsearch_document().order_by().values_list("pk", "elasticsearch_document")
+
+    for pk, document in rows.iterator(chunk_size=chunk_size):
+        yield {"index": {"_id": pk}}, document
+
+
 def bulk_add_to_search_index(
     index: str, qs: QuerySet[Image | Lesion], chunk_size: int = 2_000
 ) -> None:
     assert_index_exists(index)
 
-    # qs must be generated with with_elasticsearch_properties
-    # Use a generator for lazy evaluation
-    documents = (obj.to_elasticsearch_document() for obj in qs.iterator(chunk_size=chunk_size))
-
     # for whatever reason, bulk can't gracefully fail if the queryset is empty.
     if not qs.exists():
         return
 
+    if qs.model is Image:
+        # image documents are built by the database, which is much cheaper than building
+        # them from models.
+        actions: Iterable = _image_document_actions(qs, chunk_size)
+        expand_action_callback = _passthrough_action
+    else:
+        # qs must be generated with with_elasticsearch_properties
+        # Use a generator for lazy evaluation
+        actions = (obj.to_elasticsearch_document() for obj in qs.iterator(chunk_size=chunk_size))
+        expand_action_callback = expand_action
+
     # note we can't use parallel_bulk because the cachalot_disabled context manager
-    # is thread local.
+    # is thread local, see parallel_bulk_add_to_search_index.
     success, info = bulk(
         client=get_elasticsearch_client(),
         index=index,
-        actions=documents,
+        actions=actions,
+        expand_action_callback=expand_action_callback,
         # The default chunk_size is 2000, but that may be too many models to fit into memory.
         # Note the default chunk_size matches QuerySet.iterator
         chunk_size=chunk_size,
@@ -204,8 +241,406 @@ def bulk_add_to_search_index(
         logger.error("Failed to insert document into elasticsearch: %s", info)
 
 
+def _passthrough_action(action: tuple[dict, str]) -> tuple[dict, str]:
+    return action
+
+
+def _init_search_index_worker() -> None:
+    django.setup()
+
+
+def _bulk_add_pk_range_to_search_index(
+    index: str,
+    qs_factory: Callable[[], QuerySet[Image | Lesion]],
+    start: Any,
+    end: Any | None,
+    chunk_size: int,
+) -> None:
+    qs = qs_factory().filter(pk__gte=start)
+    if end is not None:
+        qs = qs.filter(pk__lt=end)
+
+    bulk_add_to_search_index(index, qs, chunk_size)
+
+
+def _pk_ranges(qs: QuerySet, range_size: int) -> list[tuple[Any, Any | None]]:
+    # lesion primary keys are strings, so the ranges are derived from the keys themselves
+    # rather than by dividing up the space between the minimum and maximum.
+    starts = list(
+        itertools.islice(
+            qs.order_by("pk").values_list("pk", flat=True).iterator(), 0, None, range_size
+        )
+    )
+    return list(zip(starts, [*starts[1:], None], strict=True))
+
+
+def parallel_bulk_add_to_search_index(  # noqa: PLR0913
+    index: str,
+    qs_factory: Callable[[], QuerySet[Image | Lesion]],
+    *,
+    concurrency: int,
+    range_size: int = 50_000,
+    max_retries: int = 3,
+    chunk_size: int = 2_000,
+) -> None:
+    """
+    Index the queryset returned by qs_factory with a pool of processes.
+
+    The primary keys are split into ranges which are indexed by separate processes, each with
+    their own database connection and elasticsearch client. This sidesteps cachalot_disabled
+    being thread local, see bulk_add_to_search_index. Failed ranges are retried up to
+    max_retries times.
+
+    qs_factory has to be a module level function so it can be sent to the worker processes.
+    Note that this can't be called from a celery task since celery workers are daemonic
+    processes, which can't have children.
+    """
+    if concurrency <= 1:
+        bulk_add_to_search_index(index, qs_factory(), chunk_size)
+        return
+
+    assert_index_exists(index)
+
+    ranges = _pk_ranges(qs_factory(), range_size)
+    attempts = dict.fromkeys(ranges, 0)
+    completed = 0
+
+    # spawn rather than fork so that the workers don't inherit the parent's connections
+    with ProcessPoolExecutor(
+        max_workers=concurrency,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_search_index_worker,
+    ) as executor:
+
+        def submit(pk_range: tuple[Any, Any | None]) -> None:
+            future = executor.submit(
+                _bulk_add_pk_range_to_search_index, index, qs_factory, *pk_range, chunk_size
+            )
+            pending[future] = pk_range
+
+        pending: dict = {}
+        for pk_range in ranges:
+            submit(pk_range)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                pk_range = pending.pop(future)
+
+                if exc := future.exception():
+                    attempts[pk_range] += 1
+
+                    if attempts[pk_range] > max_retries:
+                        executor.shutdown(cancel_futures=True)
+                        raise exc
+
+                    logger.warning(
+                        "Retrying indexing %s range %s (attempt %d).",
+                        index,
+                        pk_range,
+                        attempts[pk_range],
+                        exc_info=exc,
+                    )
+                    submit(pk_range)
+                else:
+                    completed += 1
+                    logger.info(
+                        "Indexed %s range %s (%d/%d).", index, pk_range, completed, len(ranges)
+                    )
+
+
+def images_for_search_index() -> QuerySet[Image]:
+    # the documents are built by bulk_add_to_search_index, so no properties are needed.
+    return Image.objects.all()
+
+
+def lesions_for_search_index() -> QuerySet[Lesion]:
+    return (
+        Lesion.objects
+        # only include lesions with images
+        .has_images()
+        # only look at published accessions
+        .prefetch_related(Prefetch("accessions", queryset=Accession.objects.published().order_by()))
+        # include elasticsearch properties for the images
+        .prefetch_related(
+            Prefetch(
+                "accessions__image",
+                queryset=Image.objects.with_elasticsearch_properties().order_by(),
+            )
+        )
+        .all()
+        .order_by()
+    )
+
+
+def sync_search_indices(*, concurrency: int = 1) -> None:
+    """Reindex every image and lesion into the live indices."""
+    # updates queued before this point are reflected by the full sync below. anything queued
+    # afterwards is left for sync_search_index_updates.
+    last_update_pk = SearchIndexUpdate.objects.aggregate(Max("pk"))["pk__max"]
+
+    parallel_bulk_add_to_search_index(
+        settings.ISIC_ELASTICSEARCH_IMAGES_INDEX, images_for_search_index, concurrency=concurrency
+    )
+    parallel_bulk_add_to_search_index(
+        settings.ISIC_ELASTICSEARCH_LESIONS_INDEX,
+        lesions_for_search_index,
+        concurrency=concurrency,
+    )
+
+    if last_update_pk is not None:
+        SearchIndexUpdate.objects.filter(pk__lte=last_update_pk).delete()
+
+    invalidate_search_caches()
+
+
+def _search_generation_cache_key(index: str) -> str:
+    return f"search-generation:{index}"
+
+
+def search_generation(index: str) -> int:
+    """
+    Return a number which changes whenever the documents of index change.
+
+    Caches keyed by it are invalidated by invalidate_search_caches without deleting them.
+    """
+    return cache.get_or_set(_search_generation_cache_key(index), 0, timeout=None)
+
+
+def _bump_search_generation(index: str) -> None:
+    key = _search_generation_cache_key(index)
+    cache.add(key, 0, timeout=None)
+    cache.incr(key)
+
+
+def invalidate_search_caches(*, images: bool = True, lesions: bool = True) -> None:
+    if images:
+        _bump_search_generation(settings.ISIC_ELASTICSEARCH_IMAGES_INDEX)
+
+    if lesions:
+        _bump_search_generation(settings.ISIC_ELASTICSEARCH_LESIONS_INDEX)
+
+    # hasattr is necessary because only the upstream django-redis has
+    # the ability to delete patterns.
+    if not hasattr(cache, "delete_pattern"):
+        return
+
+    # the previous values are kept to be served while the first request for each key
+    # recomputes it, see get_or_set_single_flight.
+    if images:
+        mark_stale("image_facets:*", STALE_SEARCH_CACHE_TIMEOUT)
+        mark_stale(f"es:{settings.ISIC_ELASTICSEARCH_IMAGES_INDEX}:*", STALE_SEARCH_CACHE_TIMEOUT)
+
+    if lesions:
+        mark_stale(f"es:{settings.ISIC_ELASTICSEARCH_LESIONS_INDEX}:*", STALE_SEARCH_CACHE_TIMEOUT)
+
+
+def queue_search_index_update(
+    *, qs: QuerySet[Image] | None = None, image: Image | None = None
+) -> None:
+    """
+    Mark the search documents of images as stale.
+
+    This should be called in the same transaction as the change which made the documents stale,
+    the documents are then reindexed by sync_elasticsearch_index_updates_task.
+    """
+    # is not None is necessary because qs could be an empty queryset
+    if qs is not None and image is not None:
+        raise ValueError("qs and image are mutually exclusive arguments.")
+
+    if qs is None and image is None:
+        raise ValueError("Either qs or image must be provided.")
+
+    if image:
+        qs = Image.objects.filter(pk=image.pk)
+
+    assert qs is not None  # noqa: S101
+
+    for image_pks in itertools.batched(
+        qs.order_by().values_list("pk", flat=True).iterator(), 5_000, strict=False
+    ):
+        SearchIndexUpdate.objects.bulk_create(
+            [SearchIndexUpdate(image_id=image_pk) for image_pk in image_pks]
+        )
+
+
+def sync_search_index_updates(batch_size: int = 2_000) -> int:
+    """
+    Reindex the images (and their lesions) with pending search index updates.
+
+    Returns the number of distinct images that were reindexed.
+    """
+    # updates are left in place while a reindex is running since writing them to the outgoing
+    # index generation would lose them. they're applied to the new generation once it's live.
+    if cache.get(REINDEX_IN_PROGRESS_CACHE_KEY):
+        return 0
+
+    total = 0
+
+    while True:
+        with transaction.atomic():
+            # skip_locked allows overlapping runs to work on disjoint batches rather than
+            # reindexing the same documents twice.
+            updates = list(
+                SearchIndexUpdate.objects.select_for_update(skip_locked=True)
+                .order_by("pk")
+                .values_list("pk", "image_id")[:batch_size]
+            )
+
+            if not updates:
+                break
+
+            image_pks = {image_pk for _, image_pk in updates}
+
+            bulk_add_to_search_index(
+                settings.ISIC_ELASTICSEARCH_IMAGES_INDEX,
+                Image.objects.filter(pk__in=image_pks),
+            )
+            bulk_add_to_search_index(
+                settings.ISIC_ELASTICSEARCH_LESIONS_INDEX,
+                lesions_for_search_index().filter(
+                    pk__in=Accession.objects.filter(image__in=image_pks)
+                    .exclude(lesion=None)
+                    .values("lesion_id")
+                ),
+            )
+
+            # only delete the rows that were reindexed, rows added since then are for changes
+            # that may not be reflected in the documents that were just written.
+            SearchIndexUpdate.objects.filter(pk__in=[pk for pk, _ in updates]).delete()
+
+        total += len(image_pks)
+
+    if total:
+        invalidate_search_caches()
+
+    return total
+
+
+def index_generations(alias: str) -> list[str]:
+    """Return the versioned indices created for alias, oldest first."""
+    pattern = re.compile(rf"{re.escape(alias)}-v\d+")
+    indices = get_elasticsearch_client().indices.get(index=f"{alias}-v*")
+    return sorted(name for name in indices if pattern.fullmatch(name))
+
+
+def reindex_search_index(
+    alias: str,
+    mappings: Mapping[str, Any],
+    qs_factory: Callable[[], QuerySet[Image | Lesion]],
+    *,
+    keep: int = 1,
+    concurrency: int = 1,
+) -> str:
+    """
+    Build a new generation of an index and atomically point alias at it.
+
+    The new index is bulk loaded without replicas or refreshes, which are restored once it's
+    loaded. All but the most recent keep generations preceding the new one are deleted, the
+    retained ones allow rolling back by moving the alias.
+
+    Returns the name of the new index.
+    """
+    es = get_elasticsearch_client()
+    generation = f"{alias}-v{datetime.now(tz=UTC):%Y%m%d%H%M%S%f}"
+
+    try:
+        live_settings = es.indices.get_settings(index=alias)
+    except NotFoundError:
+        # None resets the setting to the cluster default
+        replicas = None
+    else:
+        replicas = next(iter(live_settings.values()))["settings"]["index"]["number_of_replicas"]
+
+    # documents are only ever added, so the count before loading is a lower bound on what
+    # the new index should contain.
+    expected_count = qs_factory().order_by().count()
+
+    es.indices.create(
+        index=generation,
+        mappings=mappings,
+        settings={"number_of_replicas": 0, "refresh_interval": "-1"},
+    )
+
+    try:
+        parallel_bulk_add_to_search_index(generation, qs_factory, concurrency=concurrency)
+
+        es.indices.put_settings(
+            index=generation,
+            settings={"number_of_replicas": replicas, "refresh_interval": None},
+        )
+        es.indices.refresh(index=generation)
+
+        indexed_count = es.count(index=generation)["count"]
+        if indexed_count < expected_count:
+            raise Exception(
+                f'Index "{generation}" has {indexed_count} documents, '
+                f"expected at least {expected_count}."
+            )
+    except:
+        es.indices.delete(index=generation)
+        raise
+
+    actions: list[dict[str, Any]] = [{"add": {"index": generation, "alias": alias}}]
+
+    if es.indices.exists_alias(name=alias):
+        actions.extend(
+            {"remove": {"index": index, "alias": alias}}
+            for index in es.indices.get_alias(name=alias)
+        )
+    elif es.indices.exists(index=alias):
+        # the index predates versioned indices, it has to be removed in the same operation
+        # since an alias can't share a name with an index.
+        actions.append({"remove_index": {"index": alias}})
+
+    es.indices.update_aliases(actions=actions)
+
+    previous_generations = [name for name in index_generations(alias) if name != generation]
+    for name in previous_generations[: max(len(previous_generations) - keep, 0)]:
+        es.indices.delete(index=name)
+
+    return generation
+
+
+def reindex_search_indices(*, keep: int = 1, concurrency: int = 1) -> None:
+    """
+    Rebuild the image and lesion indices without search downtime.
+
+    Incremental updates are deferred while the new generations are built, changes made in the
+    meantime are applied to the new generations by the next sync_search_index_updates.
+    """
+    cache.set(REINDEX_IN_PROGRESS_CACHE_KEY, value=True, timeout=60 * 60 * 12)
+
+    try:
+        reindex_search_index(
+            settings.ISIC_ELASTICSEARCH_IMAGES_INDEX,
+            IMAGE_INDEX_MAPPINGS,
+            images_for_search_index,
+            keep=keep,
+            concurrency=concurrency,
+        )
+        reindex_search_index(
+            settings.ISIC_ELASTICSEARCH_LESIONS_INDEX,
+            LESION_INDEX_MAPPINGS,
+            lesions_for_search_index,
+            keep=keep,
+            concurrency=concurrency,
+        )
+    finally:
+        cache.delete(REINDEX_IN_PROGRESS_CACHE_KEY)
+
+    invalidate_search_caches()
+
+
 def _prettify_facets(facets: dict[str, Any]) -> dict[str, Any]:
     """Perform some post-processing on the facets to make UI rendering easier."""
+    # fold the sibling present/absent count aggregations into the metadata of each facet
+    for field in DEFAULT_SEARCH_AGGREGATES:
+        facets[field]["meta"] = {
+            "missing_count": facets.pop(f"{field}_missing")["doc_count"],
+            "present_count": facets.pop(f"{field}_present")["value"],
+        }
 
     def _strip_superfluous_fields(facets: dict[str, dict]) -> dict[str, dict]:
         for value in facets.values():
@@ -245,31 +680,19 @@ def facets(query: dict | None = None) -> dict:
     """
     Generate the facet counts for a given query.
 
-    This has to perform 2 elasticsearch queries, one for computing the present/absent
-    counts for each facet, and another for generating the buckets themselves.
+    The present/absent counts for each facet are computed by sibling aggregations in the same
+    query as the buckets, see _prettify_facets.
     """
-    counts = get_elasticsearch_client().search(
-        index=settings.ISIC_ELASTICSEARCH_IMAGES_INDEX,
-        size=0,
-        aggs=COUNTS_AGGREGATES,
-        query=query,
-    )["aggregations"]
-
     aggs = deepcopy(DEFAULT_SEARCH_AGGREGATES)
 
-    # pass the counts through as metadata in the final aggregation query
-    # https://www.elastic.co/docs/explore-analyze/query-filter/aggregations#add-metadata-to-an-agg
-    for field, agg in aggs.items():
-        agg["meta"] = {
-            "missing_count": counts[f"{field}_missing"]["doc_count"],
-            "present_count": counts[f"{field}_present"]["value"],
-        }
-
-        # for term fields (non-ranges), show all facet values even if this query has no
-        # matching documents.
+    # for term fields (non-ranges), show all facet values even if this query has no
+    # matching documents.
+    for agg in aggs.values():
         if "terms" in agg:
             agg["terms"]["min_doc_count"] = 0
 
+    aggs.update(COUNTS_AGGREGATES)
+
     return _prettify_facets(
         get_elasticsearch_client().search(
             index=settings.ISIC_ELASTICSEARCH_IMAGES_INDEX,
@@ -321,18 +744,13 @@ def build_elasticsearch_query(
 
         # the logic below of generalizing the query parameters to avoid user-specific data
         # is identical to the logic in ImagePermissions.view_image_list.
-        if user.owned_contributors.exists():
-            query_dict["bool"]["should"].append(
-                {
-                    "terms": {
-                        "contributor_owner_ids": list(
-                            user.owned_contributors.order_by().values_list("id", flat=True)
-                        )
-                    }
-                }
-            )
+        visibility = get_visibility_context(user)
+
+        if visibility.contributor_ids:
+            # documents store the ids of the users who own the contributor, not of the contributor
+            query_dict["bool"]["should"].append({"terms": {"contributor_owner_ids": [user.pk]}})
 
-        if user.image_shares_received.exists():
+        if visibility.has_shares:
             query_dict["bool"]["should"].append({"terms": {"shared_to": [user.pk]}})
 
         return query_dict
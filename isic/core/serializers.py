@@ -1,19 +1,21 @@
 from __future__ import annotations
 
+import contextlib
 from hashlib import sha1
 import json
-from typing import TYPE_CHECKING, cast
+from typing import TYPE_CHECKING
 
 from django.contrib.auth.models import AnonymousUser, User
 from django.shortcuts import get_object_or_404
 from ninja import Schema
 from pydantic import field_validator
 
-from isic.core.dsl import es_parser, parse_query
+from isic.core.dsl import ParseException, canonical_query, canonicalize, es_parser
 from isic.core.models import Image
 from isic.core.models.collection import Collection
 from isic.core.permissions import get_visible_objects
 from isic.core.search import build_elasticsearch_query
+from isic.core.visibility import get_visibility_context
 
 if TYPE_CHECKING:
     from isic.core.models.image import ImageQuerySet
@@ -59,9 +61,19 @@ class SearchQueryIn(Schema):
     def to_cache_key(self, user=None):
         token = self.to_token_representation(user)
 
+        if self.query:
+            # equivalent queries share a cache key, invalid queries are keyed as they are
+            # since they won't be cached.
+            with contextlib.suppress(ParseException):
+                token["query"] = canonical_query(self.query)
+
         if user is not None:
-            # let staff users share the same cache representation
-            token["user"] = "staff" if user.is_staff else user.pk
+            if self.collections:
+                # collection visibility isn't captured by the visibility context
+                token["user"] = "staff" if user.is_staff else user.pk
+            else:
+                # let users who can see the same images share the same cache representation
+                token["user"] = get_visibility_context(user).cache_key
 
         return sha1(json.dumps(token, sort_keys=True).encode()).hexdigest()  # noqa: S324
 
@@ -80,21 +92,23 @@ class SearchQueryIn(Schema):
             qs = qs.from_search_query(self.query)
 
         if self.collections:
+            # images in multiple of the collections would be duplicated by a join
             qs = qs.filter(
-                collections__in=get_visible_objects(
-                    user,
-                    "core.view_collection",
-                    Collection.objects.filter(pk__in=self.collections),
-                )
+                pk__in=Collection.images.through.objects.filter(
+                    collection__in=get_visible_objects(
+                        user,
+                        "core.view_collection",
+                        Collection.objects.filter(pk__in=self.collections),
+                    )
+                ).values("image_id")
             )
 
-        return get_visible_objects(user, "core.view_image", qs).distinct()
+        return get_visible_objects(user, "core.view_image", qs)
 
     def to_es_query(self, user: User | AnonymousUser) -> dict:
         es_query: dict | None = None
         if self.query:
-            # we know it can't be a Q object because we're using es_parser and not django_parser
-            es_query = cast("dict | None", parse_query(es_parser, self.query))
+            es_query = es_parser(canonicalize(self.query))
 
         return build_elasticsearch_query(
             es_query or {},
@@ -1,14 +1,36 @@
 from collections.abc import Generator
+from dataclasses import dataclass
 from functools import reduce
+import io
 import operator
 from typing import Any, cast
 
-from django.db.models import F, Func
+from django.db import connection
+from django.db.models import (
+    BooleanField,
+    Case,
+    CharField,
+    Expression,
+    F,
+    Field,
+    ForeignKey,
+    Func,
+    Q,
+    TextField,
+    Value,
+    When,
+)
 from django.db.models.aggregates import Count
+from django.db.models.functions import Concat, NullIf
+from django.db.models.lookups import Exact, StartsWith
 from django.db.models.query import QuerySet
 
 from isic.core.models.image import Image
-from isic.ingest.models.accession import Accession
+from isic.core.utils.csv import FORBIDDEN_LEADING_CHARS, EscapingDictWriter
+from isic.ingest.models.accession import Accession, ComputedMetadataField
+
+# the size of the chunks yielded by image_metadata_csv_copy, which holds many rows
+COPY_CHUNK_SIZE = 64 * 1024
 
 
 class JsonKeys(Func):
@@ -140,12 +162,15 @@ def staff_image_metadata_csv(*, qs: QuerySet[Image]) -> Generator[list[str] | di
         yield value
 
 
-def image_metadata_csv(*, qs: QuerySet[Image]) -> tuple[list[str], Generator[dict[str, Any]]]:
-    """
-    Generate the fieldnames and rows of a CSV of image metadata for non-staff users.
+@dataclass(frozen=True)
+class _ImageMetadataColumns:
+    fieldnames: list[str]
+    # the accession columns which are selected as is
+    columns: list[str]
+    computed_fields: list[ComputedMetadataField]
 
-    The fieldnames are computed eagerly, and the rows are a generator.
-    """
+
+def _image_metadata_columns(qs: QuerySet[Image]) -> _ImageMetadataColumns:
     initial_headers = ["isic_id", "attribution", "copyright_license"]
 
     accession_qs = Accession.objects.filter(image__in=qs)
@@ -175,7 +200,20 @@ def image_metadata_csv(*, qs: QuerySet[Image]) -> tuple[list[str], Generator[dic
         used_metadata_keys.remove(computed_field.input_field_name)
         used_metadata_keys += computed_field.output_field_names
 
-    fieldnames = initial_headers + sorted(used_metadata_keys)
+    return _ImageMetadataColumns(
+        fieldnames=initial_headers + sorted(used_metadata_keys),
+        columns=used_metadata_columns + used_remapped_columns,
+        computed_fields=used_computed_fields,
+    )
+
+
+def image_metadata_csv(*, qs: QuerySet[Image]) -> tuple[list[str], Generator[dict[str, Any]]]:
+    """
+    Generate the fieldnames and rows of a CSV of image metadata for non-staff users.
+
+    The fieldnames are computed eagerly, and the rows are a generator.
+    """
+    columns = _image_metadata_columns(qs)
 
     def rows() -> Generator[dict[str, Any]]:
         # Note this uses .values because populating django ORM objects is very slow, and doing
@@ -188,17 +226,14 @@ def image_metadata_csv(*, qs: QuerySet[Image]) -> tuple[list[str], Generator[dic
                 "isic_id",
                 attribution=F("accession__attribution"),
                 copyright_license=F("accession__copyright_license"),
-                **{
-                    key: F(f"accession__{key}")
-                    for key in used_metadata_columns + used_remapped_columns
-                },
+                **{key: F(f"accession__{key}") for key in columns.columns},
             )
             .iterator()
         ):
             # Strip the TypedDict, since we're about to change some fields
             row = cast("dict[str, Any]", image)
 
-            for computed_field in used_computed_fields:
+            for computed_field in columns.computed_fields:
                 input_value = row.pop(computed_field.input_field_name)
                 if input_value:
                     computed_values = computed_field.transformer(input_value)
@@ -207,4 +242,85 @@ def image_metadata_csv(*, qs: QuerySet[Image]) -> tuple[list[str], Generator[dic
 
             yield row
 
-    return fieldnames, rows()
+    return columns.fieldnames, rows()
+
+
+def _csv_value(expression: Expression, field: Field) -> Expression:
+    """Format the value of a field as EscapingDictWriter would write it."""
+    if isinstance(field, ForeignKey):
+        field = field.target_field
+
+    if isinstance(field, BooleanField):
+        return Case(
+            When(Exact(expression, Value(True)), then=Value("True")),
+            When(Exact(expression, Value(False)), then=Value("False")),
+        )
+
+    if isinstance(field, CharField | TextField):
+        # COPY quotes empty strings to tell them apart from nulls, which csv doesn't
+        return Case(
+            When(
+                Q(
+                    *[StartsWith(expression, char) for char in FORBIDDEN_LEADING_CHARS],
+                    _connector=Q.OR,
+                ),
+                then=Concat(Value("\t"), expression),
+            ),
+            default=NullIf(expression, Value("")),
+            output_field=field,
+        )
+
+    return expression
+
+
+def image_metadata_csv_copy(*, qs: QuerySet[Image]) -> Generator[bytes]:
+    """
+    Generate the same CSV as image_metadata_csv, including the header, as chunks of bytes.
+
+    The rows are formatted by postgres with COPY rather than by python, which is several times
+    faster for large querysets. The CSV is identical to what EscapingDictWriter writes with the
+    exception of a value which is only a backslash and a period, which COPY quotes.
+    """
+    columns = _image_metadata_columns(qs)
+
+    header = io.StringIO()
+    EscapingDictWriter(header, columns.fieldnames).writeheader()
+    yield header.getvalue().encode()
+
+    expressions = {
+        # isic ids never need to be escaped
+        "isic_id": F("isic_id"),
+        **{
+            key: _csv_value(F(f"accession__{key}"), Accession._meta.get_field(key))
+            for key in ["attribution", "copyright_license", *columns.columns]
+        },
+    }
+    for computed_field in columns.computed_fields:
+        expressions.update(
+            computed_field.expressions(F(f"accession__{computed_field.input_field_name}"))
+        )
+
+    # the aliases can't clash with the names of fields, and the select is in the order of the
+    # annotations, which is the order of the fieldnames. the first is the isic_id, which is
+    # ordered by its alias so that a distinct queryset doesn't select it a second time.
+    aliases = {f"csv_{i}": expressions[key] for i, key in enumerate(columns.fieldnames)}
+    sql, params = (
+        qs.annotate(**aliases).order_by("csv_0").values_list(*aliases).query.sql_with_params()
+    )
+
+    chunk = bytearray()
+    with (
+        connection.cursor() as cursor,
+        cursor.copy(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv)", params) as copy,
+    ):
+        # COPY sends one row at a time, terminated by \n where csv uses \r\n
+        for row in copy:
+            chunk += row[:-1]
+            chunk += b"\r\n"
+
+            if len(chunk) >= COPY_CHUNK_SIZE:
+                yield bytes(chunk)
+                chunk.clear()
+
+    if chunk:
+        yield bytes(chunk)
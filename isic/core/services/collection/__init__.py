@@ -8,6 +8,7 @@ from django.db.models.query_utils import Q
 
 from isic.core.models.collection import Collection, CollectionShare
 from isic.core.models.doi import Doi, DraftDoi
+from isic.core.search import queue_search_index_update
 from isic.core.services.collection.image import move_collection_images
 from isic.core.services.image import share_image
 from isic.studies.models import Study
@@ -64,7 +65,9 @@ def delete_collection(*, collection: Collection, ignore_lock: bool = False) -> N
     if hasattr(collection, "draftdoi"):
         raise ValidationError("Collections with draft DOIs cannot be deleted.")
 
-    collection.delete()
+    with transaction.atomic():
+        queue_search_index_update(qs=collection.images.all())
+        collection.delete()
 
 
 def get_collection_creators_in_attribution_order(*, collection: Collection) -> list[str]:
@@ -250,8 +250,11 @@ def create_collection_doi_files(*, doi: AbstractDoi) -> None:
     collection = doi.collection
     collection_slug = slugify(collection.name)
 
-    snapshot_filename, metadata_filename = snapshot_images(
+    bundle_field = doi._meta.get_field("bundle")
+    snapshot = snapshot_images(
         qs=collection.images.select_related("accession"),
+        storage=bundle_field.storage,
+        name=bundle_field.generate_filename(doi, f"{collection_slug}.zip"),
         supplemental_files=doi.supplemental_files.all(),
     )
 
@@ -262,19 +265,18 @@ def create_collection_doi_files(*, doi: AbstractDoi) -> None:
         # serialize" error. see
         # https://www.postgresql.org/docs/current/transaction-iso.html#XACT-REPEATABLE-READ
         with (
-            Path(snapshot_filename).open("rb") as bundle_file,
-            Path(metadata_filename).open("rb") as metadata_file,
+            Path(snapshot.metadata_filename).open("rb") as metadata_file,
             transaction.atomic(),  # necessary for select_for_update
         ):
             doi = doi.__class__.objects.select_for_update().get(id=doi.id)
-            doi.bundle = File(bundle_file, name=f"{collection_slug}.zip")
-            doi.bundle_size = Path(snapshot_filename).stat().st_size
+            # the bundle is uploaded while it's being written, so only its name is saved here
+            doi.bundle = snapshot.name
+            doi.bundle_size = snapshot.size
             doi.metadata = File(metadata_file, name=f"{collection_slug}.csv")
             doi.metadata_size = Path(metadata_file.name).stat().st_size
             doi.save()
     finally:
-        Path(snapshot_filename).unlink()
-        Path(metadata_filename).unlink()
+        Path(snapshot.metadata_filename).unlink()
 
 
 def publish_draft_doi(*, user: User, draft_doi: DraftDoi) -> Doi:
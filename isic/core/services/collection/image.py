@@ -8,6 +8,7 @@ from django.db.models.query import QuerySet
 from isic.core.models.collection import Collection, CollectionShare
 from isic.core.models.image import Image
 from isic.core.permissions import get_visible_objects
+from isic.core.search import queue_search_index_update
 from isic.core.services.image import share_image
 
 
@@ -43,6 +44,8 @@ def add_images_to_collection(
                 ignore_conflicts=True,
             )
 
+        queue_search_index_update(qs=qs)
+
         # adding images to a collection that's shared with a user should implicitly share the
         # images with that user.
         for share_collection in CollectionShare.objects.filter(collection=collection).all():
@@ -70,6 +73,8 @@ def move_collection_images(
     with transaction.atomic():
         CollectionImageM2M = Collection.images.through  # noqa: N806
 
+        queue_search_index_update(qs=src_collection.images.all())
+
         # first remove the images from the source collection that are already in the
         # destination collection to avoid unique constraint violations.
         CollectionImageM2M.objects.filter(
@@ -99,7 +104,10 @@ def remove_images_from_collection(
     if collection.locked and not ignore_lock:
         raise ValidationError("Can't remove images from a locked collection.")
 
-    Collection.images.through.objects.filter(collection=collection, image__in=qs).delete()
+    with transaction.atomic():
+        # queue before deleting, since qs may be relative to the collection's images
+        queue_search_index_update(qs=qs)
+        Collection.images.through.objects.filter(collection=collection, image__in=qs).delete()
 
 
 def add_collection_images_from_isic_ids(
@@ -1,12 +1,31 @@
+from collections import defaultdict
+from collections.abc import Iterable
 import itertools
+from typing import TYPE_CHECKING
 
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, User
 from django.db import transaction
 from django.db.models import QuerySet
 
-from isic.core.models import Image, IsicId
+from isic.core.models import Image, ImageEmbedding, ImageVisibility, IsicId
+from isic.core.models.image_embedding import MAX_EF_SEARCH
+from isic.core.permissions import get_visible_objects
+from isic.core.search import queue_search_index_update
+from isic.core.services.image.neighbor import IMAGE_NEIGHBORS_COUNT, get_image_neighbors
+from isic.core.visibility import invalidate_visibility_context
 from isic.ingest.models.accession import Accession
 
+if TYPE_CHECKING:
+    from django.core.files.storage import Storage
+
+# the number of neighbors fetched per similar image requested, so that images which are
+# filtered out by permissions can usually be replaced without searching again.
+SIMILAR_IMAGES_OVERFETCH = 2
+SIMILAR_IMAGES_MAX_CANDIDATES = 1_000
+# the number of binary embeddings shortlisted per candidate, before they're ranked by the
+# distance of their full embeddings.
+SIMILAR_IMAGES_SHORTLIST_FACTOR = 10
+
 
 def create_image(*, creator: User, accession: Accession, public: bool) -> Image:
     from isic.core.services.iptc import embed_iptc_metadata_for_image
@@ -19,6 +38,8 @@ def create_image(*, creator: User, accession: Accession, public: bool) -> Image:
 
         embed_iptc_metadata_for_image(image)
 
+        queue_search_index_update(image=image)
+
         return image
 
 
@@ -50,3 +71,86 @@ def share_image(
                 ],
                 ignore_conflicts=True,
             )
+            ImageVisibility.objects.add_shares([image.pk for image in image_batch], [grantee.pk])
+
+        # bulk_create doesn't send the signals which would otherwise do this
+        invalidate_visibility_context(grantee)
+        queue_search_index_update(qs=qs)
+
+
+def sign_image_file_urls(images: Iterable[Image]) -> None:
+    """
+    Sign the urls of the files of many images at once.
+
+    Storages which sign urls in bulk cache the signatures, so serializing the images afterwards
+    reuses them rather than signing each file separately.
+    """
+    names_by_storage: dict[Storage, list[str]] = defaultdict(list)
+
+    for image in images:
+        for file in [image.blob, image.thumbnail_256]:
+            if file:
+                names_by_storage[file.storage].append(file.name)
+
+    for storage, names in names_by_storage.items():
+        if hasattr(storage, "urls"):
+            storage.urls(names)
+
+
+def find_similar_images(
+    *,
+    image: Image,
+    user: User | AnonymousUser,
+    limit: int,
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> list[Image]:
+    """
+    Find the images nearest to image which are visible to user, annotated with their distance.
+
+    Images with precomputed neighbors are served from them, see compute_image_neighbors. The
+    neighbors of other images are shortlisted with an approximate search of the binary
+    embeddings and ranked by the distance of their full embeddings, before being filtered by
+    permissions. If too many are filtered out, the search is repeated with twice as many
+    candidates until enough are visible or there are no more candidates.
+    """
+    if not image.has_embedding:
+        return []
+
+    if image.embedding_relation.neighbors_computed and limit <= IMAGE_NEIGHBORS_COUNT:
+        return get_image_neighbors(image=image, user=user, limit=limit)
+
+    candidates = min(limit * SIMILAR_IMAGES_OVERFETCH, SIMILAR_IMAGES_MAX_CANDIDATES)
+
+    while True:
+        neighbors = ImageEmbedding.objects.exclude(image_id=image.pk).nearest(
+            image.embedding_relation.embedding,
+            candidates,
+            ef_search=ef_search,
+            probes=probes,
+            shortlist=min(candidates * SIMILAR_IMAGES_SHORTLIST_FACTOR, MAX_EF_SEARCH),
+        )
+        visible_images = get_visible_objects(
+            user,
+            "core.view_image",
+            Image.objects.select_related("accession__cohort").filter(
+                pk__in=[image_id for image_id, _ in neighbors]
+            ),
+        ).in_bulk()
+
+        if (
+            len(visible_images) >= limit
+            or len(neighbors) < candidates
+            or candidates >= SIMILAR_IMAGES_MAX_CANDIDATES
+        ):
+            break
+
+        candidates = min(candidates * 2, SIMILAR_IMAGES_MAX_CANDIDATES)
+
+    similar_images = []
+    for image_id, distance in neighbors:
+        if image_id in visible_images:
+            visible_images[image_id].distance = distance
+            similar_images.append(visible_images[image_id])
+
+    return similar_images[:limit]
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING
+
+from django.db import transaction
+from django.db.models import F
+
+from isic.core.models import Image, ImageEmbedding, ImageNeighbor
+from isic.core.models.image_embedding import MAX_EF_SEARCH
+from isic.core.permissions import get_visible_objects
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import AnonymousUser, User
+
+# the number of neighbors stored per image, which bounds the limit of similar images that can
+# be served from ImageNeighbor.
+IMAGE_NEIGHBORS_COUNT = 100
+
+
+def compute_image_neighbors(batch_size: int = 100, max_seconds: float | None = None) -> int:
+    """
+    Compute the neighbors of the images whose embeddings haven't been processed yet.
+
+    Each image is also inserted into the neighbors of its own neighbors, replacing their
+    farthest, so the neighbors of existing images include images added after them without
+    being recomputed. Since nearest neighbors aren't symmetric this can miss an image which
+    is near an existing image without the existing image being near it.
+
+    No batches are started after max_seconds, which leaves the rest to a later call.
+
+    Returns the number of images processed.
+    """
+    total = 0
+    deadline = None if max_seconds is None else time.monotonic() + max_seconds
+
+    while True:
+        with transaction.atomic():
+            # skip_locked allows overlapping runs to work on disjoint batches
+            pending = list(
+                ImageEmbedding.objects.select_for_update(skip_locked=True)
+                .filter(neighbors_computed=False)
+                .order_by("pk")
+                .values_list("image_id", "embedding")[:batch_size]
+            )
+
+            if not pending:
+                break
+
+            image_ids = [image_id for image_id, _ in pending]
+            neighbors = []
+
+            for image_id, embedding in pending:
+                for neighbor_id, distance in ImageEmbedding.objects.exclude(
+                    image_id=image_id
+                ).nearest(embedding, IMAGE_NEIGHBORS_COUNT, shortlist=MAX_EF_SEARCH):
+                    # cosine distance is symmetric, so both directions are known
+                    neighbors.append(
+                        ImageNeighbor(image_id=image_id, neighbor_id=neighbor_id, distance=distance)
+                    )
+                    neighbors.append(
+                        ImageNeighbor(image_id=neighbor_id, neighbor_id=image_id, distance=distance)
+                    )
+
+            ImageNeighbor.objects.filter(image_id__in=image_ids).delete()
+            ImageNeighbor.objects.bulk_create(neighbors, batch_size=5_000, ignore_conflicts=True)
+            ImageNeighbor.objects.trim(
+                {neighbor.image_id for neighbor in neighbors}, IMAGE_NEIGHBORS_COUNT
+            )
+            ImageEmbedding.objects.filter(image_id__in=image_ids).update(neighbors_computed=True)
+
+        total += len(pending)
+
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+
+    return total
+
+
+def get_image_neighbors(*, image: Image, user: User | AnonymousUser, limit: int) -> list[Image]:
+    """Return the precomputed neighbors of image which are visible to user, nearest first."""
+    qs = (
+        Image.objects.select_related("accession__cohort")
+        .filter(nearest_to__image=image)
+        .annotate(distance=F("nearest_to__distance"))
+        .order_by("distance")
+    )
+    return list(get_visible_objects(user, "core.view_image", qs)[:limit])
@@ -1,70 +1,558 @@
+from __future__ import annotations
+
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from dataclasses import dataclass, replace
+from datetime import UTC, datetime, timedelta
+import io
+import json
+from pathlib import Path, PurePosixPath
 import tempfile
+import time
+from typing import TYPE_CHECKING, NamedTuple
 import zipfile
+import zlib
 
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
 from django.db import connection, transaction
-from django.db.models import QuerySet
+from django.db.models import TextField, Value
+from django.db.models.functions import MD5, Cast, Concat
 from django.template.loader import render_to_string
 
+from isic.core.jobs import MultipartUpload
 from isic.core.models import Image, SupplementalFile
-from isic.core.services import image_metadata_csv
-from isic.core.utils.csv import EscapingDictWriter
+from isic.core.services import image_metadata_csv_copy
+from isic.core.utils.http import ChunkReader, ChunkSink
 from isic.zip_download.api import get_attributions
 
+if TYPE_CHECKING:
+    from collections.abc import Generator, Iterable, Iterator
+
+    from django.core.files.storage import Storage
+    from django.db.models import QuerySet
+    from django.db.models.fields.files import FieldFile
+
+    from isic.core.models import Job
+
 CHUNK_SIZE = 5 * 1024 * 1024  # 5MB
 
+# the number of blobs fetched concurrently, and the number which can be fetched ahead of the
+# entry being written. this bounds the memory used to the size of the largest blobs.
+SNAPSHOT_CONCURRENCY = 8
+SNAPSHOT_PREFETCH = SNAPSHOT_CONCURRENCY * 2
+
+# entries which are already compressed aren't worth compressing again
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".zip", ".gz"}
+
+ARCHIVE_SNAPSHOT_KEY = "snapshots/ISIC_images.zip"
+# the full snapshot is written here first, so that the previous one stays available while it's
+# being rebuilt.
+ARCHIVE_SNAPSHOT_PARTIAL_KEY = "snapshots/ISIC_images.zip.partial"
+ARCHIVE_MANIFEST_KEY = "snapshots/ISIC_images.manifest.csv"
+ARCHIVE_DELTA_PREFIX = "snapshots/deltas/"
+ARCHIVE_DELTA_KEY = ARCHIVE_DELTA_PREFIX + "ISIC_images-{timestamp}.zip"
+ARCHIVE_DELTA_TIMESTAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+# mirrors which fall further behind than this have to start again from the full snapshot,
+# which is rebuilt weekly.
+ARCHIVE_DELTA_RETENTION = timedelta(weeks=5)
+
+# the size of the parts of a resumable snapshot. s3 allows 10,000 parts, which bounds the zip
+# to 640GB.
+ARCHIVE_PART_SIZE = 64 * 1024 * 1024
+# the seconds between the checkpoints of a resumable snapshot. each checkpoint stores every
+# entry of the zip so far, so they're taken sparingly.
+ARCHIVE_CHECKPOINT_INTERVAL = 10 * 60
+
+# the attributes of ZipInfo which are bytes, and are stored as hex in checkpoints
+_ZINFO_BYTES_ATTRIBUTES = {"comment", "extra"}
+
+
+class ManifestEntry(NamedTuple):
+    blob: str
+    # the etag of the blob, which changes whenever the blob is rewritten
+    checksum: str
+    size: int
+    # a digest of the public metadata, attribution, and license, which are in metadata.csv
+    metadata_digest: str
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    name: str
+    size: int
+    # a temporary file which the caller is responsible for deleting
+    metadata_filename: str
+
+
+def _compress_type(filename: str) -> int:
+    if PurePosixPath(filename).suffix.lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+
+    return zipfile.ZIP_DEFLATED
+
+
+def _read_blob(blob: FieldFile) -> bytes:
+    with blob.open("rb") as f:
+        return f.read()
+
+
+def _prefetch_blobs(images: Iterable[Image]) -> Generator[tuple[Image, bytes]]:
+    """Fetch the blobs of images concurrently, yielding them in the order of images."""
+    with ThreadPoolExecutor(max_workers=SNAPSHOT_CONCURRENCY) as executor:
+        pending = deque()
+
+        for image in images:
+            pending.append((image, executor.submit(_read_blob, image.blob)))
+
+            if len(pending) >= SNAPSHOT_PREFETCH:
+                prefetched, future = pending.popleft()
+                yield prefetched, future.result()
+
+        for prefetched, future in pending:
+            yield prefetched, future.result()
+
+
+def _open_zip(sink: ChunkSink, entries: list[zipfile.ZipInfo] | None = None) -> zipfile.ZipFile:
+    """
+    Open a zip which is written to sink.
+
+    entries are the entries which were already written before the position of sink, which
+    are needed to write the central directory at the end of the zip.
+    """
+    # the sink can't be seeked, so zipfile writes the sizes of entries after their data
+    bundle = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED)
+
+    if entries:
+        bundle.filelist = entries
+        bundle.NameToInfo = {zinfo.filename: zinfo for zinfo in entries}
+
+    return bundle
+
+
+def _zip_entries_checkpoint(entries: list[zipfile.ZipInfo]) -> str:
+    states = [
+        {
+            attribute: value.hex() if attribute in _ZINFO_BYTES_ATTRIBUTES else value
+            for attribute in zipfile.ZipInfo.__slots__
+            if (value := getattr(zinfo, attribute, None)) is not None
+        }
+        for zinfo in entries
+    ]
+    # the entries of a full snapshot take tens of megabytes as json, but compress well
+    return base64.b64encode(zlib.compress(json.dumps(states).encode())).decode()
+
+
+def _zip_entries_from_checkpoint(checkpoint: str) -> list[zipfile.ZipInfo]:
+    entries = []
+
+    for state in json.loads(zlib.decompress(base64.b64decode(checkpoint))):
+        zinfo = zipfile.ZipInfo(state["filename"])
+
+        for attribute, value in state.items():
+            if attribute in _ZINFO_BYTES_ATTRIBUTES:
+                setattr(zinfo, attribute, bytes.fromhex(value))
+            elif attribute == "date_time":
+                zinfo.date_time = tuple(value)
+            else:
+                setattr(zinfo, attribute, value)
+
+        entries.append(zinfo)
+
+    return entries
+
+
+def _image_chunks(
+    bundle: zipfile.ZipFile, sink: ChunkSink, images: Iterable[Image]
+) -> Iterator[tuple[Image, bytes]]:
+    """Write the entries of images, yielding the chunk of each along with the image."""
+    for image, blob in _prefetch_blobs(images):
+        filename = f"images/{image.isic_id}.{image.extension}"
+        bundle.writestr(filename, blob, compress_type=_compress_type(filename))
+        yield image, sink.take()
+
+
+def _trailer_chunks(  # noqa: PLR0913
+    bundle: zipfile.ZipFile,
+    sink: ChunkSink,
+    qs: QuerySet[Image],
+    supplemental_files: QuerySet[SupplementalFile],
+    metadata_filename: str,
+    extra_entries: dict[str, str],
+) -> Iterator[bytes]:
+    """Write the entries which follow the images of qs, other than the central directory."""
+    bundle.write(metadata_filename, "metadata.csv")
+    yield sink.take()
+
+    for license_ in qs.values_list("accession__copyright_license", flat=True).order_by().distinct():
+        bundle.writestr(
+            f"licenses/{license_}.txt",
+            render_to_string(f"zip_download/{license_}.txt"),
+        )
+
+    attributions = get_attributions(qs.values_list("accession__attribution", flat=True))
+    bundle.writestr("attribution.txt", "\n\n".join(attributions))
+    yield sink.take()
+
+    for filename, content in extra_entries.items():
+        bundle.writestr(filename, content)
+        yield sink.take()
+
+    for supplemental_file in supplemental_files.iterator():
+        zinfo = zipfile.ZipInfo(
+            f"supplements/{supplemental_file.filename}", date_time=time.localtime()[:6]
+        )
+        zinfo.compress_type = _compress_type(supplemental_file.filename)
+
+        with (
+            supplemental_file.blob.open("rb") as blob,
+            bundle.open(zinfo, "w", force_zip64=True) as zip_file,
+        ):
+            while chunk := blob.read(CHUNK_SIZE):
+                zip_file.write(chunk)
+                yield sink.take()
+
+
+def _snapshot_chunks(
+    qs: QuerySet[Image],
+    supplemental_files: QuerySet[SupplementalFile],
+    metadata_filename: str,
+    extra_entries: dict[str, str],
+) -> Iterator[bytes]:
+    sink = ChunkSink()
+
+    with _open_zip(sink) as bundle:
+        for _, chunk in _image_chunks(bundle, sink, qs.iterator()):
+            yield chunk
+
+        yield from _trailer_chunks(
+            bundle, sink, qs, supplemental_files, metadata_filename, extra_entries
+        )
+
+    yield sink.take()
+
+
+def _write_metadata_csv(qs: QuerySet[Image]) -> str:
+    # the metadata csv could be large enough that it needs to be written to disk first
+    with tempfile.NamedTemporaryFile("wb", delete=False) as metadata_file:
+        for chunk in image_metadata_csv_copy(qs=qs):
+            metadata_file.write(chunk)
+
+    return metadata_file.name
+
 
 def snapshot_images(
-    *, qs: QuerySet[Image], supplemental_files: QuerySet[SupplementalFile] | None = None
-) -> tuple[str, str]:
+    *,
+    qs: QuerySet[Image],
+    storage: Storage,
+    name: str,
+    supplemental_files: QuerySet[SupplementalFile] | None = None,
+    extra_entries: dict[str, str] | None = None,
+) -> Snapshot:
+    """
+    Write a zip of images, their metadata, licenses, and attributions to storage.
+
+    The zip is streamed to storage as it's written, so it's never on local disk and only a
+    bounded number of blobs are in memory at once. Blobs are fetched concurrently.
+    """
     with transaction.atomic():
         cursor = connection.cursor()
         cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
 
         qs = qs.select_related("accession").all()
+        metadata_filename = _write_metadata_csv(qs)
 
-        with (
-            tempfile.NamedTemporaryFile("wb", delete=False) as snapshot_file,
-            zipfile.ZipFile(snapshot_file, "w") as bundle,
-        ):
-            for image in qs.iterator():
-                with image.blob.open("rb") as blob:
-                    bundle.writestr(f"images/{image.isic_id}.{image.extension}", blob.read())
-
-            # the metadata csv could be large enough that it needs to be written to disk first
-            with tempfile.NamedTemporaryFile("w", delete=False) as metadata_file:
-                fieldnames, collection_metadata = image_metadata_csv(qs=qs)
-                writer = EscapingDictWriter(metadata_file, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in collection_metadata:
-                    writer.writerow(row)
-                metadata_file.flush()
-
-                bundle.write(metadata_file.name, "metadata.csv")
-
-            for license_ in (
-                qs.values_list("accession__copyright_license", flat=True).order_by().distinct()
-            ):
-                bundle.writestr(
-                    f"licenses/{license_}.txt",
-                    render_to_string(f"zip_download/{license_}.txt"),
+        supplemental_files = (
+            supplemental_files
+            if supplemental_files is not None
+            else SupplementalFile.objects.none()
+        )
+        reader = ChunkReader(
+            _snapshot_chunks(qs, supplemental_files, metadata_filename, extra_entries or {})
+        )
+        # uploads read in full parts, which the chunks of single entries don't line up with
+        saved_name = storage.save(name, File(io.BufferedReader(reader, CHUNK_SIZE), name=name))
+
+        return Snapshot(name=saved_name, size=reader.size, metadata_filename=metadata_filename)
+
+
+def snapshot_images_with_checkpoints(
+    *,
+    qs: QuerySet[Image],
+    storage_alias: str,
+    name: str,
+    job: Job,
+    extra_entries: dict[str, str] | None = None,
+) -> Snapshot:
+    """
+    Write a zip of images like snapshot_images, as a multipart upload which can be resumed.
+
+    The upload, the zip's entries, and the last image written are checkpointed on job after
+    parts, so a later attempt of the job continues the zip after that image. Everything after
+    the images is written by the attempt which finishes them. The name of the first attempt is
+    kept by later ones.
+
+    Unlike snapshot_images, the images aren't read in a single transaction since checkpoints
+    need to be committed as they're taken.
+    """
+    checkpoint = job.checkpoint
+    qs = qs.select_related("accession").all()
+    images = qs.order_by("isic_id")
+
+    if checkpoint:
+        upload = MultipartUpload.from_checkpoint(checkpoint["upload"])
+
+        if upload.completed:
+            # the zip was written but the caller didn't finish
+            return Snapshot(
+                name=upload.name,
+                size=checkpoint["position"],
+                metadata_filename=_write_metadata_csv(qs),
+            )
+
+        sink = ChunkSink(checkpoint["position"])
+        entries = _zip_entries_from_checkpoint(checkpoint["entries"])
+        images = images.filter(isic_id__gt=checkpoint["after"])
+    else:
+        upload = MultipartUpload.create(storage_alias, name)
+        sink = ChunkSink()
+        entries = []
+        # the upload is recorded right away so that it's aborted if the job fails
+        job.save_checkpoint(
+            processed=0,
+            upload=upload.to_checkpoint(),
+            position=0,
+            entries=_zip_entries_checkpoint(entries),
+            after="",
+        )
+
+    job.total = job.processed + images.count()
+    job.save(update_fields=["total", "modified"])
+
+    processed = job.processed
+    metadata_filename = _write_metadata_csv(qs)
+    buffer = bytearray()
+    checkpointed_at = time.monotonic()
+
+    with _open_zip(sink, entries) as bundle:
+        for image, chunk in _image_chunks(bundle, sink, images.iterator()):
+            buffer += chunk
+            processed += 1
+
+            # parts end with an entry, so that the zip can be resumed after any of them
+            if len(buffer) >= ARCHIVE_PART_SIZE:
+                upload.upload_part(bytes(buffer))
+                buffer.clear()
+
+                if time.monotonic() - checkpointed_at >= ARCHIVE_CHECKPOINT_INTERVAL:
+                    job.save_checkpoint(
+                        processed=processed,
+                        upload=upload.to_checkpoint(),
+                        position=sink.tell(),
+                        entries=_zip_entries_checkpoint(bundle.filelist),
+                        after=image.isic_id,
+                    )
+                    checkpointed_at = time.monotonic()
+
+        trailer = _trailer_chunks(
+            bundle,
+            sink,
+            qs,
+            SupplementalFile.objects.none(),
+            metadata_filename,
+            extra_entries or {},
+        )
+
+        for chunk in trailer:
+            buffer += chunk
+
+            if len(buffer) >= ARCHIVE_PART_SIZE:
+                upload.upload_part(bytes(buffer))
+                buffer.clear()
+
+    buffer += sink.take()
+    upload.upload_part(bytes(buffer))
+    upload.complete()
+    job.save_checkpoint(processed=processed, upload=upload.to_checkpoint(), position=sink.tell())
+
+    return Snapshot(name=upload.name, size=sink.tell(), metadata_filename=metadata_filename)
+
+
+def build_snapshot_manifest(qs: QuerySet[Image], storage: Storage) -> dict[str, ManifestEntry]:
+    """
+    Return the manifest entry of each of the public images of qs, keyed by ISIC ID.
+
+    Checksums come from listing the stored blobs rather than reading them.
+    """
+    objects = {name: (etag, size) for name, etag, size in storage.list_objects("images/")}
+    manifest = {}
+
+    for isic_id, blob, metadata_digest in (
+        qs.annotate(
+            metadata_digest=MD5(
+                Concat(
+                    # jsonb renders keys in a consistent order
+                    Cast("public_metadata", TextField()),
+                    Value("\n"),
+                    "accession__attribution",
+                    Value("\n"),
+                    "accession__copyright_license",
+                    output_field=TextField(),
                 )
+            )
+        )
+        .values_list("isic_id", "accession__sponsored_blob", "metadata_digest")
+        .iterator()
+    ):
+        checksum, size = objects.get(blob, ("", 0))
+        manifest[isic_id] = ManifestEntry(
+            blob=blob, checksum=checksum, size=size, metadata_digest=metadata_digest
+        )
+
+    return manifest
+
+
+def read_snapshot_manifest(storage: Storage, name: str) -> dict[str, ManifestEntry] | None:
+    """Return the manifest of the previous run, or None if there isn't one in this format."""
+    if not storage.exists(name):
+        return None
+
+    with storage.open(name, "rb") as f:
+        reader = csv.DictReader(io.TextIOWrapper(f, encoding="utf-8"))
+
+        # the entries of an older manifest can't be compared with the current ones
+        if reader.fieldnames != ["isic_id", *ManifestEntry._fields]:
+            return None
 
-            attributions = get_attributions(qs.values_list("accession__attribution", flat=True))
-            bundle.writestr("attribution.txt", "\n\n".join(attributions))
+        return {
+            row["isic_id"]: ManifestEntry(
+                blob=row["blob"],
+                checksum=row["checksum"],
+                size=int(row["size"]),
+                metadata_digest=row["metadata_digest"],
+            )
+            for row in reader
+        }
+
+
+def _manifest_csv(manifest: dict[str, ManifestEntry]) -> str:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["isic_id", *ManifestEntry._fields])
+    for isic_id, entry in sorted(manifest.items()):
+        writer.writerow([isic_id, *entry])
+    return output.getvalue()
+
+
+def prune_archive_deltas(storage: Storage, *, older_than: timedelta) -> int:
+    """Delete the deltas which were written more than older_than ago, returning the count."""
+    cutoff = datetime.now(tz=UTC) - older_than
+    deleted = 0
+
+    for name, _, _ in list(storage.list_objects(ARCHIVE_DELTA_PREFIX)):
+        try:
+            written = datetime.strptime(
+                PurePosixPath(name).stem.removeprefix("ISIC_images-"),
+                ARCHIVE_DELTA_TIMESTAMP_FORMAT,
+            ).replace(tzinfo=UTC)
+        except ValueError:
+            # not a delta written by update_archive_snapshot
+            continue
+
+        if written < cutoff:
+            storage.delete(name)
+            deleted += 1
+
+    return deleted
+
+
+def _write_archive_snapshot(
+    qs: QuerySet[Image], name: str, extra_entries: dict[str, str], job: Job | None
+) -> Snapshot:
+    if job is None:
+        return snapshot_images(
+            qs=qs, storage=storages["sponsored"], name=name, extra_entries=extra_entries
+        )
+
+    return snapshot_images_with_checkpoints(
+        qs=qs, storage_alias="sponsored", name=name, job=job, extra_entries=extra_entries
+    )
+
+
+def update_archive_snapshot(*, full: bool = False, job: Job | None = None) -> Snapshot | None:
+    """
+    Update the snapshot of all public images.
+
+    The manifest of the images is compared with the manifest of the previous run, and a delta
+    zip is written with only the images whose blob or metadata were added or changed. It
+    includes the full manifest and a removed.txt of the ISIC IDs which are no longer public, so
+    that mirrors can sync from the previous run. The full snapshot is also rebuilt when
+    requested, which is done weekly, or when there's no previous manifest. Deltas older than
+    ARCHIVE_DELTA_RETENTION are pruned.
+
+    The full snapshot, or the delta if only a delta is written, is written with checkpoints on
+    job if one is given, see snapshot_images_with_checkpoints.
 
-            supplemental_files = (
-                supplemental_files
-                if supplemental_files is not None
-                else SupplementalFile.objects.none()
+    Returns the full snapshot if it was rebuilt, otherwise the delta, or None if nothing
+    changed.
+    """
+    storage = storages["sponsored"]
+    qs = Image.objects.public()
+
+    manifest = build_snapshot_manifest(qs, storage)
+    manifest_csv = _manifest_csv(manifest)
+    previous = read_snapshot_manifest(storage, ARCHIVE_MANIFEST_KEY)
+    rebuild = full or previous is None
+    snapshot = None
+
+    if rebuild:
+        # left behind by a run which failed, unless this is a later attempt of the job which
+        # is resuming it
+        if (job is None or not job.checkpoint) and storage.exists(ARCHIVE_SNAPSHOT_PARTIAL_KEY):
+            storage.delete(ARCHIVE_SNAPSHOT_PARTIAL_KEY)
+
+        snapshot = _write_archive_snapshot(
+            qs, ARCHIVE_SNAPSHOT_PARTIAL_KEY, {"manifest.csv": manifest_csv}, job
+        )
+
+        # an earlier attempt of the job could have moved it already
+        if storage.exists(snapshot.name):
+            storage.move(snapshot.name, ARCHIVE_SNAPSHOT_KEY)
+
+        snapshot = replace(snapshot, name=ARCHIVE_SNAPSHOT_KEY)
+
+    # full runs write a delta too, so that mirrors syncing from deltas don't miss a run
+    if previous is not None:
+        changed = [isic_id for isic_id, entry in manifest.items() if previous.get(isic_id) != entry]
+        removed = sorted(previous.keys() - manifest.keys())
+
+        if changed or removed:
+            delta_qs = qs.filter(isic_id__in=changed)
+            delta_name = ARCHIVE_DELTA_KEY.format(
+                timestamp=datetime.now(tz=UTC).strftime(ARCHIVE_DELTA_TIMESTAMP_FORMAT)
             )
-            for supplemental_file in supplemental_files.iterator():
-                with (
-                    supplemental_file.blob.open("rb") as blob,
-                    bundle.open(f"supplements/{supplemental_file.filename}", "w") as zip_file,
-                ):
-                    chunk = blob.read(CHUNK_SIZE)
-                    while chunk:
-                        zip_file.write(chunk)
-                        chunk = blob.read(CHUNK_SIZE)
-
-        return snapshot_file.name, metadata_file.name
+            delta_entries = {"manifest.csv": manifest_csv, "removed.txt": "\n".join(removed)}
+
+            if rebuild:
+                # the checkpoints of job belong to the full snapshot
+                delta = snapshot_images(
+                    qs=delta_qs, storage=storage, name=delta_name, extra_entries=delta_entries
+                )
+                Path(delta.metadata_filename).unlink()
+            else:
+                snapshot = _write_archive_snapshot(delta_qs, delta_name, delta_entries, job)
+
+    prune_archive_deltas(storage, older_than=ARCHIVE_DELTA_RETENTION)
+
+    if snapshot is None:
+        return None
+
+    if storage.exists(ARCHIVE_MANIFEST_KEY):
+        storage.delete(ARCHIVE_MANIFEST_KEY)
+
+    storage.save(ARCHIVE_MANIFEST_KEY, ContentFile(manifest_csv.encode()))
+
+    return snapshot
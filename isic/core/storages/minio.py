@@ -1,15 +1,86 @@
+from collections.abc import Iterator
 from datetime import timedelta
 import io
+import mimetypes
 from urllib.parse import quote
 
 import boto3
 from botocore.exceptions import ClientError
+from minio.commonconfig import ComposeSource
+from minio.datatypes import Part
 from minio_storage import MinioMediaStorage
 
 from isic.core.storages import PreventRenamingMixin
 
+# the size of the parts of uploads of unknown size
+STREAMING_PART_SIZE = 16 * 1024 * 1024
+
 
 class IsicMinioMediaStorage(PreventRenamingMixin, MinioMediaStorage):
+    def _save(self, name: str, content) -> str:
+        # minio needs the size of the content up front, unless it's uploaded in parts. content
+        # which can't be seeked is streamed, see snapshot_images.
+        if content.seekable():
+            return super()._save(name, content)
+
+        sane_name = self._sanitize_path(name)
+        self.client.put_object(
+            self.bucket_name,
+            sane_name,
+            content,
+            -1,
+            mimetypes.guess_type(name, strict=False)[0] or "application/octet-stream",
+            metadata=self.object_metadata,
+            part_size=STREAMING_PART_SIZE,
+        )
+        return sane_name
+
+    def list_objects(self, prefix: str) -> Iterator[tuple[str, str, int]]:
+        """Yield the name, etag, and size of each object whose name starts with prefix."""
+        for obj in self.client.list_objects(self.bucket_name, prefix=prefix, recursive=True):
+            yield obj.object_name, obj.etag.strip('"'), obj.size
+
+    def move(self, old_name: str, new_name: str) -> None:
+        """Move an object, replacing the object at new_name without it ever being missing."""
+        # unlike copy_object, compose_object copies objects larger than 5GB in parts
+        self.client.compose_object(
+            self.bucket_name,
+            self._sanitize_path(new_name),
+            [ComposeSource(self.bucket_name, self._sanitize_path(old_name))],
+        )
+        self.delete(old_name)
+
+    # multipart uploads whose state is kept by the caller, so they can be resumed by another
+    # process. see MultipartUpload. minio only exposes these through private methods.
+
+    def create_multipart_upload(self, name: str) -> str:
+        content_type = mimetypes.guess_type(name, strict=False)[0] or "application/octet-stream"
+        return self.client._create_multipart_upload(  # noqa: SLF001
+            self.bucket_name,
+            self._sanitize_path(name),
+            {"Content-Type": content_type, **(self.object_metadata or {})},
+        )
+
+    def upload_part(self, name: str, upload_id: str, part_number: int, data: bytes) -> str:
+        return self.client._upload_part(  # noqa: SLF001
+            self.bucket_name, self._sanitize_path(name), data, None, upload_id, part_number
+        )
+
+    def complete_multipart_upload(
+        self, name: str, upload_id: str, parts: list[tuple[int, str]]
+    ) -> None:
+        self.client._complete_multipart_upload(  # noqa: SLF001
+            self.bucket_name,
+            self._sanitize_path(name),
+            upload_id,
+            [Part(number, etag) for number, etag in parts],
+        )
+
+    def abort_multipart_upload(self, name: str, upload_id: str) -> None:
+        self.client._abort_multipart_upload(  # noqa: SLF001
+            self.bucket_name, self._sanitize_path(name), upload_id
+        )
+
     def unsigned_url(self, name: str) -> str:
         def strip_beg(path):
             while path.startswith("/"):
@@ -1,11 +1,16 @@
+from collections.abc import Iterable, Iterator
 from datetime import UTC, datetime, timedelta
+import hashlib
 from urllib.parse import urlencode
 
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.encoding import filepath_to_uri
 from storages.backends.s3 import S3StaticStorage, S3Storage
 from storages.utils import clean_name
 
 from isic.core.storages import PreventRenamingMixin
+from isic.core.utils.cache import LRUCache
 
 
 class S3UnsignedUrlMixin:
@@ -14,13 +19,97 @@ class S3UnsignedUrlMixin:
         return f"https://{self.bucket_name}.s3.{self.region_name}.amazonaws.com/{name}"
 
 
-class CacheableCloudFrontStorage(PreventRenamingMixin, S3Storage, S3UnsignedUrlMixin):
+class S3ObjectsMixin:
+    def list_objects(self, prefix: str) -> Iterator[tuple[str, str, int]]:
+        """Yield the name, etag, and size of each object whose name starts with prefix."""
+        for obj in self.bucket.objects.filter(Prefix=self._normalize_name(clean_name(prefix))):
+            yield obj.key, obj.e_tag.strip('"'), obj.size
+
+    def move(self, old_name: str, new_name: str) -> None:
+        """Move an object, replacing the object at new_name without it ever being missing."""
+        # copies of large objects are done in parts on the server
+        self.bucket.Object(self._normalize_name(clean_name(new_name))).copy(
+            {"Bucket": self.bucket_name, "Key": self._normalize_name(clean_name(old_name))}
+        )
+        self.delete(old_name)
+
+    # multipart uploads whose state is kept by the caller, so they can be resumed by another
+    # process. see MultipartUpload.
+
+    def create_multipart_upload(self, name: str) -> str:
+        return self.bucket.meta.client.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(clean_name(name)),
+            **self._get_write_parameters(name),
+        )["UploadId"]
+
+    def upload_part(self, name: str, upload_id: str, part_number: int, data: bytes) -> str:
+        return self.bucket.meta.client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(clean_name(name)),
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )["ETag"]
+
+    def complete_multipart_upload(
+        self, name: str, upload_id: str, parts: list[tuple[int, str]]
+    ) -> None:
+        self.bucket.meta.client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(clean_name(name)),
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [{"PartNumber": number, "ETag": etag} for number, etag in parts]
+            },
+        )
+
+    def abort_multipart_upload(self, name: str, upload_id: str) -> None:
+        self.bucket.meta.client.abort_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(clean_name(name)),
+            UploadId=upload_id,
+        )
+
+
+def _signed_url_cache_key(url: str, expiration: datetime) -> str:
+    digest = hashlib.sha256(url.encode()).hexdigest()
+    return f"signed-url:{int(expiration.timestamp())}:{digest}"
+
+
+class CacheableCloudFrontStorage(
+    PreventRenamingMixin, S3Storage, S3UnsignedUrlMixin, S3ObjectsMixin
+):
+    # the number of signed urls kept by each process, this should be at least the number of
+    # urls in the largest response (two per image).
+    signed_url_cache_size = 20_000
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._signed_urls = LRUCache(self.signed_url_cache_size)
+
     @staticmethod
     def next_expiration_time(now=None):
         # returns a time > 6 days but <= 7.
         now = now or datetime.now(tz=UTC)
         return now.replace(second=0, microsecond=0, minute=0, hour=0) + timedelta(days=7)
 
+    @property
+    def _signs_urls(self) -> bool:
+        return bool(self.custom_domain and self.querystring_auth and self.cloudfront_signer)
+
+    def _custom_domain_url(self, name: str, parameters: dict | None = None) -> str:
+        # Preserve the trailing slash after normalizing the path.
+        name = self._normalize_name(clean_name(name))
+        params = parameters.copy() if parameters else {}
+
+        return "{}//{}/{}{}".format(
+            self.url_protocol,
+            self.custom_domain,
+            filepath_to_uri(name),
+            f"?{urlencode(params)}" if params else "",
+        )
+
     # This is copied from upstream with minor modifications, subclassing in a cleaner way wasn't
     # possible.
     def url(self, name, parameters=None, expire=None, http_method=None) -> str:
@@ -29,26 +118,88 @@ class CacheableCloudFrontStorage(PreventRenamingMixin, S3Storage, S3UnsignedUrlM
         if expire is not None or http_method is not None:
             return super().url(name, parameters=parameters, expire=expire, http_method=http_method)
 
-        # Preserve the trailing slash after normalizing the path.
-        name = self._normalize_name(clean_name(name))
-        params = parameters.copy() if parameters else {}
-
         if self.custom_domain:
-            url = "{}//{}/{}{}".format(
-                self.url_protocol,
-                self.custom_domain,
-                filepath_to_uri(name),
-                f"?{urlencode(params)}" if params else "",
-            )
+            url = self._custom_domain_url(name, parameters)
 
-            if self.querystring_auth and self.cloudfront_signer:
-                expiration = self.next_expiration_time()
-                return self.cloudfront_signer.generate_presigned_url(url, date_less_than=expiration)
+            if self._signs_urls:
+                return self._sign_urls([url])[url]
 
             return url
 
         return super().url(name, parameters=parameters, expire=expire, http_method=http_method)
 
+    def urls(self, names: Iterable[str]) -> dict[str, str]:
+        """
+        Return the urls of many files, keyed by name.
+
+        This signs every url which isn't cached in one pass, and checks the shared cache with a
+        single round trip, which is much cheaper than calling url for each file.
+        """
+        if not self._signs_urls:
+            return {name: self.url(name) for name in names}
+
+        unsigned_urls = {name: self._custom_domain_url(name) for name in names}
+        signed_urls = self._sign_urls(unsigned_urls.values())
+        return {name: signed_urls[url] for name, url in unsigned_urls.items()}
+
+    def _sign_urls(self, urls: Iterable[str]) -> dict[str, str]:
+        """
+        Sign urls to expire at the end of the current expiration window, reusing signatures.
+
+        The expiration time only changes once a day, so a url signed within a day is identical
+        to every other signature of it that day. Signatures are cached by url and expiration time
+        in process, then in the shared cache when ISIC_SIGNED_URL_SHARED_CACHE is set, since an
+        RSA signature is far more expensive than looking one up.
+        """
+        now = datetime.now(tz=UTC)
+        expiration = self.next_expiration_time(now)
+
+        signed_urls: dict[str, str] = {}
+        unsigned_urls: list[str] = []
+
+        for url in dict.fromkeys(urls):
+            signed_url = self._signed_urls.get((url, expiration))
+
+            if signed_url is None:
+                unsigned_urls.append(url)
+            else:
+                signed_urls[url] = signed_url
+
+        if unsigned_urls and settings.ISIC_SIGNED_URL_SHARED_CACHE:
+            urls_by_key = {_signed_url_cache_key(url, expiration): url for url in unsigned_urls}
+
+            for key, signed_url in cache.get_many(urls_by_key).items():
+                signed_urls[urls_by_key[key]] = signed_url
+                self._signed_urls.set((urls_by_key[key], expiration), signed_url)
+
+            unsigned_urls = [url for url in unsigned_urls if url not in signed_urls]
+
+        if unsigned_urls:
+            newly_signed_urls = {
+                url: self.cloudfront_signer.generate_presigned_url(url, date_less_than=expiration)
+                for url in unsigned_urls
+            }
+
+            for url, signed_url in newly_signed_urls.items():
+                self._signed_urls.set((url, expiration), signed_url)
+
+            if settings.ISIC_SIGNED_URL_SHARED_CACHE:
+                # the window ends when the next expiration time changes, at midnight.
+                window_end = expiration - timedelta(days=6)
+                cache.set_many(
+                    {
+                        _signed_url_cache_key(url, expiration): signed_url
+                        for url, signed_url in newly_signed_urls.items()
+                    },
+                    timeout=max(int((window_end - now).total_seconds()), 1),
+                )
+
+            signed_urls.update(newly_signed_urls)
+
+        return signed_urls
+
 
-class IsicS3StaticStorage(PreventRenamingMixin, S3StaticStorage, S3UnsignedUrlMixin):
+class IsicS3StaticStorage(
+    PreventRenamingMixin, S3StaticStorage, S3UnsignedUrlMixin, S3ObjectsMixin
+):
     pass
@@ -1,6 +1,6 @@
 from datetime import UTC, datetime, timedelta
+import io
 from pathlib import Path
-import tempfile
 from typing import Literal, cast
 import uuid
 
@@ -10,11 +10,9 @@ from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.core.cache import cache
-from django.core.files.storage import default_storage, storages
+from django.core.files.storage import storages
 from django.core.mail import send_mail
-from django.db import connection, transaction
-from django.db.models import Prefetch
+from django.db import connection
 from django.template.loader import render_to_string
 from oauth2_provider.models import clear_expired as clear_expired_oauth_tokens
 from resonant_utils.storages import expiring_url
@@ -22,9 +20,18 @@ from urllib3.exceptions import ConnectionError as Urllib3ConnectionError
 from urllib3.exceptions import TimeoutError as Urllib3TimeoutError
 
 from isic.core.health import run_all_health_checks
+from isic.core.jobs import (
+    JOB_RUNNING_RETRY_DELAY,
+    MULTIPART_UPLOAD_MIN_PART_SIZE,
+    JobRunningError,
+    MultipartUpload,
+    job_key,
+    prune_jobs,
+    run_job,
+)
 from isic.core.models.collection import Collection
 from isic.core.models.image import Image
-from isic.core.search import bulk_add_to_search_index
+from isic.core.search import sync_search_index_updates, sync_search_indices
 from isic.core.serializers import SearchQueryIn
 from isic.core.services import staff_image_metadata_csv
 from isic.core.services.collection import share_collection
@@ -32,10 +39,9 @@ from isic.core.services.collection.image import (
     add_collection_images_from_isic_ids,
     add_images_to_collection,
 )
-from isic.core.services.snapshot import snapshot_images
+from isic.core.services.image.neighbor import compute_image_neighbors
+from isic.core.services.snapshot import update_archive_snapshot
 from isic.core.utils.csv import EscapingDictWriter
-from isic.ingest.models.accession import Accession
-from isic.ingest.models.lesion import Lesion
 from isic.ingest.services.publish import embed_iptc_metadata
 
 logger = get_task_logger(__name__)
@@ -110,69 +116,119 @@ def share_collection_with_users_task(
     queue="es-indexing",
 )
 def sync_elasticsearch_indices_task():
-    bulk_add_to_search_index(
-        settings.ISIC_ELASTICSEARCH_IMAGES_INDEX, Image.objects.with_elasticsearch_properties()
-    )
-
-    bulk_add_to_search_index(
-        settings.ISIC_ELASTICSEARCH_LESIONS_INDEX,
-        Lesion.objects
-        # only include lesions with images
-        .has_images()
-        # only look at published accessions
-        .prefetch_related(Prefetch("accessions", queryset=Accession.objects.published().order_by()))
-        # include elasticsearch properties for the images
-        .prefetch_related(
-            Prefetch(
-                "accessions__image",
-                queryset=Image.objects.with_elasticsearch_properties().order_by(),
-            )
-        )
-        .all()
-        .order_by(),
-    )
-
-    # hasattr is necessary because only the upstream django-redis has
-    # the ability to delete patterns.
-    if hasattr(cache, "delete_pattern"):
-        cache.delete_pattern("get_facets:*")
-        cache.delete_pattern("es:*")
-
-
-@shared_task(soft_time_limit=1800, time_limit=1810)
-def generate_staff_image_list_metadata_csv_task(user_id: int) -> None:
-    user = User.objects.get(pk=user_id, is_staff=True)
+    sync_search_indices()
 
-    with tempfile.NamedTemporaryFile(mode="w", delete=False) as f, transaction.atomic():
-        # use repeatable read for the headers and rows to make sure they match
-        cursor = connection.cursor()
-        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
 
-        qs = Image.objects.all()
-        image_csv = staff_image_metadata_csv(qs=qs)
-        writer = EscapingDictWriter(f, next(image_csv))
-        writer.writeheader()
+@shared_task(
+    soft_time_limit=600,
+    time_limit=610,
+    autoretry_for=(Urllib3ConnectionError, Urllib3TimeoutError),
+    retry_backoff=True,
+    retry_backoff_max=600,
+    retry_kwargs={"max_retries": 3},
+    queue="es-indexing",
+)
+def sync_elasticsearch_index_updates_task():
+    reindexed = sync_search_index_updates()
 
-        for metadata_row in image_csv:
-            # the generator returns a narrowed type after the first element
-            metadata_row = cast("dict[str, str | bool | float]", metadata_row)
-            writer.writerow(metadata_row)
+    if reindexed:
+        logger.info("Reindexed %d images with pending search index updates.", reindexed)
 
-    current_time = datetime.now(tz=UTC).strftime("%Y-%m-%d")
-    csv_filename = f"isic_image_metadata_{current_time}.csv"
-    storage_key = f"staff-metadata-csvs/{uuid.uuid4()}/{csv_filename}"
 
-    with Path(f.name).open("rb") as csv_file:
-        default_storage.save(storage_key, csv_file)
+@shared_task(soft_time_limit=600, time_limit=610)
+def compute_image_neighbors_task():
+    # runs are scheduled every 5 minutes, so a backlog is worked through by successive runs
+    # rather than by one run which exceeds its time limit. see the compute_image_neighbors
+    # command for working through a large backlog at once.
+    computed = compute_image_neighbors(max_seconds=4 * 60)
 
-    signed_url = expiring_url(default_storage, storage_key, timedelta(days=1))
+    if computed:
+        logger.info("Computed the neighbors of %d images.", computed)
 
-    message = render_to_string(
-        "core/email/image_list_metadata_csv_generated.txt", {"csv_url": signed_url}
-    )
-    send_mail("Metadata CSV Ready", message, settings.DEFAULT_FROM_EMAIL, [user.email])
 
-    Path(f.name).unlink()
+@shared_task(
+    bind=True,
+    soft_time_limit=1800,
+    time_limit=1810,
+    acks_late=True,
+    reject_on_worker_lost=True,
+    # another attempt of the job is running, e.g. because the message outlived the broker's
+    # consumer_timeout. it's tried again until that attempt finishes or dies.
+    autoretry_for=(JobRunningError,),
+    default_retry_delay=JOB_RUNNING_RETRY_DELAY.total_seconds(),
+    max_retries=None,
+)
+def generate_staff_image_list_metadata_csv_task(self, user_id: int) -> None:
+    user = User.objects.get(pk=user_id, is_staff=True)
+    qs = Image.objects.all()
+
+    # the task id is the same when the task is redelivered, so it's resumed from the last part
+    # which was uploaded.
+    with run_job(job_key(self), total=qs.count()) as job:
+        if job.status == job.Status.SUCCEEDED:
+            return
+
+        checkpoint = job.checkpoint
+        upload = MultipartUpload.from_checkpoint(checkpoint["upload"]) if checkpoint else None
+
+        if upload is None or not upload.completed:
+            if upload is not None:
+                fieldnames = checkpoint["fieldnames"]
+                qs = qs.filter(isic_id__gt=checkpoint["after"])
+            else:
+                current_time = datetime.now(tz=UTC).strftime("%Y-%m-%d")
+                csv_filename = f"isic_image_metadata_{current_time}.csv"
+                upload = MultipartUpload.create(
+                    "default", f"staff-metadata-csvs/{uuid.uuid4()}/{csv_filename}"
+                )
+                fieldnames = None
+                # the upload is recorded right away so that it's aborted if the job fails
+                job.save_checkpoint(
+                    processed=0, upload=upload.to_checkpoint(), fieldnames=None, after=""
+                )
+
+            image_csv = staff_image_metadata_csv(qs=qs)
+            headers = next(image_csv)
+            buffer = io.StringIO()
+            # the headers of the first attempt are kept so the rows of later attempts line up
+            # with them. metadata keys which are first used between attempts are left out.
+            writer = EscapingDictWriter(buffer, fieldnames or headers, extrasaction="ignore")
+
+            if fieldnames is None:
+                fieldnames = headers
+                writer.writeheader()
+
+            processed = job.processed
+
+            for metadata_row in image_csv:
+                # the generator returns a narrowed type after the first element
+                metadata_row = cast("dict[str, str | bool | float]", metadata_row)
+                writer.writerow(metadata_row)
+                processed += 1
+
+                if buffer.tell() >= MULTIPART_UPLOAD_MIN_PART_SIZE:
+                    upload.upload_part(buffer.getvalue().encode())
+                    buffer.seek(0)
+                    buffer.truncate()
+                    job.save_checkpoint(
+                        processed=processed,
+                        upload=upload.to_checkpoint(),
+                        fieldnames=fieldnames,
+                        after=metadata_row["isic_id"],
+                    )
+
+            upload.upload_part(buffer.getvalue().encode())
+            upload.complete()
+            # the upload finished, a later attempt only needs to send the email
+            job.save_checkpoint(processed=processed, upload=upload.to_checkpoint())
+
+        signed_url = expiring_url(upload.storage, upload.name, timedelta(days=1))
+
+        message = render_to_string(
+            "core/email/image_list_metadata_csv_generated.txt",
+            {"csv_url": signed_url, "rows": job.processed},
+        )
+        send_mail("Metadata CSV Ready", message, settings.DEFAULT_FROM_EMAIL, [user.email])
 
 
 @shared_task(soft_time_limit=60 * 60 * 12, time_limit=(60 * 60 * 12) + 60)
@@ -244,16 +300,26 @@ def publish_draft_doi_task(draft_doi_id: str, user_id: int) -> None:
     publish_draft_doi(user=user, draft_doi=draft_doi)
 
 
-@shared_task(soft_time_limit=12 * 60 * 60, time_limit=12 * 60 * 60 + 60)
-def generate_archive_snapshot_task() -> None:
-    snapshot_filename, metadata_filename = snapshot_images(qs=Image.objects.public())
+@shared_task(
+    bind=True,
+    soft_time_limit=12 * 60 * 60,
+    time_limit=12 * 60 * 60 + 60,
+    acks_late=True,
+    reject_on_worker_lost=True,
+    autoretry_for=(JobRunningError,),
+    default_retry_delay=JOB_RUNNING_RETRY_DELAY.total_seconds(),
+    max_retries=None,
+)
+def generate_archive_snapshot_task(self, *, full: bool = False) -> None:
+    # a redelivered task continues the zip from the last checkpoint
+    with run_job(job_key(self)) as job:
+        if job.status == job.Status.SUCCEEDED:
+            return
+
+        snapshot = update_archive_snapshot(full=full, job=job)
 
-    try:
-        with Path(snapshot_filename).open("rb") as snapshot_file:
-            storages["sponsored"].save("snapshots/ISIC_images.zip", snapshot_file)
-    finally:
-        Path(snapshot_filename).unlink()
-        Path(metadata_filename).unlink()
+    if snapshot is not None:
+        Path(snapshot.metadata_filename).unlink()
 
 
 @shared_task(soft_time_limit=10, time_limit=15)
@@ -261,6 +327,12 @@ def prune_expired_oauth_tokens_task():
     clear_expired_oauth_tokens()
 
 
+@shared_task(soft_time_limit=300, time_limit=310)
+def prune_jobs_task():
+    pruned = prune_jobs()
+    logger.info("Pruned %d jobs.", pruned)
+
+
 @shared_task(soft_time_limit=90, time_limit=120)
 def refresh_materialized_view_collection_counts_task():
     with connection.cursor() as cursor:
@@ -1,8 +1,15 @@
+import json
+
 from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+import pyarrow as pa
 import pytest
 
+from isic.core.api.image import image_export_schema
+from isic.core.models import Image, ImageEmbedding, ImageNeighbor
 from isic.core.search import add_to_search_index, get_elasticsearch_client
+from isic.core.services.image.neighbor import compute_image_neighbors
 
 
 @pytest.fixture
@@ -51,6 +58,19 @@ def test_core_api_image_ages_are_always_rounded(
         assert r.json()["count"] == 0
 
 
+@pytest.mark.django_db
+def test_api_image_search_hides_images_made_private_since_indexing(
+    client, searchable_image, settings
+):
+    settings.ISIC_USE_ELASTICSEARCH_SEARCH_RESULTS = True
+    # the search index isn't updated until the next sync
+    Image.objects.filter(pk=searchable_image.pk).update(public=False)
+
+    r = client.get(reverse("api:image_search"))
+    assert r.status_code == 200, r.json()
+    assert r.json()["results"] == []
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize("image_file", ["full", "thumbnail_256"])
 def test_api_image_urls_thumbnail_256(client, image_factory, image_file):
@@ -105,6 +125,94 @@ def test_api_image_similar_images(authenticated_client, image_factory, image_emb
     assert "distance" in results[0]
 
 
+@pytest.mark.django_db
+def test_api_image_similar_images_tuning(authenticated_client, image_embedding_factory):
+    image = image_embedding_factory(image__public=True).image
+    url = reverse("api:image_similar", kwargs={"isic_id": image.isic_id})
+
+    r = authenticated_client.get(url, {"ef_search": 100, "probes": 20})
+    assert r.status_code == 200
+
+    r = authenticated_client.get(url, {"probes": 0})
+    assert r.status_code == 422
+
+
+@pytest.mark.django_db
+def test_api_image_similar_images_skips_invisible_neighbors(
+    authenticated_client, image_embedding_factory
+):
+    def embedding(*components):
+        return [*components, *[0.0] * (3584 - len(components))]
+
+    image = image_embedding_factory(image__public=True, embedding=embedding(1.0)).image
+    # the nearest neighbors aren't visible, so more candidates have to be fetched
+    for i in range(1, 4):
+        image_embedding_factory(image__public=False, embedding=embedding(1.0, i * 0.1))
+    farther_image = image_embedding_factory(image__public=True, embedding=embedding(1.0, 1.0)).image
+
+    with connection.cursor() as cursor:
+        cursor.execute("SET enable_indexscan = off")
+
+    url = reverse("api:image_similar", kwargs={"isic_id": image.isic_id})
+    r = authenticated_client.get(url, {"limit": 1})
+    assert r.status_code == 200
+    assert [result["isic_id"] for result in r.json()] == [farther_image.isic_id]
+
+
+@pytest.mark.django_db
+def test_image_embedding_shortlist_uses_binary_index(image_embedding_factory):
+    image_embedding = image_embedding_factory()
+
+    with CaptureQueriesContext(connection) as queries:
+        ImageEmbedding.objects.nearest(image_embedding.embedding, 1, shortlist=10)
+
+    [sql] = [query["sql"] for query in queries if "binary_quantize" in query["sql"]]
+
+    # the shortlist has to repeat the expression of the index to be able to use it
+    with connection.cursor() as cursor:
+        cursor.execute("SET enable_seqscan = off")
+        cursor.execute(f"EXPLAIN {sql}")
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+
+    assert "imageembedding_binary_hnsw" in plan
+
+
+@pytest.mark.django_db
+def test_api_image_similar_images_precomputed(authenticated_client, image_embedding_factory):
+    def embedding(*components):
+        return [*components, *[0.0] * (3584 - len(components))]
+
+    image = image_embedding_factory(image__public=True, embedding=embedding(1.0)).image
+    far_image = image_embedding_factory(image__public=True, embedding=embedding(1.0, 1.0)).image
+
+    with connection.cursor() as cursor:
+        cursor.execute("SET enable_indexscan = off")
+
+    assert compute_image_neighbors() == 2
+
+    # the new image is inserted into the neighbors of the existing images
+    near_image = image_embedding_factory(image__public=True, embedding=embedding(1.0, 0.1)).image
+    assert compute_image_neighbors() == 1
+    assert set(ImageNeighbor.objects.filter(image=image).values_list("neighbor_id", flat=True)) == {
+        near_image.pk,
+        far_image.pk,
+    }
+
+    url = reverse("api:image_similar", kwargs={"isic_id": image.isic_id})
+    r = authenticated_client.get(url)
+    assert r.status_code == 200
+    assert [result["isic_id"] for result in r.json()] == [near_image.isic_id, far_image.isic_id]
+
+
+@pytest.mark.django_db
+def test_compute_image_neighbors_stops_after_max_seconds(image_embedding_factory):
+    image_embedding_factory.create_batch(3, image__public=True)
+
+    # a batch is always processed, and none are started after the time is up
+    assert compute_image_neighbors(batch_size=1, max_seconds=0) == 1
+    assert compute_image_neighbors() == 2
+
+
 @pytest.mark.django_db
 def test_api_image_similar_images_requires_login(client, image_embedding_factory):
     image_with_embedding = image_embedding_factory(image__public=True).image
@@ -122,3 +230,88 @@ def test_api_image_similar_images_without_embedding(authenticated_client, image_
     r = authenticated_client.get(url)
     assert r.status_code == 200
     assert r.json() == []
+
+
+@pytest.mark.django_db
+def test_api_image_batch(client, image_factory):
+    public_images = [image_factory(public=True) for _ in range(2)]
+    public_images[0].accession.update_metadata(
+        public_images[0].creator, {"clin_size_long_diam_mm": "3.14"}, ignore_image_check=True
+    )
+    private_image = image_factory(public=False)
+
+    r = client.post(
+        reverse("api:image_batch"),
+        {
+            "isic_ids": [
+                public_images[1].isic_id,
+                private_image.isic_id,
+                "ISIC_9999999",
+                public_images[0].isic_id,
+                public_images[1].isic_id,
+            ]
+        },
+        content_type="application/json",
+    )
+    assert r.status_code == 200
+    results = json.loads(b"".join(r.streaming_content))
+
+    # results are in request order, without duplicates
+    assert [image["isic_id"] for image in results["results"]] == [
+        public_images[1].isic_id,
+        public_images[0].isic_id,
+    ]
+    assert isinstance(results["results"][0]["files"]["full"]["url"], str)
+    assert results["results"][1]["metadata"]["clinical"]["clin_size_long_diam_mm"] == "3.14"
+    assert results["no_perms_or_does_not_exist"] == [private_image.isic_id, "ISIC_9999999"]
+
+
+@pytest.mark.django_db
+def test_api_image_batch_invalid_isic_id(client):
+    r = client.post(
+        reverse("api:image_batch"),
+        {"isic_ids": ["not-an-isic-id"]},
+        content_type="application/json",
+    )
+    assert r.status_code == 422
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("encoding", ["", "gzip", "zstd"])
+def test_api_image_export_ndjson(client, image_factory, encoding):
+    images = sorted(
+        [image_factory(public=True) for _ in range(3)] + [image_factory(public=False)],
+        key=lambda image: image.isic_id,
+    )
+    public_isic_ids = [image.isic_id for image in images if image.public]
+
+    r = client.get(reverse("api:image_export"), headers={"accept-encoding": encoding})
+    assert r.status_code == 200
+    assert r.get("Content-Encoding") == (encoding or None)
+
+    content = b"".join(r.streaming_content)
+    if encoding:
+        content = pa.CompressedInputStream(pa.py_buffer(content), encoding).read()
+
+    records = [json.loads(line) for line in content.splitlines()]
+    assert [record["isic_id"] for record in records] == public_isic_ids
+
+    # resume after the first record
+    r = client.get(reverse("api:image_export"), {"after": public_isic_ids[0]})
+    records = [json.loads(line) for line in b"".join(r.streaming_content).splitlines()]
+    assert [record["isic_id"] for record in records] == public_isic_ids[1:]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_api_image_export_arrow(client, image_factory):
+    image = image_factory(public=True, accession__age=52, accession__sex="female")
+
+    r = client.get(reverse("api:image_export"), {"format": "arrow"})
+    assert r.status_code == 200
+
+    table = pa.ipc.open_stream(b"".join(r.streaming_content)).read_all()
+    assert table.schema == image_export_schema()
+    records = table.to_pylist()
+    assert [record["isic_id"] for record in records] == [image.isic_id]
+    assert records[0]["metadata"]["clinical"]["age_approx"] == 50
+    assert records[0]["metadata"]["clinical"]["sex"] == "female"
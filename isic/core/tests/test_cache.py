@@ -1,7 +1,9 @@
+from django.core.cache import cache
 from django.urls import reverse
 import pytest
 
 from isic.core.tasks import sync_elasticsearch_indices_task
+from isic.core.utils.cache import get_or_set_single_flight, mark_stale
 
 
 @pytest.mark.django_db
@@ -26,3 +28,30 @@ def test_faceting_cache(client, django_assert_max_num_queries):
 
     with django_assert_max_num_queries(1):
         client.get(reverse("api:image_facets"), {"query": "age_approx:50"})
+
+
+def test_single_flight_serves_stale_value_while_locked(mocker):
+    cache.set("lock:some-key", value=True)
+    cache.set("stale:some-key", "stale")
+    compute = mocker.Mock()
+
+    assert get_or_set_single_flight("some-key", compute) == "stale"
+    compute.assert_not_called()
+
+
+def test_single_flight_computes_once(mocker):
+    compute = mocker.Mock(return_value="fresh")
+
+    assert get_or_set_single_flight("some-key", compute) == "fresh"
+    assert get_or_set_single_flight("some-key", compute) == "fresh"
+    compute.assert_called_once()
+    assert cache.get("lock:some-key") is None
+
+
+def test_mark_stale():
+    cache.set("some-prefix:key", "value")
+
+    mark_stale("some-prefix:*", 60)
+
+    assert cache.get("some-prefix:key") is None
+    assert cache.get("stale:some-prefix:key") == "value"
@@ -1,8 +1,15 @@
 from django.db.models.query_utils import Q
-from pyparsing.exceptions import ParseException
 import pytest
 
-from isic.core.dsl import django_parser, es_parser, parse_query
+from isic.core.dsl import (
+    ParseException,
+    canonical_query,
+    canonicalize,
+    django_parser,
+    es_parser,
+    parse_query,
+)
+from isic.core.serializers import SearchQueryIn
 
 # test null problem
 
@@ -175,3 +182,80 @@ def test_dsl_es_parser(query, filter):
 )
 def test_dsl_image_type_backwards_compatible(query, filter):
     assert parse_query(django_parser, query) == filter
+
+
+@pytest.mark.parametrize(
+    ("query", "loc"),
+    [
+        ("", 0),
+        ("diagnosis_1:foo randstring", 16),
+        ("diagnosis_1:foo AND", 16),
+        ("(diagnosis_1:foo", 16),
+        ("diagnosis_1:", 12),
+        ("age_approxx:50", 10),
+        ("age_approx:[50 TO", 17),
+    ],
+)
+def test_dsl_parse_error_location(query, loc):
+    with pytest.raises(ParseException) as excinfo:
+        parse_query(es_parser, query)
+
+    assert excinfo.value.loc == loc
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "image_type:dermoscopic diagnosis_1:Benign",
+        "diagnosis_1:Benign   AND image_type:dermoscopic",
+        "((image_type:dermoscopic) AND (diagnosis_1:Benign))",
+        "diagnosis_1:Benign AND diagnosis_1:Benign AND image_type:dermoscopic",
+    ],
+)
+def test_dsl_equivalent_queries_are_canonicalized(query):
+    canonical = "diagnosis_1:Benign AND image_type:dermoscopic"
+
+    assert canonical_query(query) == canonical
+    assert (
+        SearchQueryIn(query=query).to_cache_key() == SearchQueryIn(query=canonical).to_cache_key()
+    )
+
+
+@pytest.mark.parametrize(
+    ("query", "canonical", "filter"),
+    [
+        (
+            "image_type:clinical",
+            'image_type:"clinical: close-up"',
+            {"term": {"image_type": "clinical: close-up"}},
+        ),
+        (
+            "diagnosis_1:b OR (diagnosis_1:a OR diagnosis_1:b*)",
+            "(diagnosis_1:a OR diagnosis_1:b) OR diagnosis_1:b*",
+            {
+                "bool": {
+                    "should": [
+                        {"terms": {"diagnosis_1": ["a", "b"]}},
+                        {"wildcard": {"diagnosis_1": {"value": "b*"}}},
+                    ]
+                }
+            },
+        ),
+        (
+            "age_approx:[50 TO *] age_approx:{* TO 70} -age_approx:[55 TO 60]",
+            "-age_approx:[55 TO 60] AND age_approx:[50 TO 70}",
+            {
+                "bool": {
+                    "filter": [
+                        {"bool": {"must_not": {"range": {"age_approx": {"gte": 55, "lte": 60}}}}},
+                        {"range": {"age_approx": {"gte": 50, "lt": 70}}},
+                    ]
+                }
+            },
+        ),
+    ],
+)
+def test_dsl_canonical_query(query, canonical, filter):
+    assert canonical_query(query) == canonical
+    assert canonical_query(canonical) == canonical
+    assert es_parser(canonicalize(query)) == filter
@@ -1,6 +1,11 @@
 import pytest
 
-from isic.core.health import check_engagement_profile_defaults_consistent, run_all_health_checks
+from isic.core.health import (
+    check_engagement_profile_defaults_consistent,
+    check_public_metadata_consistency,
+    run_all_health_checks,
+)
+from isic.core.models import Image
 
 
 @pytest.mark.django_db
@@ -20,3 +25,13 @@ def test_engagement_profile_defaults_inconsistent(
     result = check_engagement_profile_defaults_consistent()
     assert not result.passed
     assert "1 engagement profiles" in result.message
+
+
+@pytest.mark.django_db
+def test_public_metadata_inconsistent(image_factory):
+    image = image_factory(accession__age=52)
+    Image.objects.filter(pk=image.pk).update(public_metadata={})
+
+    result = check_public_metadata_consistency()
+    assert not result.passed
+    assert image.isic_id in result.message
@@ -0,0 +1,145 @@
+from datetime import timedelta
+
+from django.core.files.storage import storages
+from django.db import connections
+from django.utils import timezone
+import pytest
+
+from isic.core.jobs import (
+    JOB_LOCK_NAMESPACE,
+    MAX_JOB_ATTEMPTS,
+    MULTIPART_UPLOAD_MIN_PART_SIZE,
+    JobAttemptsExceededError,
+    JobRunningError,
+    MultipartUpload,
+    prune_jobs,
+    run_job,
+)
+from isic.core.models import Job
+
+
+def _fail_after_checkpoint():
+    with run_job("test", total=10) as job:
+        job.save_checkpoint(processed=4, after="ISIC_0000003")
+        raise RuntimeError
+
+
+@pytest.mark.django_db
+def test_run_job_resumes_from_checkpoint():
+    with pytest.raises(RuntimeError):
+        _fail_after_checkpoint()
+
+    job = Job.objects.get(key="test")
+    assert job.status == Job.Status.FAILED
+    assert job.progress == 0.4
+
+    with run_job("test", total=10) as job:
+        assert job.attempts == 2
+        assert job.checkpoint == {"after": "ISIC_0000003"}
+
+    job.refresh_from_db()
+    assert job.status == Job.Status.SUCCEEDED
+    assert job.checkpoint == {}
+
+    # a job which succeeded isn't attempted again
+    with run_job("test", total=10) as job:
+        assert job.status == Job.Status.SUCCEEDED
+        assert job.attempts == 2
+
+
+def _fail_with_upload():
+    with run_job("test") as job:
+        upload = MultipartUpload.create("default", "test-multipart-upload")
+        job.save_checkpoint(processed=0, upload=upload.to_checkpoint())
+        raise RuntimeError
+
+
+@pytest.mark.django_db
+def test_run_job_aborts_upload_on_failure(mocker):
+    abort = mocker.patch.object(MultipartUpload, "abort", autospec=True)
+
+    with pytest.raises(RuntimeError):
+        _fail_with_upload()
+
+    abort.assert_called_once()
+    assert abort.call_args.args[0].name == "test-multipart-upload"
+
+    # the checkpoint can't be resumed from without the upload
+    job = Job.objects.get(key="test")
+    assert job.status == Job.Status.FAILED
+    assert job.checkpoint == {}
+
+
+def _attempt_job():
+    with run_job("test"):
+        pass
+
+
+@pytest.mark.django_db
+def test_run_job_gives_up_after_max_attempts():
+    Job.objects.create(key="test", attempts=MAX_JOB_ATTEMPTS)
+
+    with pytest.raises(JobAttemptsExceededError):
+        _attempt_job()
+
+    assert Job.objects.get(key="test").status == Job.Status.FAILED
+
+
+@pytest.mark.django_db
+def test_run_job_rejects_concurrent_attempt():
+    job = Job.objects.create(key="test", attempts=1)
+    # another worker, which has a database session of its own
+    other = connections.create_connection("default")
+
+    try:
+        with other.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s, %s)", [JOB_LOCK_NAMESPACE, job.pk])
+
+        with pytest.raises(JobRunningError):
+            _attempt_job()
+
+        # the running attempt is left alone
+        job.refresh_from_db()
+        assert job.status == Job.Status.RUNNING
+        assert job.attempts == 1
+    finally:
+        other.close()
+
+    # the lock is released with the session of a worker which died
+    _attempt_job()
+    assert Job.objects.get(key="test").status == Job.Status.SUCCEEDED
+
+
+@pytest.mark.django_db
+def test_prune_jobs(mocker):
+    abort = mocker.patch.object(MultipartUpload, "abort", autospec=True)
+    upload = MultipartUpload("default", "test-multipart-upload", "upload-id")
+    recent = Job.objects.create(key="recent", checkpoint={"upload": upload.to_checkpoint()})
+    stale = Job.objects.create(key="stale", checkpoint={"upload": upload.to_checkpoint()})
+    succeeded = Job.objects.create(key="succeeded", status=Job.Status.SUCCEEDED)
+    Job.objects.filter(pk__in=[stale.pk, succeeded.pk]).update(
+        modified=timezone.now() - timedelta(days=8)
+    )
+
+    assert prune_jobs() == 2
+
+    assert list(Job.objects.all()) == [recent]
+    # only the upload of the stale job which didn't succeed is aborted
+    abort.assert_called_once()
+
+
+def test_multipart_upload_resumes_from_checkpoint():
+    storage = storages["default"]
+    upload = MultipartUpload.create("default", "test-multipart-upload")
+    upload.upload_part(b"a" * MULTIPART_UPLOAD_MIN_PART_SIZE)
+
+    upload = MultipartUpload.from_checkpoint(upload.to_checkpoint())
+    upload.upload_part(b"b")
+    upload.complete()
+    assert upload.completed
+
+    try:
+        with storage.open(upload.name, "rb") as f:
+            assert f.read() == b"a" * MULTIPART_UPLOAD_MIN_PART_SIZE + b"b"
+    finally:
+        storage.delete(upload.name)
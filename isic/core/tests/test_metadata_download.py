@@ -1,7 +1,14 @@
+import io
+
 import pytest
 
 from isic.core.models.image import Image
-from isic.core.services import image_metadata_csv, staff_image_metadata_csv
+from isic.core.services import (
+    image_metadata_csv,
+    image_metadata_csv_copy,
+    staff_image_metadata_csv,
+)
+from isic.core.utils.csv import EscapingDictWriter
 
 
 @pytest.fixture
@@ -50,6 +57,29 @@ def test_image_metadata_csv_rows_correct(image_with_metadata):
     }
 
 
+@pytest.mark.django_db
+def test_image_metadata_csv_copy_matches_image_metadata_csv(image_with_metadata, image_factory):
+    image = image_factory()
+    # values which need to be escaped or quoted
+    image.accession.attribution = '=HYPERLINK("http://example.com"), \nsecond line'
+    image.accession.save()
+    image.accession.update_metadata(
+        image.creator, {"age": 0, "melanocytic": False}, ignore_image_check=True
+    )
+    # an empty string, which postgres would quote
+    image_factory(accession__attribution="")
+
+    qs = Image.objects.all()
+    fieldnames, rows = image_metadata_csv(qs=qs)
+    expected = io.StringIO(newline="")
+    writer = EscapingDictWriter(expected, fieldnames)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+
+    assert b"".join(image_metadata_csv_copy(qs=qs)) == expected.getvalue().encode()
+
+
 @pytest.mark.django_db
 def test_staff_image_metadata_csv_rows_correct(image_with_metadata):
     rows = staff_image_metadata_csv(qs=Image.objects.filter(pk=image_with_metadata.pk))
@@ -34,6 +34,19 @@ def test_image_masks_unsafe_metadata(image_with_maskable_metadata):
     assert image_with_maskable_metadata.metadata["patient_id"] != "supersecretpatientid"
 
 
+@pytest.mark.django_db
+def test_image_public_metadata_follows_metadata(image_with_maskable_metadata):
+    image = Image.objects.get(pk=image_with_maskable_metadata.pk)
+    assert image.public_metadata == image.metadata
+    assert image.public_metadata["age_approx"] == 30
+
+    image.accession.remove_metadata(image.creator, ["age"], ignore_image_check=True)
+
+    image = Image.objects.get(pk=image.pk)
+    assert image.public_metadata == image.metadata
+    assert "age_approx" not in image.public_metadata
+
+
 @pytest.mark.django_db
 def test_image_csv_headers_exposes_safe_metadata(image_with_maskable_metadata):
     headers, _ = image_metadata_csv(qs=Image.objects.all())
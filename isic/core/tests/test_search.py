@@ -1,16 +1,32 @@
+from base64 import b64encode
+from datetime import datetime
+from decimal import Decimal
+import json
+
 from cachalot.api import cachalot_disabled
+from django.conf import settings
 from django.urls import reverse
+from elastic_transport import JsonSerializer
 from isic_metadata.fields import ImageTypeEnum
 import pytest
 from pytest_lazy_fixtures import lf
 
+from isic.core.counts import image_count
 from isic.core.dsl import es_parser, parse_query
+from isic.core.models import Image, SearchIndexUpdate
 from isic.core.search import (
+    _pk_ranges,
     add_to_search_index,
     build_elasticsearch_query,
     facets,
     get_elasticsearch_client,
+    index_generations,
+    invalidate_search_caches,
+    reindex_search_indices,
 )
+from isic.core.serializers import SearchQueryIn
+from isic.core.services.image import share_image
+from isic.core.tasks import sync_elasticsearch_index_updates_task
 
 
 @pytest.fixture
@@ -236,6 +252,15 @@ def test_core_api_image_search_contributed(private_searchable_image, authenticat
     assert r.json()["count"] == 1, r.json()
 
 
+@pytest.mark.django_db
+def test_build_elasticsearch_query_contributor_owner(user, contributor_factory):
+    contributor_factory.create_batch(2, owners=[user])
+
+    query = build_elasticsearch_query({}, user)
+
+    assert {"terms": {"contributor_owner_ids": [user.pk]}} in query["bool"]["should"]
+
+
 @pytest.mark.django_db
 def test_core_api_image_search_shares(
     private_searchable_image, authenticated_client, user, staff_user
@@ -367,6 +392,20 @@ def test_core_api_image_faceting_structure(searchable_images, client):
     }, r.json()
 
 
+@pytest.mark.django_db
+def test_facets_single_query(searchable_images, mocker):
+    search = mocker.spy(get_elasticsearch_client(), "search")
+
+    actual = facets()
+
+    assert search.call_count == 1
+    for field, facet in actual.items():
+        assert not field.endswith(("_missing", "_present"))
+        assert facet["meta"]["missing_count"] + facet["meta"]["present_count"] == len(
+            searchable_images
+        )
+
+
 @pytest.mark.parametrize(
     "client_",
     [
@@ -440,3 +479,135 @@ def test_facet_range_buckets_add_wildcard_to_final_bucket(image_factory):
 
     final_range_bucket = actual["mel_thick_mm"]["buckets"][-1]
     assert final_range_bucket["to"] == "*"
+
+
+@pytest.mark.django_db
+def test_sync_elasticsearch_index_updates(private_searchable_image, user, staff_user):
+    share_image(image=private_searchable_image, grantor=staff_user, grantee=user)
+    assert SearchIndexUpdate.objects.filter(image=private_searchable_image).exists()
+
+    sync_elasticsearch_index_updates_task()
+    get_elasticsearch_client().indices.refresh(index="_all")
+
+    assert not SearchIndexUpdate.objects.exists()
+    document = get_elasticsearch_client().get(
+        index=settings.ISIC_ELASTICSEARCH_IMAGES_INDEX, id=str(private_searchable_image.pk)
+    )
+    assert document["_source"]["shared_to"] == [user.pk]
+
+
+@pytest.mark.django_db
+def test_reindex_search_indices(image_factory):
+    image = image_factory(public=True)
+    es = get_elasticsearch_client()
+    alias = settings.ISIC_ELASTICSEARCH_IMAGES_INDEX
+
+    try:
+        reindex_search_indices(keep=1)
+        first_generation = index_generations(alias)[-1]
+        assert list(es.indices.get_alias(name=alias)) == [first_generation]
+        assert es.get(index=alias, id=str(image.pk))["found"]
+
+        reindex_search_indices(keep=1)
+        reindex_search_indices(keep=1)
+        generations = index_generations(alias)
+        # the live generation and the one preceding it
+        assert len(generations) == 2
+        assert first_generation not in generations
+        assert list(es.indices.get_alias(name=alias)) == [generations[-1]]
+        # the bulk load settings are reset once the index is loaded
+        live_settings = es.indices.get_settings(index=alias)[generations[-1]]["settings"]
+        assert "refresh_interval" not in live_settings["index"]
+    finally:
+        for index in [alias, settings.ISIC_ELASTICSEARCH_LESIONS_INDEX]:
+            if generations := index_generations(index):
+                es.indices.delete(index=",".join(generations))
+
+
+@pytest.mark.django_db
+def test_pk_ranges_cover_queryset(image_factory):
+    images = [image_factory() for _ in range(5)]
+    qs = Image.objects.all()
+
+    ranges = _pk_ranges(qs, 2)
+
+    assert len(ranges) == 3
+    assert ranges[-1][1] is None
+    covered = []
+    for start, end in ranges:
+        range_qs = qs.filter(pk__gte=start)
+        if end is not None:
+            range_qs = range_qs.filter(pk__lt=end)
+        covered.extend(range_qs.values_list("pk", flat=True))
+    assert sorted(covered) == sorted(image.pk for image in images)
+
+
+@pytest.mark.django_db
+def test_elasticsearch_document_matches_model(image_factory, collection_factory, user, staff_user):
+    image = image_factory(
+        public=True,
+        accession__age=52,
+        accession__mel_thick_mm=Decimal("1.25"),
+        accession__diagnosis_1="Benign",
+    )
+    collection_factory().images.add(image)
+    share_image(image=image, grantor=staff_user, grantee=user)
+    image.accession.cohort.contributor.owners.add(user)
+
+    expected = (
+        Image.objects.with_elasticsearch_properties()
+        .get(pk=image.pk)
+        .to_elasticsearch_document(source_only=True)
+    )
+    actual = json.loads(
+        Image.objects.with_elasticsearch_document().get(pk=image.pk).elasticsearch_document
+    )
+
+    assert datetime.fromisoformat(actual.pop("created")) == expected.pop("created")
+    assert actual == json.loads(JsonSerializer().dumps(expected))
+    assert actual["age_approx"] == 50
+
+
+@pytest.mark.django_db
+def test_core_api_image_search_elasticsearch_results(searchable_images, staff_client, settings):
+    settings.ISIC_USE_ELASTICSEARCH_SEARCH_RESULTS = True
+    images = sorted(searchable_images, key=lambda image: image.created)
+
+    r = staff_client.get(reverse("api:image_search"), {"limit": 1})
+    assert r.status_code == 200, r.json()
+    assert r.json()["count"] == 2
+    assert [image["isic_id"] for image in r.json()["results"]] == [images[0].isic_id]
+    assert r.json()["previous"] is None
+
+    r = staff_client.get(r.json()["next"])
+    assert r.status_code == 200, r.json()
+    assert r.json()["count"] is None
+    assert [image["isic_id"] for image in r.json()["results"]] == [images[1].isic_id]
+    assert r.json()["next"] is None
+
+    r = staff_client.get(r.json()["previous"])
+    assert r.status_code == 200, r.json()
+    assert [image["isic_id"] for image in r.json()["results"]] == [images[0].isic_id]
+    assert r.json()["previous"] is None
+
+    # a position for a different sort is rejected
+    r = staff_client.get(
+        reverse("api:image_search"),
+        {"pin_sort": "true", "cursor": b64encode(b"p=1%7C2").decode()},
+    )
+    assert r.status_code == 422, r.json()
+
+
+@pytest.mark.django_db
+def test_image_count_cached_by_generation(searchable_images, user_factory, mocker):
+    count = mocker.spy(get_elasticsearch_client(), "count")
+    users = [user_factory(), user_factory()]
+
+    assert image_count(SearchQueryIn(), users[0]) == 1
+    # users who can see the same images share the count
+    assert image_count(SearchQueryIn(), users[1]) == 1
+    assert count.call_count == 1
+
+    invalidate_search_caches()
+    assert image_count(SearchQueryIn(), users[0]) == 1
+    assert count.call_count == 2
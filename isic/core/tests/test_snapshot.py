@@ -1,9 +1,30 @@
+from datetime import UTC, datetime, timedelta
+import io
+from pathlib import Path
 import zipfile
 
+from django.core.files.base import ContentFile
 from django.core.files.storage import storages
 import pytest
 
+from isic.core.models import Image
+from isic.core.services.snapshot import (
+    ARCHIVE_DELTA_KEY,
+    ARCHIVE_DELTA_PREFIX,
+    ARCHIVE_DELTA_TIMESTAMP_FORMAT,
+    ARCHIVE_MANIFEST_KEY,
+    ARCHIVE_SNAPSHOT_KEY,
+    ARCHIVE_SNAPSHOT_PARTIAL_KEY,
+    _open_zip,
+    _zip_entries_checkpoint,
+    _zip_entries_from_checkpoint,
+    prune_archive_deltas,
+    read_snapshot_manifest,
+    snapshot_images,
+    update_archive_snapshot,
+)
 from isic.core.tasks import generate_archive_snapshot_task
+from isic.core.utils.http import ChunkSink
 
 
 @pytest.mark.django_db(transaction=True)
@@ -22,3 +43,164 @@ def test_snapshot_task(public_image, private_image):
     # clean this up since it's in a predetermined spot and it's useful to sometimes run
     # tests via pytest-repeat.
     storages["sponsored"].delete("snapshots/ISIC_images.zip")
+    storages["sponsored"].delete(ARCHIVE_MANIFEST_KEY)
+
+
+def test_snapshot_zip_resumes_from_checkpoint():
+    sink = ChunkSink()
+    with _open_zip(sink) as bundle:
+        bundle.writestr("a.txt", "a" * 1000)
+        bundle.writestr("b.jpg", b"b", compress_type=zipfile.ZIP_STORED)
+        written = sink.take()
+        position = sink.tell()
+        checkpoint = _zip_entries_checkpoint(bundle.filelist)
+
+    # another process continues the zip from where the first left off
+    sink = ChunkSink(position)
+    with _open_zip(sink, _zip_entries_from_checkpoint(checkpoint)) as bundle:
+        bundle.writestr("c.txt", "c")
+    written += sink.take()
+
+    with zipfile.ZipFile(io.BytesIO(written)) as z:
+        assert z.testzip() is None
+        assert z.namelist() == ["a.txt", "b.jpg", "c.txt"]
+        assert z.read("a.txt") == b"a" * 1000
+        assert z.read("c.txt") == b"c"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_snapshot_task_delta(public_reviewed_image_factory):
+    storage = storages["sponsored"]
+    image = public_reviewed_image_factory()()
+    snapshot = None
+
+    try:
+        generate_archive_snapshot_task()
+        assert read_snapshot_manifest(storage, ARCHIVE_MANIFEST_KEY).keys() == {image.isic_id}
+
+        # nothing changed, so there's no delta
+        assert update_archive_snapshot() is None
+
+        new_image = public_reviewed_image_factory()()
+        snapshot = update_archive_snapshot()
+        assert snapshot is not None
+        Path(snapshot.metadata_filename).unlink()
+
+        with storage.open(snapshot.name, "rb") as f, zipfile.ZipFile(f) as z:
+            images = [name for name in z.namelist() if name.startswith("images/")]
+            assert images == [f"images/{new_image.isic_id}.jpg"]
+            assert z.read("removed.txt") == b""
+
+        assert read_snapshot_manifest(storage, ARCHIVE_MANIFEST_KEY).keys() == {
+            image.isic_id,
+            new_image.isic_id,
+        }
+    finally:
+        for name in [ARCHIVE_SNAPSHOT_KEY, ARCHIVE_MANIFEST_KEY]:
+            storage.delete(name)
+
+        if snapshot is not None:
+            storage.delete(snapshot.name)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_snapshot_task_delta_metadata_change(public_reviewed_image_factory):
+    storage = storages["sponsored"]
+    image = public_reviewed_image_factory()()
+    snapshot = None
+
+    try:
+        generate_archive_snapshot_task()
+
+        # the blob is the same, but metadata.csv of the delta has to include the new attribution
+        image.accession.attribution = "A new attribution"
+        image.accession.save(update_fields=["attribution"])
+
+        snapshot = update_archive_snapshot()
+        assert snapshot is not None
+        Path(snapshot.metadata_filename).unlink()
+
+        with storage.open(snapshot.name, "rb") as f, zipfile.ZipFile(f) as z:
+            assert f"images/{image.isic_id}.jpg" in z.namelist()
+            assert b"A new attribution" in z.read("metadata.csv")
+    finally:
+        for name in [ARCHIVE_SNAPSHOT_KEY, ARCHIVE_MANIFEST_KEY]:
+            storage.delete(name)
+
+        if snapshot is not None:
+            storage.delete(snapshot.name)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_snapshot_task_full_writes_delta(public_reviewed_image_factory):
+    storage = storages["sponsored"]
+    public_reviewed_image_factory()()
+
+    try:
+        generate_archive_snapshot_task()
+        new_image = public_reviewed_image_factory()()
+
+        snapshot = update_archive_snapshot(full=True)
+        assert snapshot is not None
+        assert snapshot.name == ARCHIVE_SNAPSHOT_KEY
+        assert not storage.exists(ARCHIVE_SNAPSHOT_PARTIAL_KEY)
+        Path(snapshot.metadata_filename).unlink()
+
+        # mirrors which sync from the deltas still see the images of the full run
+        deltas = [name for name, _, _ in storage.list_objects(ARCHIVE_DELTA_PREFIX)]
+        assert len(deltas) == 1
+        with storage.open(deltas[0], "rb") as f, zipfile.ZipFile(f) as z:
+            images = [name for name in z.namelist() if name.startswith("images/")]
+            assert images == [f"images/{new_image.isic_id}.jpg"]
+    finally:
+        for name in [ARCHIVE_SNAPSHOT_KEY, ARCHIVE_MANIFEST_KEY]:
+            storage.delete(name)
+
+        for name, _, _ in list(storage.list_objects(ARCHIVE_DELTA_PREFIX)):
+            storage.delete(name)
+
+
+def test_prune_archive_deltas():
+    storage = storages["sponsored"]
+    now = datetime.now(tz=UTC)
+    old, recent = (
+        ARCHIVE_DELTA_KEY.format(timestamp=when.strftime(ARCHIVE_DELTA_TIMESTAMP_FORMAT))
+        for when in [now - timedelta(weeks=6), now - timedelta(days=1)]
+    )
+    unrelated = f"{ARCHIVE_DELTA_PREFIX}README.txt"
+
+    try:
+        for name in [old, recent, unrelated]:
+            storage.save(name, ContentFile(b""))
+
+        assert prune_archive_deltas(storage, older_than=timedelta(weeks=5)) == 1
+
+        assert not storage.exists(old)
+        assert storage.exists(recent)
+        assert storage.exists(unrelated)
+    finally:
+        for name in [old, recent, unrelated]:
+            storage.delete(name)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_snapshot_images_compression(public_image):
+    snapshot = snapshot_images(
+        qs=Image.objects.public(), storage=storages["sponsored"], name="snapshots/test.zip"
+    )
+
+    try:
+        with (
+            storages["sponsored"].open(snapshot.name, "rb") as f,
+            zipfile.ZipFile(f) as z,
+        ):
+            assert z.getinfo(f"images/{public_image.isic_id}.jpg").compress_type == (
+                zipfile.ZIP_STORED
+            )
+            assert z.getinfo("metadata.csv").compress_type == zipfile.ZIP_DEFLATED
+            assert z.testzip() is None
+
+        assert snapshot.size == storages["sponsored"].size(snapshot.name)
+    finally:
+        storages["sponsored"].delete(snapshot.name)
+        Path(snapshot.metadata_filename).unlink()
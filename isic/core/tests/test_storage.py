@@ -26,3 +26,29 @@ def test_prevent_renaming():
             storages["default"].save("foo", ContentFile(b"test"))
     finally:
         storages["default"].delete("foo")
+
+
+def test_signed_urls_are_cached(mocker):
+    def cloudfront_storage():
+        storage = CacheableCloudFrontStorage(bucket_name="isic", custom_domain="cdn.example.com")
+        storage.cloudfront_signer = mocker.Mock()
+        storage.cloudfront_signer.generate_presigned_url.side_effect = lambda url, date_less_than: (
+            f"{url}?Signature={date_less_than.date()}"
+        )
+        return storage
+
+    storage = cloudfront_storage()
+    urls = storage.urls(["a.jpg", "b.jpg"])
+
+    expiration = CacheableCloudFrontStorage.next_expiration_time().date()
+    assert urls == {
+        "a.jpg": f"https://cdn.example.com/a.jpg?Signature={expiration}",
+        "b.jpg": f"https://cdn.example.com/b.jpg?Signature={expiration}",
+    }
+    assert storage.url("a.jpg") == urls["a.jpg"]
+    assert storage.cloudfront_signer.generate_presigned_url.call_count == 2
+
+    # other processes reuse the signatures through the shared cache
+    other_storage = cloudfront_storage()
+    assert other_storage.urls(["a.jpg", "b.jpg"]) == urls
+    other_storage.cloudfront_signer.generate_presigned_url.assert_not_called()
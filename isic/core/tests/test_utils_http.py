@@ -0,0 +1,24 @@
+from django.test import RequestFactory
+import pytest
+
+from isic.core.utils.http import accepted_content_coding
+
+
+@pytest.mark.parametrize(
+    ("accept_encoding", "expected"),
+    [
+        ("", None),
+        ("gzip", "gzip"),
+        ("gzip, zstd", "zstd"),
+        ("zstd;q=0, gzip", "gzip"),
+        ("zstd;q=0.0, gzip;q=0.000", None),
+        ("zstd;q=0.05", "zstd"),
+        ("zstd;q=0.001, gzip", "zstd"),
+        ("ZSTD; Q=0.5", "zstd"),
+        ("zstd;q=invalid, gzip", "gzip"),
+    ],
+)
+def test_accepted_content_coding(accept_encoding, expected):
+    request = RequestFactory().get("/", headers={"Accept-Encoding": accept_encoding})
+
+    assert accepted_content_coding(request) == expected
@@ -0,0 +1,115 @@
+from django.contrib.auth.models import AnonymousUser, User
+import pytest
+
+from isic.core.models import ImageVisibility
+from isic.core.models.image import ImagePermissions, ImageShare
+from isic.core.services.image import share_image
+from isic.core.visibility import get_visibility_context
+
+
+def _fresh(user: User) -> User:
+    # a new object, so nothing is memoized on it
+    return User.objects.get(pk=user.pk)
+
+
+@pytest.mark.django_db
+def test_visibility_context_cache_key(user_factory, staff_user, contributor_factory):
+    assert get_visibility_context(AnonymousUser()).cache_key == "public"
+    assert get_visibility_context(staff_user).cache_key == "staff"
+
+    user, other_user = user_factory(), user_factory()
+    assert get_visibility_context(user).cache_key == "public"
+
+    contributor = contributor_factory(owners=[user, other_user])
+    assert get_visibility_context(_fresh(user)).cache_key == f"contributors:{contributor.pk}"
+    assert (
+        get_visibility_context(_fresh(user)).cache_key
+        == get_visibility_context(_fresh(other_user)).cache_key
+    )
+
+
+@pytest.mark.django_db
+def test_visibility_context_is_memoized(user, django_assert_num_queries):
+    get_visibility_context(user)
+
+    with django_assert_num_queries(0):
+        get_visibility_context(user)
+
+    # a different object for the same user reads it from the cache
+    same_user = _fresh(user)
+    with django_assert_num_queries(0):
+        get_visibility_context(same_user)
+
+
+@pytest.mark.django_db
+def test_visibility_context_invalidated_by_ownership(user, contributor_factory):
+    contributor = contributor_factory(owners=[])
+    assert get_visibility_context(user).contributor_ids == ()
+
+    contributor.owners.add(user)
+    assert get_visibility_context(_fresh(user)).contributor_ids == (contributor.pk,)
+
+    user.owned_contributors.remove(contributor)
+    assert get_visibility_context(user).contributor_ids == ()
+
+
+@pytest.mark.django_db
+def test_visibility_context_invalidated_by_shares(user, staff_user, image_factory):
+    image = image_factory(public=False)
+    assert not get_visibility_context(user).has_shares
+
+    share_image(image=image, grantor=staff_user, grantee=user)
+    assert get_visibility_context(user).has_shares
+    assert get_visibility_context(user).cache_key == f"user:{user.pk}"
+
+
+@pytest.mark.django_db
+def test_image_visibility_index(user, image_factory):
+    image = image_factory(public=False)
+
+    def principals():
+        return set(ImageVisibility.objects.filter(image=image).values_list("principal", flat=True))
+
+    # public and contributor visibility come from the image itself
+    assert principals() == set()
+
+    image.shares.add(user, through_defaults={"grantor": image.creator})
+    assert principals() == {f"user:{user.pk}"}
+    assert list(ImagePermissions.view_image_list(_fresh(user))) == [image]
+
+    image.shares.remove(user)
+    assert principals() == set()
+
+
+@pytest.mark.django_db
+def test_image_visibility_index_keeps_public_and_contributed_images(user, image_factory):
+    public_image = image_factory(public=True)
+    contributed_image = image_factory(public=False)
+    contributed_image.accession.cohort.contributor.owners.add(user)
+    shared_image = image_factory(public=False)
+    image_factory(public=False)
+    share_image(image=shared_image, grantor=shared_image.creator, grantee=user)
+
+    assert set(ImagePermissions.view_image_list(_fresh(user))) == {
+        public_image,
+        contributed_image,
+        shared_image,
+    }
+
+
+@pytest.mark.django_db
+def test_image_visibility_index_multiple_grantors(user, user_factory, image_factory):
+    image = image_factory(public=False)
+    grantors = [user_factory(), user_factory()]
+
+    for grantor in grantors:
+        share_image(image=image, grantor=grantor, grantee=user)
+
+    # a single row despite the two shares, so the semi-join doesn't duplicate the image
+    assert list(ImagePermissions.view_image_list(_fresh(user))) == [image]
+
+    ImageShare.objects.filter(grantor=grantors[0]).delete()
+    assert ImageVisibility.objects.filter(principal=f"user:{user.pk}").exists()
+
+    ImageShare.objects.filter(grantor=grantors[1]).delete()
+    assert not ImageVisibility.objects.filter(principal=f"user:{user.pk}").exists()
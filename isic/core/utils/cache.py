@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+import threading
+import time
+from typing import Any
+
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django_redis import get_redis_connection
+
+
+def get_or_set_single_flight(  # noqa: PLR0913
+    key: str,
+    compute: Callable[[], Any],
+    timeout: Any = DEFAULT_TIMEOUT,
+    *,
+    lock_timeout: int = 30,
+    wait_timeout: float = 5.0,
+    poll_interval: float = 0.05,
+) -> Any:
+    """
+    Return the cached value for key, computing it at most once across workers on a miss.
+
+    The first worker to miss takes a lock and computes the value. Other workers serve the stale
+    value left by mark_stale if there is one, otherwise they wait for the value to be computed.
+    If it isn't computed within wait_timeout they compute it themselves, so a worker that dies
+    while holding the lock only delays others.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f"lock:{key}"
+
+    if cache.add(lock_key, value=True, timeout=lock_timeout):
+        try:
+            value = compute()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+
+        return value
+
+    stale_value = cache.get(f"stale:{key}")
+    if stale_value is not None:
+        return stale_value
+
+    deadline = time.monotonic() + wait_timeout
+    while time.monotonic() < deadline:
+        time.sleep(poll_interval)
+
+        value = cache.get(key)
+        if value is not None:
+            return value
+
+    value = compute()
+    cache.set(key, value, timeout)
+    return value
+
+
+def mark_stale(pattern: str, timeout: int) -> None:
+    """
+    Invalidate the keys matching pattern, keeping their values to be served while recomputing.
+
+    See get_or_set_single_flight. This requires django-redis, callers are expected to check
+    for delete_pattern like they would when deleting keys by pattern.
+    """
+    connection = get_redis_connection("default")
+
+    with connection.pipeline(transaction=False) as pipeline:
+        for key in cache.iter_keys(pattern):
+            stale_key = cache.make_key(f"stale:{key}")
+            pipeline.rename(cache.make_key(key), stale_key)
+            pipeline.expire(stale_key, timeout)
+
+        # keys can expire between being listed and renamed, which isn't an error here.
+        pipeline.execute(raise_on_error=False)
+
+
+class LRUCache:
+    """A bounded in-process cache which evicts the least recently used keys, safe across threads."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return None
+
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
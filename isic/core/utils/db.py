@@ -1,4 +1,5 @@
 from contextlib import contextmanager
+import json
 
 from django.db import models, transaction
 
@@ -12,3 +13,9 @@ def lock_table_for_writes(cls: type[models.Model]):
             yield
         finally:
             cursor.close()
+
+
+def estimated_count(qs: models.QuerySet) -> int:
+    """Return the planner's estimate of the number of rows in qs, without running the query."""
+    plan = json.loads(qs.order_by().explain(format="json"))
+    return plan[0]["Plan"]["Plan Rows"]
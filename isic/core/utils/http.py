@@ -1,3 +1,13 @@
+from collections.abc import Generator, Iterable
+import io
+
+from django.http.request import HttpRequest
+import pyarrow as pa
+
+# content codings which streamed responses can be compressed with, in order of preference.
+STREAMING_CONTENT_CODINGS = ["zstd", "gzip"]
+
+
 class Echo:
     """
     A file-like object which returns written values instead of storing them.
@@ -10,3 +20,117 @@ class Echo:
 
     def write(self, value: str) -> bytes:
         return value.encode("utf-8")
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    A file-like object which buffers written bytes until they're taken.
+
+    position is the offset of the first byte written, for continuing a stream whose start was
+    taken by another process.
+    """
+
+    def __init__(self, position: int = 0) -> None:
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._position = position
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self._position += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    A readable file-like object over an iterable of chunks, which counts the bytes read.
+
+    Reads can be shorter than requested, wrap it in an io.BufferedReader for consumers which
+    expect full reads.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+
+            if chunk is None:
+                return 0
+
+            self._chunk = memoryview(chunk)
+
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        self.size += n
+        return n
+
+
+def _quality(params: Iterable[str]) -> float:
+    """Return the q value of the parameters of an Accept-Encoding coding, which defaults to 1."""
+    for param in params:
+        key, _, value = param.partition("=")
+
+        if key.strip().lower() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                # a coding with a malformed weight isn't assumed to be acceptable
+                return 0.0
+
+    return 1.0
+
+
+def accepted_content_coding(request: HttpRequest) -> str | None:
+    """Return the preferred coding from STREAMING_CONTENT_CODINGS accepted by the client."""
+    accepted = set()
+
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        name, *params = (part.strip() for part in coding.split(";"))
+
+        # a weight of 0 means the coding isn't acceptable, any other weight means it is
+        if _quality(params) > 0:
+            accepted.add(name.lower())
+
+    return next((coding for coding in STREAMING_CONTENT_CODINGS if coding in accepted), None)
+
+
+def compress_stream(chunks: Iterable[bytes], coding: str) -> Generator[bytes]:
+    """
+    Compress a stream of chunks with a content coding, yielding output as it's produced.
+
+    The compressor buffers internally, so small chunks won't yield anything until enough
+    of them have been written.
+    """
+    sink = ChunkSink()
+    compressed = pa.CompressedOutputStream(sink, coding)
+
+    for chunk in chunks:
+        compressed.write(chunk)
+
+        if data := sink.take():
+            yield data
+
+    compressed.close()
+
+    if data := sink.take():
+        yield data
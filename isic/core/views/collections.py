@@ -1,6 +1,4 @@
-from collections.abc import Generator
 from datetime import UTC, datetime
-from itertools import batched
 from typing import Any
 
 from django.contrib import messages
@@ -20,10 +18,8 @@ from isic.core.forms.collection import CollectionForm
 from isic.core.models import Collection
 from isic.core.pagination import CursorPagination, qs_with_hardcoded_count
 from isic.core.permissions import get_visible_objects, needs_object_permission
-from isic.core.services import image_metadata_csv
+from isic.core.services import image_metadata_csv_copy
 from isic.core.services.collection import create_collection, update_collection
-from isic.core.utils.csv import EscapingDictWriter
-from isic.core.utils.http import Echo
 from isic.ingest.models import Contributor
 
 
@@ -79,18 +75,8 @@ def collection_download_metadata(request, pk):
         collection.images.all(),
     )
 
-    def csv_rows() -> Generator[bytes]:
-        fieldnames, metadata_rows = image_metadata_csv(qs=qs)
-        writer = EscapingDictWriter(Echo(), fieldnames)
-        yield writer.writeheader()
-
-        # yield rows in batches, since responding with many small chunks incurs per-chunk
-        # overhead in the WSGI write path and socket writes.
-        for metadata_batch in batched(metadata_rows, 256, strict=False):
-            yield b"".join(writer.writerow(metadata_row) for metadata_row in metadata_batch)
-
     current_time = datetime.now(tz=UTC).strftime("%Y-%m-%d")
-    response = StreamingHttpResponse(csv_rows(), content_type="text/csv")
+    response = StreamingHttpResponse(image_metadata_csv_copy(qs=qs), content_type="text/csv")
     response["Content-Disposition"] = (
         f'attachment; filename="{slugify(collection.name)}_metadata_{current_time}.csv"'
     )
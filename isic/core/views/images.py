@@ -14,11 +14,11 @@ from ninja.errors import ValidationError as NinjaValidationError
 import pydantic
 
 from isic.core.api.image import PinnedFirstPagination
+from isic.core.counts import image_count
 from isic.core.forms.search import ImageSearchForm
 from isic.core.models import Collection, Image
 from isic.core.pagination import qs_with_hardcoded_count
 from isic.core.permissions import get_visible_objects, needs_object_permission
-from isic.core.search import get_elasticsearch_client
 from isic.core.tasks import generate_staff_image_list_metadata_csv_task
 from isic.studies.models import Study
 from isic.types import AuthenticatedHttpRequest
@@ -120,7 +120,7 @@ def image_detail(request, isic_id):
         "metadata_versions": [],
     }
 
-    ctx["metadata"] = dict(sorted(image.metadata.items()))
+    ctx["metadata"] = dict(sorted(image.public_metadata.items()))
     if request.user.has_perm("core.view_full_metadata", image):
         ctx["unstructured_metadata"] = dict(
             sorted(image.accession.unstructured_metadata.value.items())
@@ -168,12 +168,9 @@ def image_browser(request):
         qs = search_form.results
 
         if settings.ISIC_USE_ELASTICSEARCH_COUNTS:
-            es_query = search_form.serializer.to_es_query(request.user)
-            es_count = get_elasticsearch_client().count(
-                index=settings.ISIC_ELASTICSEARCH_IMAGES_INDEX,
-                body={"query": es_query},
-            )["count"]
-            qs = qs_with_hardcoded_count(qs, order_by, es_count)
+            qs = qs_with_hardcoded_count(
+                qs, order_by, lambda: image_count(search_form.serializer, request.user)
+            )
 
     paginator = PinnedFirstPagination()
     try:
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from django.core.cache import cache
+from django.db import transaction
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from django.contrib.auth.models import AnonymousUser, User
+
+VISIBILITY_CONTEXT_TIMEOUT = 60 * 60
+
+# the principals an image can be visible to, see ImageVisibility.
+USER_PRINCIPAL_PREFIX = "user:"
+
+
+def user_principal(user_id: int) -> str:
+    return f"{USER_PRINCIPAL_PREFIX}{user_id}"
+
+
+@dataclass(frozen=True)
+class VisibilityContext:
+    """
+    Everything about a user which determines the images they can see.
+
+    See ImagePermissions.view_image_list for how each part is used.
+    """
+
+    user_id: int | None
+    is_staff: bool = False
+    contributor_ids: tuple[int, ...] = ()
+    has_shares: bool = False
+
+    @property
+    def cache_key(self) -> str:
+        """
+        Identify the users who can see the same images, so cached results can be shared.
+
+        Users with shares are the exception since the images shared with them are specific to
+        them.
+        """
+        if self.is_staff:
+            return "staff"
+
+        if self.has_shares:
+            return f"user:{self.user_id}"
+
+        if self.contributor_ids:
+            return f"contributors:{','.join(map(str, self.contributor_ids))}"
+
+        return "public"
+
+
+def _visibility_context_cache_key(user_id: int) -> str:
+    return f"visibility-context:{user_id}"
+
+
+def get_visibility_context(user: User | AnonymousUser) -> VisibilityContext:
+    if not user.is_authenticated:
+        return VisibilityContext(user_id=None)
+
+    if user.is_staff:
+        return VisibilityContext(user_id=user.pk, is_staff=True)
+
+    # memoize on the user object, which lives as long as the request like django's own
+    # permission caches.
+    if not hasattr(user, "_visibility_context"):
+        key = _visibility_context_cache_key(user.pk)
+        context = cache.get(key)
+
+        if context is None:
+            context = VisibilityContext(
+                user_id=user.pk,
+                contributor_ids=tuple(
+                    user.owned_contributors.order_by("id").values_list("id", flat=True)
+                ),
+                has_shares=user.image_shares_received.exists(),
+            )
+            cache.set(key, context, VISIBILITY_CONTEXT_TIMEOUT)
+
+        user._visibility_context = context  # type: ignore[union-attr]  # noqa: SLF001
+
+    return user._visibility_context  # type: ignore[union-attr]  # noqa: SLF001
+
+
+def invalidate_visibility_context(user: User) -> None:
+    user.__dict__.pop("_visibility_context", None)
+    invalidate_visibility_contexts([user.pk])
+
+
+def invalidate_visibility_contexts(user_ids: Iterable[int]) -> None:
+    keys = [_visibility_context_cache_key(user_id) for user_id in user_ids]
+
+    if keys:
+        cache.delete_many(keys)
+        # a request could read the old values and cache them again before the transaction
+        # making the change commits.
+        transaction.on_commit(lambda: cache.delete_many(keys))
@@ -1,6 +1,8 @@
 from django.core.exceptions import ValidationError
 from django.db import transaction
 
+from isic.core.models.image import Image
+from isic.core.search import queue_search_index_update
 from isic.engagement.models import EngagementProfile
 from isic.ingest.models.cohort import Cohort
 from isic.ingest.models.contributor import Contributor
@@ -31,3 +33,6 @@ def assign_engagement_defaults(
         engagement_profile.save()
 
         contributor.owners.add(engagement_profile.user)
+        queue_search_index_update(
+            qs=Image.objects.filter(accession__cohort__contributor=contributor)
+        )
@@ -14,10 +14,10 @@ from s3_file_field.widgets import S3PlaceholderFile
 
 from isic.auth import allow_any, is_authenticated, is_staff
 from isic.core.api.image import ImageOut
+from isic.core.counts import lesion_count
 from isic.core.pagination import CursorPagination
 from isic.core.permissions import get_visible_objects
 from isic.ingest.models import Accession, Cohort, Contributor, Lesion, MetadataFile
-from isic.ingest.models.lesion import get_lesion_count_for_user
 from isic.ingest.services.accession import create_accession
 from isic.ingest.services.accession.review import bulk_create_accession_reviews
 from isic.ingest.tasks import update_metadata_task
@@ -78,7 +78,7 @@ def lesion_list(request: HttpRequest):
         .order_by("id"),
     )
     # the count can be done much more efficiently than the full query
-    qs.custom_count = get_lesion_count_for_user(request.user)
+    qs.custom_count = lambda: lesion_count(request.user)
     return qs
 
 
@@ -17,10 +17,17 @@ from django.core.files import File
 from django.core.files.storage import storages
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.db import models, transaction
-from django.db.models import Deferrable, FileField, FloatField, IntegerField, Transform
+from django.db.models import (
+    Deferrable,
+    FileField,
+    FloatField,
+    IntegerField,
+    Transform,
+    Value,
+)
 from django.db.models.constraints import CheckConstraint, UniqueConstraint
 from django.db.models.fields import Field
-from django.db.models.functions import Cast, Round
+from django.db.models.functions import Cast, NullIf, Round
 from django.db.models.query_utils import Q
 from isic_metadata.fields import ImageTypeEnum
 from isic_metadata.metadata import MetadataRow
@@ -223,6 +230,9 @@ class ComputedMetadataField:
     input_field_name: str
     output_field_names: list[str]
     transformer: Transformer
+    # the same as transformer, in SQL. it's given the input field and returns the values of the
+    # output fields, formatted as they should appear in a CSV.
+    expressions: Callable[[models.Expression], dict[str, models.Expression]]
 
     type: Literal["acquisition", "clinical"]
 
@@ -543,7 +553,11 @@ class Accession(CreationSortedTimeStampedModel, AccessionMetadata):
             "age",
             ["age_approx"],
             lambda age: None if age is None else {"age_approx": int(round(age / 5.0) * 5)},
-            "clinical",
+            # an age of 0 is treated as missing, like in image_metadata_csv
+            expressions=lambda age: {
+                "age_approx": Approx(NullIf(age, Value(0)), output_field=IntegerField())
+            },
+            type="clinical",
             es_mappings={"age_approx": {"type": "integer"}},
             es_aggregates={
                 "age_approx": {
@@ -878,6 +892,7 @@ class Accession(CreationSortedTimeStampedModel, AccessionMetadata):
         2) Manages audit trails (MetadataVersion records)
         3) Resets the review
         4) Manages remapping internal fields
+        5) Updates the public metadata of the image, if published
         """
         if self.pk and not ignore_image_check:
             self._require_unpublished()
@@ -969,6 +984,9 @@ class Accession(CreationSortedTimeStampedModel, AccessionMetadata):
                 self.unstructured_metadata.save()
                 self.save()
 
+                if self.published:
+                    self.image.update_public_metadata()
+
         return modified
 
     def remove_metadata(
@@ -1006,6 +1024,9 @@ class Accession(CreationSortedTimeStampedModel, AccessionMetadata):
                 )
                 self.save()
 
+                if self.published:
+                    self.image.update_public_metadata()
+
     def remove_unstructured_metadata(
         self, user: User, unstructured_metadata_fields: list[str]
     ) -> bool:
@@ -19,6 +19,7 @@ from elasticsearch.dsl import Search
 from elasticsearch.dsl.query import Q as ESQ
 
 from isic.core.constants import LESION_ID_REGEX
+from isic.core.visibility import get_visibility_context
 
 
 def get_lesion_count_for_user(user: User | AnonymousUser) -> int:
@@ -34,12 +35,14 @@ def get_lesion_count_for_user(user: User | AnonymousUser) -> int:
     # these are structured to make the search dictionary as cacheable as possible.
     # similar to the logic in build_elasticsearch_query.
     if user.is_authenticated:
-        if user.owned_contributors.exists():
+        visibility = get_visibility_context(user)
+
+        if visibility.contributor_ids:
             should += [
                 ESQ("term", **{"images.contributor_owner_ids": user.pk}),
             ]
 
-        if user.image_shares_received.exists():
+        if visibility.has_shares:
             should += [
                 ESQ("term", **{"images.shared_to": user.pk}),
             ]
@@ -272,18 +275,16 @@ class LesionPermissions:
         if user_obj.is_staff:
             return qs
         elif user_obj.is_authenticated:
+            visibility = get_visibility_context(user_obj)
             lesion_visibility_requirements = Q(accessions__image__public=True) | Q(
-                # this needs list coercion because otherwise it will be a subquery that contains
-                # the user_id, which doesn't allow users with identical privileges to share
-                # the query cache.
-                cohort__contributor_id__in=list(
-                    user_obj.owned_contributors.order_by().values_list("id", flat=True)
-                )
+                # this uses the ids rather than a subquery that contains the user_id, which
+                # doesn't allow users with identical privileges to share the query cache.
+                cohort__contributor_id__in=visibility.contributor_ids
             )
 
             # only add the user share requirement if the user has shares, since it will put
             # the user_id into the query (making query caching less effective).
-            if user_obj.image_shares_received.exists():
+            if visibility.has_shares:
                 lesion_visibility_requirements |= Q(user_share_id=user_obj.id)
 
             return qs.filter(
@@ -8,10 +8,12 @@ from django.core.files.base import File
 from django.db import transaction
 from django.db.models import FileField
 from django.db.models.query import QuerySet
+from django.utils import timezone
 from s3_file_field.widgets import S3PlaceholderFile
 
 from isic.core.models.base import CopyrightLicense
 from isic.core.models.image import Image
+from isic.core.search import queue_search_index_update
 from isic.core.services.iptc import embed_iptc_metadata_for_image
 from isic.core.utils.db import lock_table_for_writes
 from isic.ingest.models.accession import Accession
@@ -143,7 +145,10 @@ def relicense_accessions(
     ):
         raise ValidationError("Cannot change to a more restrictive license.")
 
-    return accessions.update(copyright_license=to_license)
+    with transaction.atomic():
+        queue_search_index_update(qs=Image.objects.filter(accession__in=accessions))
+        # update skips the auto_now of modified, which the parquet export checks for changes
+        return accessions.update(copyright_license=to_license, modified=timezone.now())
 
 
 def update_accession_metadata(  # noqa: PLR0913
@@ -190,11 +195,19 @@ def update_accession_metadata(  # noqa: PLR0913
                 .in_bulk()
             )
 
+            modified_image_pks = []
+
             for accession_id, metadata_row in batch:
                 accession = accessions_by_id[accession_id]
-                accession.update_metadata(
+                modified = accession.update_metadata(
                     user,
                     metadata_row,
                     ignore_image_check=ignore_image_check,
                     reset_review=reset_review,
                 )
+
+                if modified and accession.published:
+                    modified_image_pks.append(accession.image.pk)
+
+            if modified_image_pks:
+                queue_search_index_update(qs=Image.objects.filter(pk__in=modified_image_pks))
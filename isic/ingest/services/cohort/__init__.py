@@ -5,6 +5,8 @@ from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.db.models import Count
 
+from isic.core.models.image import Image
+from isic.core.search import queue_search_index_update
 from isic.core.services.collection import merge_magic_collections
 from isic.ingest.models.accession import Accession
 from isic.ingest.models.cohort import Cohort
@@ -96,6 +98,8 @@ def merge_cohorts(*, dest_cohort: Cohort, src_cohort: Cohort) -> None:
         # iterate on the other_cohorts.
         list(Cohort.objects.filter(id__in=[dest_cohort.id, src_cohort.id]).select_for_update())
 
+        # the images could move to the cohort of another contributor, which changes their owners
+        queue_search_index_update(qs=Image.objects.filter(accession__cohort=src_cohort))
         Accession.objects.filter(cohort=src_cohort).update(cohort=dest_cohort)
         ZipUpload.objects.filter(cohort=src_cohort).update(cohort=dest_cohort)
         MetadataFile.objects.filter(cohort=src_cohort).update(cohort=dest_cohort)
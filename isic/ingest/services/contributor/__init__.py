@@ -1,6 +1,8 @@
 from django.contrib.auth.models import User
 from django.db import transaction
 
+from isic.core.models.image import Image
+from isic.core.search import queue_search_index_update
 from isic.ingest.models.contributor import Contributor
 
 
@@ -32,6 +34,12 @@ def merge_contributors(*, dest_contributor: Contributor, src_contributor: Contri
     """Merge a src_contributor into dest_contributor."""
     with transaction.atomic():
         dest_contributor.owners.add(*src_contributor.owners.all())
+        # the owners of both contributors' images change
+        queue_search_index_update(
+            qs=Image.objects.filter(
+                accession__cohort__contributor__in=[dest_contributor, src_contributor]
+            )
+        )
         src_contributor.cohorts.update(contributor=dest_contributor)
         src_contributor.engagement_profiles.update(default_contributor=dest_contributor)
         src_contributor.email_domains.update(contributor=dest_contributor)
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+from datetime import UTC, datetime
+from pathlib import Path
+import tempfile
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.core.files.storage import storages
+from django.db import connection
+from django.db.models import F, Max
+from django.db.models.fields.json import KeyTextTransform
+import pyarrow as pa
+from pyarrow import csv
+import pyarrow.parquet as pq
+
+from isic.core.models import Image
+from isic.ingest.models import Accession
+from isic.ingest.utils.parquet import ROW_GROUP_SIZE, build_parquet_schema
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from django.core.files.storage import Storage
+    from django.db.models import QuerySet
+
+
+def metadata_parquet_tables(qs: QuerySet[Image], schema: pa.Schema) -> Iterator[pa.Table]:
+    """
+    Generate the parquet rows of the images of qs, as tables of ROW_GROUP_SIZE rows.
+
+    The columns are copied out of postgres as a CSV which arrow parses into the types of schema,
+    so no python objects are created per row. Computed and remapped fields are read from
+    public_metadata, where they've already been computed.
+    """
+    columns = {
+        "isic_id": F("isic_id"),
+        "attribution": F("accession__attribution"),
+        "copyright_license": F("accession__copyright_license"),
+    }
+    columns.update(
+        {
+            name: KeyTextTransform(name, "public_metadata")
+            for name in schema.names
+            if name not in columns
+        }
+    )
+
+    # the aliases can't clash with the names of fields, and the select is in the order of the
+    # annotations.
+    aliases = {f"parquet_{i}": expression for i, expression in enumerate(columns.values())}
+    sql, params = (
+        qs.annotate(**aliases).order_by("parquet_0").values_list(*aliases).query.sql_with_params()
+    )
+
+    with tempfile.TemporaryFile() as csv_file:
+        with (
+            connection.cursor() as cursor,
+            cursor.copy(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv)", params) as copy,
+        ):
+            for row in copy:
+                csv_file.write(row)
+
+        csv_file.seek(0)
+        reader = csv.open_csv(
+            csv_file,
+            read_options=csv.ReadOptions(column_names=list(columns)),
+            convert_options=csv.ConvertOptions(
+                column_types={name: schema.field(name).type for name in columns},
+                # COPY writes nulls unquoted and empty strings quoted. the other default null
+                # values such as NA could be real values.
+                null_values=[""],
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=False,
+            ),
+        )
+
+        batches: list[pa.RecordBatch] = []
+        for batch in reader:
+            batches.append(batch)
+            table = pa.Table.from_batches(batches)
+
+            while table.num_rows >= ROW_GROUP_SIZE:
+                yield table.slice(0, ROW_GROUP_SIZE).cast(schema)
+                table = table.slice(ROW_GROUP_SIZE)
+
+            batches = table.to_batches()
+
+        if batches:
+            yield pa.Table.from_batches(batches).cast(schema)
+
+
+def _previous_export(storage: Storage, name: str) -> tuple[datetime, int] | None:
+    """Return the snapshot timestamp and the number of rows of the export in storage."""
+    if not storage.exists(name):
+        return None
+
+    with storage.open(name, "rb") as f:
+        metadata = pq.read_metadata(f)
+
+    snapshot_timestamp = (metadata.metadata or {}).get(b"snapshot_timestamp")
+    if snapshot_timestamp is None:
+        return None
+
+    return datetime.fromisoformat(snapshot_timestamp.decode()), metadata.num_rows
+
+
+def _unchanged_since(snapshot_timestamp: datetime, rows: int) -> bool:
+    last_modified = max(
+        (
+            modified
+            for modified in [
+                Image.objects.aggregate(modified=Max("modified"))["modified"],
+                Accession.objects.aggregate(modified=Max("modified"))["modified"],
+            ]
+            if modified is not None
+        ),
+        default=None,
+    )
+
+    # images which were deleted leave no modified time behind, but change the count
+    return (
+        last_modified is not None
+        and last_modified <= snapshot_timestamp
+        and Image.objects.public().count() == rows
+    )
+
+
+def export_metadata_parquet(*, force: bool = False) -> int | None:
+    """
+    Export the metadata of public images to a parquet file in sponsored storage.
+
+    The export is skipped unless force is given if no image or accession was modified since
+    the snapshot timestamp of the previous export. The file is uploaded under a temporary name
+    and then moved over the previous export, so it's never missing.
+
+    Returns the number of rows exported, or None if the export was skipped.
+    """
+    storage = storages["sponsored"]
+    name = settings.ISIC_DATA_EXPLORER_PARQUET_KEY
+    # taken before reading the images, so that changes made during the export are picked up
+    # by the next one.
+    snapshot_timestamp = datetime.now(tz=UTC)
+
+    previous = None if force else _previous_export(storage, name)
+    if previous is not None and _unchanged_since(*previous):
+        return None
+
+    schema = build_parquet_schema(
+        parquet_metadata={"snapshot_timestamp": snapshot_timestamp.isoformat()}
+    )
+    rows = 0
+
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as tmp:
+        with pq.ParquetWriter(tmp.name, schema, compression="snappy") as writer:
+            for table in metadata_parquet_tables(Image.objects.public(), schema):
+                writer.write_table(table)
+                rows += table.num_rows
+
+        partial_name = f"{name}.partial"
+        # left behind by an export which failed
+        if storage.exists(partial_name):
+            storage.delete(partial_name)
+
+        with Path(tmp.name).open("rb") as f:
+            storage.save(partial_name, f)
+
+        storage.move(partial_name, name)
+
+    return rows
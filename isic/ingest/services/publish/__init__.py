@@ -18,6 +18,7 @@ import pyexiv2
 from isic.core.models.collection import Collection
 from isic.core.models.image import Image
 from isic.core.models.isic_id import IsicId
+from isic.core.search import queue_search_index_update
 from isic.core.services.collection import create_collection
 from isic.core.services.collection.image import add_images_to_collection
 from isic.core.services.image import create_image
@@ -223,6 +224,7 @@ def unembargo_image(*, image: Image) -> None:
         )
     image.public = True
     image.save(update_fields=["public"])
+    queue_search_index_update(image=image)
 
     def delete_storage_keys():
         for storage_key in storage_keys_to_delete:
@@ -21,6 +21,7 @@ from isic.ingest.models import (
 )
 from isic.ingest.models.publish_request import PublishRequest
 from isic.ingest.services.accession import update_accession_metadata
+from isic.ingest.services.parquet import export_metadata_parquet
 from isic.ingest.services.publish import publish_accession, publish_cohort
 from isic.ingest.utils.metadata import (
     ColumnRowErrors,
@@ -171,6 +172,14 @@ def update_metadata_task(user_pk: int, metadata_file_pk: int):
     )
 
 
+@shared_task(soft_time_limit=600, time_limit=660)
+def export_metadata_parquet_task():
+    rows = export_metadata_parquet()
+
+    if rows is not None:
+        logger.info("Exported the metadata of %d images to parquet.", rows)
+
+
 @shared_task(soft_time_limit=3600, time_limit=3660)
 def publish_cohort_task(publish_request_pk: int):
     publish_request = PublishRequest.objects.get(pk=publish_request_pk)
@@ -4,6 +4,8 @@ from urllib.parse import urlparse
 from django.urls import reverse
 import pytest
 
+from isic.core.models import Image
+
 
 @pytest.mark.django_db
 def test_pagination(image_factory, staff_client):
@@ -62,3 +64,35 @@ def test_pagination_invalid_cursor(image_factory, staff_client, cursor):
     error = resp.json()["detail"][0]
     assert error["loc"] == ["query", "cursor"]
     assert error["msg"] == "Value error, Invalid cursor."
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("pin_sort", [False, True])
+def test_pagination_ties(image_factory, staff_client, pin_sort):
+    images = [image_factory(public=True) for _ in range(5)]
+    # identical positions are disambiguated by the id rather than an offset
+    Image.objects.update(created=images[0].created)
+    Image.objects.filter(pk=images[3].pk).update(pinned=1)
+    expected = list(
+        Image.objects.order_by(*(["-pinned"] if pin_sort else []), "created", "id").values_list(
+            "isic_id", flat=True
+        )
+    )
+
+    pages = []
+    resp = staff_client.get(
+        reverse("api:image_list"), data={"limit": 2, **({"pin_sort": "true"} if pin_sort else {})}
+    )
+    while True:
+        assert resp.status_code == 200, resp.json()
+        pages.append([image["isic_id"] for image in resp.json()["results"]])
+        if not resp.json()["next"]:
+            break
+        resp = staff_client.get(resp.json()["next"])
+
+    assert [isic_id for page in pages for isic_id in page] == expected
+
+    # walk back through the previous links
+    for page in reversed(pages[:-1]):
+        resp = staff_client.get(resp.json()["previous"])
+        assert [image["isic_id"] for image in resp.json()["results"]] == page
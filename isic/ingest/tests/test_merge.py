@@ -2,6 +2,7 @@ from django.core.exceptions import ValidationError
 from django.urls import reverse
 import pytest
 
+from isic.core.models import SearchIndexUpdate
 from isic.core.models.base import CopyrightLicense
 from isic.core.models.collection import Collection
 from isic.core.services.collection import merge_magic_collections
@@ -137,6 +138,17 @@ def test_merge_cohorts(full_cohort):
     )
 
 
+@pytest.mark.django_db
+def test_merge_cohorts_queues_search_index_updates(full_cohort):
+    cohort_a, cohort_b = full_cohort(), full_cohort()
+    moved_images = set(cohort_b.accessions.values_list("image__pk", flat=True))
+    SearchIndexUpdate.objects.all().delete()
+
+    merge_cohorts(dest_cohort=cohort_a, src_cohort=cohort_b)
+
+    assert set(SearchIndexUpdate.objects.values_list("image_id", flat=True)) >= moved_images
+
+
 @pytest.mark.django_db
 def test_merge_cohorts_missing_magic_collections(full_cohort):
     """Test that merging a cohort into a cohort with no magic collections works."""
@@ -1,12 +1,16 @@
 from decimal import Decimal
 import tempfile
 
+from django.conf import settings
+from django.core.files.storage import storages
 import pyarrow as pa
 import pyarrow.parquet as pq
 from pydantic_to_pyarrow import get_pyarrow_schema
 import pytest
 
+from isic.core.models import Image
 from isic.core.models.base import CopyrightLicense
+from isic.ingest.services.parquet import export_metadata_parquet, metadata_parquet_tables
 from isic.ingest.utils.parquet import (
     EXCLUDED_FIELDS,
     FIELD_ORDER,
@@ -95,3 +99,66 @@ def test_parquet_metadata_row_from_image(image_factory, accession_factory):
     assert result["age_approx"] == [55]
     assert result["anatom_site_1"][0] == "Head and neck"
     assert result["diagnosis_1"][0] == "Malignant"
+
+
+@pytest.mark.django_db
+def test_metadata_parquet_tables_match_parquet_metadata_row(image_factory, accession_factory):
+    for accession in [
+        accession_factory(
+            public=True,
+            attribution="Test Hospital",
+            sex="female",
+            age=55,
+            short_diagnosis="melanoma",
+            short_anatom_site="scalp",
+            clin_size_long_diam_mm=Decimal("3.10"),
+            melanocytic=True,
+        ),
+        # NA is a valid string rather than a null
+        accession_factory(public=True, attribution="NA", age=0, melanocytic=False),
+        accession_factory(public=True, attribution=""),
+    ]:
+        image_factory(accession=accession, public=True)
+
+    schema = build_parquet_schema()
+    qs = Image.objects.public()
+
+    expected = pa.Table.from_pylist(
+        [
+            ParquetMetadataRow(
+                isic_id=image.isic_id,
+                attribution=image.accession.attribution,
+                copyright_license=CopyrightLicense(image.accession.copyright_license),
+                **image.public_metadata,
+            ).model_dump(mode="python")
+            for image in qs.select_related("accession").order_by("isic_id")
+        ],
+        schema=schema,
+    )
+    table = pa.concat_tables(metadata_parquet_tables(qs, schema))
+
+    assert table.schema == schema
+    assert table.to_pylist() == expected.to_pylist()
+
+
+@pytest.mark.django_db
+def test_export_metadata_parquet_skips_unchanged(image_factory):
+    storage = storages["sponsored"]
+    image = image_factory(public=True)
+
+    try:
+        assert export_metadata_parquet() == 1
+        assert not storage.exists(f"{settings.ISIC_DATA_EXPLORER_PARQUET_KEY}.partial")
+
+        # nothing changed since the snapshot timestamp of the previous export
+        assert export_metadata_parquet() is None
+        assert export_metadata_parquet(force=True) == 1
+
+        image.accession.attribution = "A new attribution"
+        image.accession.save(update_fields=["attribution", "modified"])
+        assert export_metadata_parquet() == 1
+
+        with storage.open(settings.ISIC_DATA_EXPLORER_PARQUET_KEY, "rb") as f:
+            assert pq.read_table(f).to_pydict()["attribution"] == ["A new attribution"]
+    finally:
+        storage.delete(settings.ISIC_DATA_EXPLORER_PARQUET_KEY)
@@ -186,10 +186,46 @@ CELERY_BEAT_SCHEDULE = {
         "task": "isic.core.tasks.sync_elasticsearch_indices_task",
         "schedule": crontab(minute="0", hour="0"),
     },
+    "sync-elasticsearch-index-updates": {
+        "task": "isic.core.tasks.sync_elasticsearch_index_updates_task",
+        "schedule": crontab(minute="*/5", hour="*"),
+        "options": {
+            # a newer run will pick up the same updates, so there's no point in letting these
+            # pile up behind a slow run.
+            "expires": timedelta(minutes=5).total_seconds(),
+        },
+    },
+    "compute-image-neighbors": {
+        "task": "isic.core.tasks.compute_image_neighbors_task",
+        "schedule": crontab(minute="*/5", hour="*"),
+        "options": {
+            # runs work on disjoint batches, but a newer run will pick up the same embeddings.
+            "expires": timedelta(minutes=5).total_seconds(),
+        },
+    },
+    "export-metadata-parquet": {
+        "task": "isic.ingest.tasks.export_metadata_parquet_task",
+        "schedule": crontab(minute="*/15", hour="*"),
+        "options": {
+            # a newer run exports the same images, so there's no point in letting these pile up.
+            "expires": timedelta(minutes=15).total_seconds(),
+        },
+    },
+    "generate-full-archive-snapshot": {
+        "task": "isic.core.tasks.generate_archive_snapshot_task",
+        # the deltas are only relative to the previous run, so the full snapshot is rebuilt
+        # periodically to keep it current.
+        "schedule": crontab(minute="0", hour="12", day_of_week="sunday"),
+        "kwargs": {"full": True},
+    },
     "prune-expired-oauth-tokens": {
         "task": "isic.core.tasks.prune_expired_oauth_tokens_task",
         "schedule": crontab(minute="0", hour="0"),
     },
+    "prune-jobs": {
+        "task": "isic.core.tasks.prune_jobs_task",
+        "schedule": crontab(minute="30", hour="0"),
+    },
     "refresh-materialized-view-collection-counts": {
         "task": "isic.core.tasks.refresh_materialized_view_collection_counts_task",
         "schedule": crontab(minute="*/15", hour="*"),
@@ -276,9 +312,19 @@ ISIC_ELASTICSEARCH_LESIONS_INDEX = "isic-lesions"
 # time is too difficult. We hedge by having tests that verify our counts are correct
 # with both methods.
 ISIC_USE_ELASTICSEARCH_COUNTS = True
+# Serve the pages of image searches from elasticsearch, only fetching the images on the page
+# from the database. This requires the images index to contain pinned, so it must be reindexed
+# with populate_elasticsearch --reindex before this is enabled.
+ISIC_USE_ELASTICSEARCH_SEARCH_RESULTS = env.bool(
+    "DJANGO_ISIC_USE_ELASTICSEARCH_SEARCH_RESULTS", default=False
+)
 # opensearch logs every single request, which is too verbose
 logging.getLogger("elastic_transport").setLevel(logging.WARNING)
 
+# Share CloudFront url signatures between processes through the cache, see
+# CacheableCloudFrontStorage._sign_urls.
+ISIC_SIGNED_URL_SHARED_CACHE = env.bool("DJANGO_ISIC_SIGNED_URL_SHARED_CACHE", default=True)
+
 ISIC_DATACITE_API_URL: ParseResult | None = env.url("DJANGO_ISIC_DATACITE_API_URL", default=None)
 # These are the default styles with their proper names that are used by the
 # DataCite GUI. The full list of supported styles is at https://citation.doi.org/.
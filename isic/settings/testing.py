@@ -66,6 +66,7 @@ CELERY_TASK_EAGER_PROPAGATES = True
 ISIC_ELASTICSEARCH_IMAGES_INDEX = "test-isic-images"
 ISIC_ELASTICSEARCH_LESIONS_INDEX = "test-isic-lesions"
 ISIC_USE_ELASTICSEARCH_COUNTS = False
+ISIC_USE_ELASTICSEARCH_SEARCH_RESULTS = False
 
 # suppress noisy cache invalidation log messages
 logging.getLogger("isic.core.signals").setLevel(logging.ERROR)
@@ -27,9 +27,7 @@ import orjson
 from isic.auth import allow_any
 from isic.core.models import CopyrightLicense, Image
 from isic.core.serializers import SearchQueryIn
-from isic.core.services import image_metadata_csv
-from isic.core.utils.csv import EscapingDictWriter
-from isic.core.utils.http import Echo
+from isic.core.services import image_metadata_csv_copy
 from isic.types import NinjaAuthHttpRequest
 
 if TYPE_CHECKING:
@@ -182,16 +180,7 @@ def zip_download_metadata_file(request: NinjaAuthHttpRequest):
     user, search = SearchQueryIn.from_token_representation(request.auth)
     qs = search.to_queryset(user, Image.objects.select_related("accession__cohort").distinct())
 
-    fieldnames, metadata_rows = image_metadata_csv(qs=qs)
-
-    def write_response() -> Generator[bytes]:
-        writer = EscapingDictWriter(Echo(), fieldnames)
-        yield writer.writeheader()
-
-        for metadata_row in metadata_rows:
-            yield writer.writerow(metadata_row)
-
-    return StreamingHttpResponse(write_response(), content_type="text/csv")
+    return StreamingHttpResponse(image_metadata_csv_copy(qs=qs), content_type="text/csv")
 
 
 @zip_router.get("/attribution-file/", include_in_schema=False, auth=ZipDownloadTokenAuth())